@@ -0,0 +1,61 @@
+import random
+import time
+from transform import Slot, SlotIndex, overlaps_with_dict
+
+
+def random_slots(n:int, resolution:int, seed:int = 0) -> list[Slot]:
+    '''Returns n random slots of one day, at the given resolution in seconds (a few of them crossing midnight)'''
+    rng = random.Random(seed)
+    steps = 24*3600 // resolution
+    slots = []
+    for _ in range(n):
+        start = rng.randrange(steps)
+        end = (start + rng.randint(0, max(1, steps // 1440))) % steps  # Short slots (a minute, or an hour at hour resolution), so many fit in a day
+        slots.append( (start*resolution/3600, end*resolution/3600) )
+    return slots
+
+
+def same_hour_slots(n:int, seed:int = 0) -> list[Slot]:
+    '''Returns n slots of events that start and end within the same hour of one day, at hour resolution: all of them are
+    zero-length slots (the dense case of the default BR21_RESOLUTION), with a few hour-long ones among them'''
+    rng = random.Random(seed)
+    slots = []
+    for _ in range(n):
+        hour = rng.randrange(24)
+        slots.append( (hour, hour + 1) if rng.random() < 0.01 else (hour, hour) )
+    return slots
+
+
+def run_list(slots:list[Slot]) -> list[bool]:
+    stored: list[Slot] = []
+    accepted = []
+    for slot in slots:
+        ignore = overlaps_with_dict(slot, stored)
+        if not ignore: stored.append(slot)
+        accepted.append(not ignore)
+    return accepted
+
+
+def run_index(slots:list[Slot]) -> list[bool]:
+    stored = SlotIndex()
+    accepted = []
+    for slot in slots:
+        ignore = stored.overlaps(slot)
+        if not ignore: stored.add(slot)
+        accepted.append(not ignore)
+    return accepted
+
+
+if __name__ == '__main__':
+    # Events of a single (aircraft, day), the worst case for BR-21
+    cases = [ (f"resolution {resolution:>4}s", random_slots(events, resolution)) for resolution, events in [(3600, 100), (60, 1000), (1, 10000), (1, 20000)] ]
+    cases.append( ("same hour, 3600s", same_hour_slots(8000)) )
+    for case, slots in cases:
+        start = time.perf_counter()
+        expected = run_list(slots)
+        list_time = time.perf_counter() - start
+        start = time.perf_counter()
+        result = run_index(slots)
+        index_time = time.perf_counter() - start
+        assert result == expected, "SlotIndex and overlaps_with_dict disagree"
+        print(f"{len(slots):>6} events, {case}, {sum(result):>5} accepted: list {list_time:8.4f} seconds, SlotIndex {index_time:8.4f} seconds")
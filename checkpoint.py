@@ -0,0 +1,81 @@
+import json
+import os
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import pyarrow as pa  # Optional: saves the tables in the Arrow IPC format instead of JSON
+except ImportError:
+    pa = None
+
+
+
+# region TRANSFORM CHECKPOINTS
+# The output of the transform is saved before loading it, so a load that fails can be resumed without extracting and
+# transforming again (see load.checkpointed_load). Each table is saved to <table>.arrow (Arrow IPC) or, without pyarrow,
+# <table>.json, and manifest.json, written last, tells the checkpoint is complete, identifies its run and gives the format.
+# Both formats are plain data, so resuming from a checkpoint never runs code from its files
+
+MANIFEST = 'manifest.json'
+
+
+def write_atomically(path:Path, write):
+    temporary = path.with_name(f"{path.name}.tmp")
+    with open(temporary, 'wb') as file: write(file)
+    os.replace(temporary, path)  # Atomic, a resume never reads half a file
+
+
+def write_table(file, rows:list[dict], table_format:str):
+    if table_format == 'arrow':
+        table = pa.Table.from_pylist(rows)
+        with pa.ipc.new_file(file, table.schema) as writer: writer.write_table(table)
+    else:
+        file.write(json.dumps(rows).encode())
+
+
+def read_table(path:Path, table_format:str) -> list[dict]:
+    if table_format == 'arrow':
+        if pa is None: raise ImportError(f"The checkpoint table {path} is in the Arrow IPC format, which needs pyarrow")
+        with pa.memory_map(str(path)) as mapped: return pa.ipc.open_file(mapped).read_all().to_pylist()
+    with open(path, encoding='utf-8') as file: return json.load(file)
+
+
+def save(directory:str, transform_sources:dict[str, list[dict]], watermarks:dict[str, datetime], batch_size:int) -> str:
+    '''Saves the result of the transform and the settings of its load to directory. Returns the id of the run'''
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    (path / MANIFEST).unlink(missing_ok=True)  # The old checkpoint is not valid anymore
+
+    table_format = 'arrow' if pa is not None else 'json'
+    for table_name, rows in transform_sources.items():
+        write_atomically(path / f"{table_name}.{table_format}", lambda file: write_table(file, rows, table_format))
+
+    manifest = {
+        'run_id': uuid.uuid4().hex,
+        'format': table_format,
+        'created': datetime.now().isoformat(),
+        'batch_size': batch_size,
+        'tables': { table_name: len(rows) for table_name, rows in transform_sources.items() },
+        'watermarks': { source: watermark.isoformat() if watermark is not None else None for source, watermark in watermarks.items() }
+    }
+    write_atomically(path / MANIFEST, lambda file: file.write(json.dumps(manifest, indent=2).encode()))
+    return manifest['run_id']
+
+
+def read(directory:str) -> tuple[dict, dict[str, list[dict]]]:
+    '''Returns the manifest of the checkpoint in directory, with its watermarks as datetimes, and the transformed tables'''
+    path = Path(directory)
+    try:
+        with open(path / MANIFEST) as file: manifest = json.load(file)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"There is no complete checkpoint in '{directory}'") from None
+
+    manifest['watermarks'] = { source: datetime.fromisoformat(watermark) if watermark is not None else None for source, watermark in manifest['watermarks'].items() }
+    table_format = manifest.get('format')
+    if table_format not in ('arrow', 'json'):
+        raise ValueError(f"The checkpoint in '{directory}' was saved by an older version of the ETL, transform the sources again")
+    transform_sources = { table_name: read_table(path / f"{table_name}.{table_format}", table_format) for table_name in manifest['tables'] }
+    return manifest, transform_sources
+
+# endregion
@@ -0,0 +1,50 @@
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+import duckdb
+from dw import DW, duckdb_filename
+
+
+TABLES = ['days', 'months', 'aircrafts', 'reporteurs', 'daily_usage', 'monthly_usage', 'reportage_usage']
+
+# The day_id and month_id the DW used before the integer keys: non-padded 'yyyy-m-d' and 'yyyymm' strings
+VARCHAR_KEYS = {
+    'day_id': "CONCAT(day_id // 10000, '-', day_id // 100 % 100, '-', day_id % 100)",
+    'month_id': "CAST(month_id AS VARCHAR)"
+}
+
+
+def copy_dw(varchar_keys:bool) -> duckdb.DuckDBPyConnection:
+    '''Returns an in-memory copy of the DW, with its integer date keys or with them turned back into VARCHAR keys'''
+    conn = duckdb.connect()
+    conn.execute(f"ATTACH '{duckdb_filename}' AS source (READ_ONLY)")
+    for table in TABLES:
+        columns = [ column for (column,) in conn.execute(f"SELECT column_name FROM information_schema.columns WHERE table_catalog = 'source' AND table_name = '{table}' ORDER BY ordinal_position").fetchall() ]
+        select = ', '.join( f"{VARCHAR_KEYS[column]} AS {column}" if varchar_keys and column in VARCHAR_KEYS else column for column in columns )
+        conn.execute(f"CREATE TABLE {table} AS SELECT {select} FROM source.{table}")
+    conn.execute("DETACH source")
+    return conn
+
+
+def time_query(conn:duckdb.DuckDBPyConnection, runs:int) -> tuple[list, list[float]]:
+    '''Runs DW.query_utilization (without its result cache) on the given connection and returns its result and the time of every run'''
+    dw = SimpleNamespace(conn_duckdb=conn)
+    result = DW.query_utilization.__wrapped__(dw, use_rollups=False)  # Warm up
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        DW.query_utilization.__wrapped__(dw, use_rollups=False)
+        times.append(time.perf_counter() - start)
+    return result, times
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    results = {}
+    for name, varchar_keys in [('VARCHAR date keys', True), ('INTEGER date keys', False)]:
+        conn = copy_dw(varchar_keys)
+        results[name], times = time_query(conn, runs)
+        print(f"{name:<18} query_utilization: median {statistics.median(times):.4f} seconds, min {min(times):.4f} seconds ({runs} runs)")
+        conn.close()
+    assert results['VARCHAR date keys'] == results['INTEGER date keys'], "Both layouts should give the same KPIs"
@@ -1,19 +1,112 @@
+import contextlib
+import functools
 import os
+import shutil
 import sys
+import threading
+import uuid
+from datetime import date, datetime, timedelta
+from pathlib import Path
 import duckdb  # https://duckdb.org
 import pygrametl  # https://pygrametl.org
 from pygrametl.tables import CachedDimension, FactTable
+from result_cache import ResultCache
 
 
 duckdb_filename = 'dw.duckdb'
+published_filename: str|None = None    # While a shadow build runs (see start_shadow_build), the file it will replace
+
+
+def cached_query(method):
+    '''Serves the result of a DW query method from DW.result_cache while the data version it was computed on is current'''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        with self.reading():
+            return list(self.result_cache.get_or_compute(key, self.data_version, lambda: method(self, *args, **kwargs)))
+    return wrapper
+
+
+def file_identity(filename:str) -> tuple[int, int]|None:
+    '''Identifies the file a path points to now: publish_shadow_build replaces it by another one, it doesn't modify it'''
+    try:
+        stat = os.stat(filename)
+        return (stat.st_dev, stat.st_ino)
+    except OSError:
+        return None
+
+
+# region KPI FILTERS
+# The query_* methods can be restricted to a slice of the DW: the aircrafts of a manufacturer, of a model or a single registration,
+# and the months from date_from to date_to. The manufacturer and the model filter the aircrafts joined to the facts, and the
+# registration and the dates are pushed into the scans of the fact tables as conditions on their registration and date key
+# columns, by which the facts are kept sorted (see DW.cluster_facts), so DuckDB skips the row groups of the other aircrafts and
+# dates. Every KPI combines daily and monthly facts, so the date range must cover whole months. Slices that don't pick a single
+# aircraft are read from the KPI rollups instead, when they are fresh (see rollup_source)
+
+def key_ranges(date_from:date|None, date_to:date|None) -> dict[str, tuple[int|None, int|None]]:
+    '''The day_id and month_id ranges of a date range (None for an open end). Raises ValueError if it doesn't cover whole months'''
+    if date_from is not None and date_from.day != 1:
+        raise ValueError(f"date_from must be the first day of a month, not {date_from}")
+    if date_to is not None and (date_to + timedelta(days=1)).day != 1:
+        raise ValueError(f"date_to must be the last day of a month, not {date_to}")
+    return {
+        'day_id': tuple( day.year*10000 + day.month*100 + day.day if day is not None else None for day in (date_from, date_to) ),
+        'month_id': tuple( day.year*100 + day.month if day is not None else None for day in (date_from, date_to) )
+    }
+
+
+def fact_conditions(alias:str, date_key:str, manufacturer:str|None, model:str|None, registration:str|None,
+                    key_range:tuple[int|None, int|None]) -> tuple[str, list]:
+    '''SQL conditions (each one starting with AND) that keep the rows of the fact table alias, joined to the aircrafts a, in the
+    slice, and their parameters'''
+    conditions = [('a.manufacturer = ?', manufacturer), ('a.model = ?', model), (f'{alias}.registration = ?', registration),
+                  (f'{alias}.{date_key} >= ?', key_range[0]), (f'{alias}.{date_key} <= ?', key_range[1])]
+    conditions = [ (condition, value) for condition, value in conditions if value is not None ]
+    return ' '.join( f'AND {condition}' for condition, _ in conditions ), [ value for _, value in conditions ]
+
+
+def rollup_source(manufacturer:str|None, model:str|None, registration:str|None, date_from:date|None, date_to:date|None) -> tuple[str, list]|None:
+    '''The rollup rows of the (manufacturer, year) groups in the slice, as a subquery with the columns of kpi_yearly, and its
+    parameters. kpi_yearly answers the filters of whole years of manufacturers, and kpi_model_monthly, rolled up to years, those
+    of models and months. None if no rollup can answer them: they pick an aircraft'''
+    if registration is not None: return None
+    key_range = key_ranges(date_from, date_to)['month_id']
+    if model is None and (date_from is None or date_from.month == 1) and (date_to is None or date_to.month == 12):
+        conditions = [('manufacturer = ?', manufacturer), ('year >= ?', date_from and date_from.year), ('year <= ?', date_to and date_to.year)]
+        conditions = [ (condition, value) for condition, value in conditions if value is not None ]
+        return f"(SELECT * FROM kpi_yearly WHERE TRUE {' '.join( f'AND {condition}' for condition, _ in conditions )})", [ value for _, value in conditions ]
+
+    conditions = [('k.manufacturer = ?', manufacturer), ('k.model = ?', model), ('k.month_id >= ?', key_range[0]), ('k.month_id <= ?', key_range[1])]
+    conditions = [ (condition, value) for condition, value in conditions if value is not None ]
+    return f"""(
+        SELECT k.manufacturer, m.year, SUM(k.daily_rows) AS daily_rows, SUM(k.monthly_rows) AS monthly_rows, SUM(k.reportage_rows) AS reportage_rows,
+            list_unique(flatten(LIST(k.aircrafts)))::BIGINT AS n_aircrafts,
+            SUM(k.fh) AS fh, SUM(k.tos) AS tos, SUM(k.sto) AS sto,
+            SUM(k.ados) AS ados, SUM(k.adoss) AS adoss, SUM(k.adosu) AS adosu, SUM(k.adis) AS adis, SUM(k.dh) AS dh, SUM(k.dy) AS dy, SUM(k.cn) AS cn,
+            SUM(k.reps) AS reps, SUM(k.mareps) AS mareps, SUM(k.pireps) AS pireps
+        FROM kpi_model_monthly k, months m
+        WHERE k.month_id = m.month_id {' '.join( f'AND {condition}' for condition, _ in conditions )}
+        GROUP BY k.manufacturer, m.year
+    )""", [ value for _, value in conditions ]
+
+# endregion
 
 
 class DW:
-    def __init__(self, create=False):
+    def __init__(self, create=False, cache_size=128, cache_dir=None, read_only=False):
         if create and os.path.exists(duckdb_filename):
             os.remove(duckdb_filename)
+        self.read_only = read_only
+        self.local = threading.local()  # Cursor of each thread that queries the DW (see cursor)
+        self.cursors: list[duckdb.DuckDBPyConnection] = []
+        self.readers = 0            # Queries running (see reading)
+        self.reopening = False
+        self.readers_changed = threading.Condition()
         try:
-            self.conn_duckdb = duckdb.connect(duckdb_filename)
+            self.filename = duckdb_filename
+            self.conn_duckdb = duckdb.connect(self.filename, read_only=read_only)
+            self.opened_file = file_identity(self.filename)
             print("Connection to the DW created successfully")
         except duckdb.Error as e:
             print(f"Unable to connect to DuckDB database '{duckdb_filename}':", e)
@@ -24,12 +117,12 @@ class DW:
 
                 self.conn_duckdb.execute('''
                     CREATE TABLE days (
-                        day_id VARCHAR PRIMARY KEY,
+                        day_id INTEGER PRIMARY KEY,         -- yyyymmdd
                         day INTEGER,
-                        month_id VARCHAR
+                        month_id INTEGER
                     );
                     CREATE TABLE months (
-                        month_id VARCHAR PRIMARY KEY,
+                        month_id INTEGER PRIMARY KEY,       -- yyyymm
                         month INTEGER,
                         year INTEGER
                     );
@@ -45,7 +138,7 @@ class DW:
                     );
                     CREATE TABLE daily_usage (
                         registration VARCHAR,
-                        day_id VARCHAR,
+                        day_id INTEGER,
                         fh DECIMAL(10, 2),
                         tos INTEGER,
                         sto INTEGER,
@@ -54,7 +147,7 @@ class DW:
                     );
                     CREATE TABLE monthly_usage (
                         registration VARCHAR,
-                        month_id VARCHAR,
+                        month_id INTEGER,
                         dy INTEGER,
                         cn INTEGER,
                         dh DECIMAL(10, 2),
@@ -67,7 +160,7 @@ class DW:
                     );
                     CREATE TABLE reportage_usage (
                         registration VARCHAR,
-                        month_id VARCHAR,
+                        month_id INTEGER,
                         reporteur_uid VARCHAR,
                         reps INTEGER,
                         mareps INTEGER,
@@ -76,13 +169,29 @@ class DW:
                         FOREIGN KEY(month_id) REFERENCES months(month_id),
                         FOREIGN KEY(reporteur_uid) REFERENCES reporteurs(reporteur_uid)
                     );
+                    CREATE TABLE etl_watermarks (
+                        source VARCHAR PRIMARY KEY,
+                        watermark TIMESTAMP
+                    );
+                    CREATE TABLE etl_data_version (
+                        version VARCHAR
+                    );
+                    CREATE TABLE etl_load_progress (
+                        run_id VARCHAR,
+                        table_name VARCHAR,
+                        batch INTEGER,
+                        inserted INTEGER,
+                        rejected INTEGER,
+                        PRIMARY KEY (run_id, table_name, batch)
+                    );
                     ''')
                 print("Tables created successfully")
             except duckdb.Error as e:
                 print("Error creating the DW tables:", e)
                 sys.exit(2)
 
-        # Link DuckDB and pygrametl
+        # Link DuckDB and pygrametl. The tables get the connection explicitly: by default pygrametl gives them the first
+        # connection that is still open, which is the one of another DW if several are open in the process
         self.conn_pygrametl = pygrametl.ConnectionWrapper(self.conn_duckdb)
 
         # ======================================================================================================= Dimension and fact table objects
@@ -92,42 +201,49 @@ class DW:
             name='days',
             key='day_id',
             attributes=['day', 'month_id'],
+            targetconnection=self.conn_pygrametl
         )
 
         months_dimension = CachedDimension(
             name='months',
             key='month_id',
-            attributes=['month', 'year']
+            attributes=['month', 'year'],
+            targetconnection=self.conn_pygrametl
         )
 
         aircrafts_dimension = CachedDimension(
             name='aircrafts',
             key='registration',
-            attributes=['model', 'manufacturer']
+            attributes=['model', 'manufacturer'],
+            targetconnection=self.conn_pygrametl
         )
 
         reporteurs_dimension = CachedDimension(
             name='reporteurs',
             key='reporteur_uid',
-            attributes=['airport', 'role']
+            attributes=['airport', 'role'],
+            targetconnection=self.conn_pygrametl
         )
 
         daily_usage_fact_table = FactTable(
             name='daily_usage',
             keyrefs=['registration', 'day_id'],
-            measures=['fh', 'tos', 'sto']
+            measures=['fh', 'tos', 'sto'],
+            targetconnection=self.conn_pygrametl
         )
 
         monthly_usage_fact_table = FactTable(
             name='monthly_usage',
             keyrefs=['registration', 'month_id'], 
-            measures=['dy', 'cn', 'dh', 'ados', 'adoss', 'adosu', 'adis']
+            measures=['dy', 'cn', 'dh', 'ados', 'adoss', 'adosu', 'adis'],
+            targetconnection=self.conn_pygrametl
         )
 
         reportage_usage_fact_table = FactTable(
             name='reportage_usage',
             keyrefs=['registration', 'month_id', 'reporteur_uid'],
-            measures=['reps', 'mareps', 'pireps']
+            measures=['reps', 'mareps', 'pireps'],
+            targetconnection=self.conn_pygrametl
         )
 
         # Mapping from table name to table object
@@ -140,9 +256,42 @@ class DW:
             'monthly_usage': monthly_usage_fact_table,
             'reportage_usage': reportage_usage_fact_table
         }
+
+        # Results of the query_* methods, valid while data_version doesn't change (see bump_data_version)
+        self.result_cache = ResultCache(cache_size, cache_dir)
+        self.data_version = self.get_data_version()
     
     def get_table(self, name: str) -> CachedDimension|FactTable:
         return self.tables_dict.get(name)
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        '''Returns the cursor of the calling thread, creating it the first time. A DuckDB connection can't run queries from
+        several threads at once, but its cursors can, one per thread, so the query_* methods can be called from many threads'''
+        cursor = getattr(self.local, 'cursor', None)
+        if cursor is None:
+            cursor = self.local.cursor = self.conn_duckdb.cursor()
+            with self.readers_changed: self.cursors.append(cursor)
+        return cursor
+
+    @contextlib.contextmanager
+    def reading(self):
+        '''Marks a query as running, so reopen waits for it to finish before closing the connection. While a reopen waits,
+        new queries wait for it'''
+        with self.readers_changed:
+            while self.reopening: self.readers_changed.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.readers_changed:
+                self.readers -= 1
+                self.readers_changed.notify_all()
+
+    def close_cursors(self):
+        '''Closes the cursors of all the threads. Called holding readers_changed, with no query running'''
+        for cursor in self.cursors: cursor.close()
+        self.cursors = []
+        self.local = threading.local()
     
     def restart(self):
         self.conn_duckdb.execute('''
@@ -153,14 +302,250 @@ class DW:
                     DELETE FROM reporteurs;
                     DELETE FROM days;
                     DELETE FROM months;
+                    DELETE FROM etl_watermarks;
                                  ''')
+        self.invalidate_rollups()
+        self.bump_data_version()
 
 
+    def is_stale(self) -> bool:
+        '''Tells if another DW was published (see publish_shadow_build) since this one was opened. The connection keeps
+        reading the file it opened, which doesn't change, until reopen is called'''
+        return file_identity(self.filename) != self.opened_file
 
-    # TODO: Rewrite the queries exemplified in "extract.py"
-    def query_utilization(self):
 
-        result = self.conn_duckdb.execute("""
+    def reopen(self):
+        '''Connects again to the DW file, to read the latest published DW. Waits for the running queries to finish, and closes
+        the connection and all its cursors before connecting: while any of them is open, DuckDB gives the new connection the
+        database it already has open, which is the replaced file'''
+        with self.readers_changed:
+            self.reopening = True
+            try:
+                while self.readers: self.readers_changed.wait()
+                self.close_cursors()
+                self.conn_pygrametl.close()
+                self.conn_duckdb = duckdb.connect(self.filename, read_only=self.read_only)
+                self.opened_file = file_identity(self.filename)
+                self.conn_pygrametl = pygrametl.ConnectionWrapper(self.conn_duckdb)
+                for table in self.tables_dict.values(): table.targetconnection = self.conn_pygrametl
+                self.data_version = self.get_data_version()
+            finally:
+                self.reopening = False
+                self.readers_changed.notify_all()
+
+
+    def get_data_version(self) -> str:
+        '''Returns the version of the data in the DW, creating one if the DW doesn't have it yet'''
+        if self.read_only:
+            try:
+                version = self.conn_duckdb.execute('SELECT version FROM etl_data_version').fetchone()
+            except duckdb.CatalogException:
+                version = None
+            return version[0] if version is not None else 'unversioned'
+        self.conn_duckdb.execute('CREATE TABLE IF NOT EXISTS etl_data_version (version VARCHAR)')
+        version = self.conn_duckdb.execute('SELECT version FROM etl_data_version').fetchone()
+        if version is None:
+            self.bump_data_version()
+            return self.data_version
+        return version[0]
+
+
+    def bump_data_version(self):
+        '''Gives the data a new version, so no cached query result computed before this call can be served.
+        It is a random id instead of a counter, so a recreated DW never repeats the version of an older one'''
+        self.data_version = uuid.uuid4().hex
+        self.conn_duckdb.execute('DELETE FROM etl_data_version')
+        self.conn_duckdb.execute('INSERT INTO etl_data_version VALUES (?)', [self.data_version])
+        self.result_cache.clear(keep_version=self.data_version)
+
+
+    def has_integer_date_keys(self) -> bool:
+        '''Tells if day_id and month_id are the integer yyyymmdd and yyyymm keys (older DWs used VARCHAR keys like '2023-4-7')'''
+        types = self.conn_duckdb.execute('''
+            SELECT data_type FROM information_schema.columns
+            WHERE (table_name = 'days' AND column_name = 'day_id') OR (table_name = 'months' AND column_name = 'month_id')''').fetchall()
+        return len(types) == 2 and all( data_type == 'INTEGER' for (data_type,) in types )
+
+
+    def get_watermarks(self) -> dict[str, datetime]:
+        '''Returns, for each source, the value of its watermark column up to which it has been loaded'''
+        try:
+            return dict(self.conn_duckdb.execute('SELECT source, watermark FROM etl_watermarks').fetchall())
+        except duckdb.CatalogException:  # DW created before incremental loads existed
+            return {}
+
+
+    def set_watermarks(self, watermarks:dict[str, datetime]):
+        '''Stores the watermarks of the sources that were just loaded'''
+        self.conn_duckdb.execute('CREATE TABLE IF NOT EXISTS etl_watermarks (source VARCHAR PRIMARY KEY, watermark TIMESTAMP)')
+        for source, watermark in watermarks.items():
+            if watermark is None: continue
+            self.conn_duckdb.execute('''
+                INSERT INTO etl_watermarks VALUES (?, ?)
+                ON CONFLICT (source) DO UPDATE SET watermark = EXCLUDED.watermark''', [source, watermark])
+        self.conn_duckdb.commit()
+
+
+    def get_load_progress(self) -> dict[str, dict[tuple[str, int], tuple[int, int]]]:
+        '''Returns, for each run of a checkpointed load (see load.checkpointed_load), its committed batches
+        as {(table_name, batch): (inserted, rejected)}'''
+        self.conn_duckdb.execute('''
+            CREATE TABLE IF NOT EXISTS etl_load_progress (run_id VARCHAR, table_name VARCHAR, batch INTEGER, inserted INTEGER, rejected INTEGER,
+                                                          PRIMARY KEY (run_id, table_name, batch))''')
+        progress: dict[str, dict[tuple[str, int], tuple[int, int]]] = {}
+        for run_id, table_name, batch, inserted, rejected in self.conn_duckdb.execute('SELECT * FROM etl_load_progress').fetchall():
+            progress.setdefault(run_id, {})[(table_name, batch)] = (inserted, rejected)
+        return progress
+
+
+    def record_load_batch(self, run_id:str, table_name:str, batch:int, inserted:int, rejected:int):
+        '''Marks a batch of a checkpointed load as committed. Must run in the same transaction that inserted the batch'''
+        self.conn_duckdb.execute('INSERT INTO etl_load_progress VALUES (?, ?, ?, ?, ?)', [run_id, table_name, batch, inserted, rejected])
+
+
+
+    # region KPI ROLLUPS
+    # Small tables with the fact tables already aggregated at the (manufacturer, year) and (manufacturer, model, month) levels.
+    # They are rebuilt as the last step of every load, and dropped as soon as the facts change, so they exist only while they are fresh.
+    # Incremental merges only refresh the groups of the facts they replace, in the same transaction
+
+    ROLLUP_TABLES = ['kpi_yearly', 'kpi_model_monthly']
+
+    def refresh_rollups(self, touched:str|None = None):
+        '''(Re)builds the KPI rollups from the fact tables. The daily_rows, monthly_rows and reportage_rows columns count the facts
+        behind each group (NULL if there were none), and n_aircrafts is the fleet size: the aircrafts that flew in that group.
+        kpi_model_monthly also lists those aircrafts, so the fleet of several of its groups can be counted (see rollup_source).
+        touched names a table of (registration, month_id) pairs whose facts changed: only the groups of those pairs are deleted
+        and aggregated again. The rollups are rebuilt in full if it's None or they don't exist'''
+        if touched is not None and not self.rollups_fresh(self.conn_duckdb): touched = None
+        for table, group_by, columns, daily_columns in [
+            ('kpi_yearly',          ['a.manufacturer', 'm.year'],                   ['manufacturer', 'year'],               ''),
+            ('kpi_model_monthly',   ['a.manufacturer', 'a.model', 'm.month_id'],    ['manufacturer', 'model', 'month_id'],  ', LIST(DISTINCT a.registration ORDER BY a.registration) AS aircrafts')
+        ]:
+            if touched is None:
+                target, in_groups = f'CREATE OR REPLACE TABLE {table} AS', ''
+            else:
+                self.conn_duckdb.execute(f'''
+                    CREATE OR REPLACE TEMP TABLE rollup_groups AS
+                    SELECT DISTINCT {", ".join(group_by)} FROM {touched} t, months m, aircrafts a
+                    WHERE t.month_id = m.month_id AND a.registration = t.registration''')
+                self.conn_duckdb.execute(f'''
+                    DELETE FROM {table} WHERE EXISTS (SELECT 1 FROM rollup_groups g WHERE {
+                        " AND ".join(f"g.{column} IS NOT DISTINCT FROM {table}.{column}" for column in columns)})''')
+                target = f'INSERT INTO {table}'
+                in_groups = f'''AND EXISTS (SELECT 1 FROM rollup_groups g WHERE {
+                    " AND ".join(f"g.{column} IS NOT DISTINCT FROM {expression}" for column, expression in zip(columns, group_by))})'''
+            self.conn_duckdb.execute(f'''
+                {target}
+                WITH daily_agg AS (
+                    SELECT {", ".join(group_by)}, COUNT(*) AS daily_rows, COUNT(DISTINCT a.registration) AS n_aircrafts{daily_columns},
+                        SUM(du.fh) AS fh, SUM(du.tos) AS tos, SUM(du.sto) AS sto
+                    FROM daily_usage du, days d, months m, aircrafts a
+                    WHERE du.day_id = d.day_id AND d.month_id = m.month_id AND a.registration = du.registration {in_groups}
+                    GROUP BY {", ".join(group_by)}
+                ),
+                monthly_agg AS (
+                    SELECT {", ".join(group_by)}, COUNT(*) AS monthly_rows,
+                        SUM(mu.ados) AS ados, SUM(mu.adoss) AS adoss, SUM(mu.adosu) AS adosu, SUM(mu.adis) AS adis,
+                        SUM(mu.dh) AS dh, SUM(mu.dy) AS dy, SUM(mu.cn) AS cn
+                    FROM monthly_usage mu, months m, aircrafts a
+                    WHERE mu.month_id = m.month_id AND a.registration = mu.registration {in_groups}
+                    GROUP BY {", ".join(group_by)}
+                ),
+                reportage_agg AS (
+                    SELECT {", ".join(group_by)}, COUNT(*) AS reportage_rows,
+                        SUM(ru.reps) AS reps, SUM(ru.mareps) AS mareps, SUM(ru.pireps) AS pireps
+                    FROM reportage_usage ru, months m, aircrafts a
+                    WHERE ru.month_id = m.month_id AND a.registration = ru.registration {in_groups}
+                    GROUP BY {", ".join(group_by)}
+                )
+                SELECT *
+                FROM daily_agg
+                FULL OUTER JOIN monthly_agg USING ({", ".join(columns)})
+                FULL OUTER JOIN reportage_agg USING ({", ".join(columns)})
+                ORDER BY {", ".join(columns)}
+            ''')
+        self.conn_duckdb.execute('DROP TABLE IF EXISTS rollup_groups')
+
+
+    def invalidate_rollups(self):
+        '''Drops the KPI rollups, so the queries go back to the fact tables until the next refresh_rollups'''
+        for table in self.ROLLUP_TABLES:
+            self.conn_duckdb.execute(f'DROP TABLE IF EXISTS {table}')
+
+
+    def rollups_fresh(self, connection=None) -> bool:
+        '''Tells if the rollups exist, with the columns the queries read (kpi_model_monthly of older DWs has no aircrafts)'''
+        columns = set((connection or self.cursor()).execute(f'''
+            SELECT table_name, column_name FROM information_schema.columns
+            WHERE table_name IN ({", ".join("?" * len(self.ROLLUP_TABLES))})''', self.ROLLUP_TABLES).fetchall())
+        return {table for table, _ in columns} == set(self.ROLLUP_TABLES) and ('kpi_model_monthly', 'aircrafts') in columns
+
+    # endregion
+
+
+
+    # region FACT LAYOUT
+
+    FACT_ORDER = {
+        'daily_usage': ['registration', 'day_id'],
+        'monthly_usage': ['registration', 'month_id'],
+        'reportage_usage': ['registration', 'month_id', 'reporteur_uid']
+    }
+
+    def cluster_facts(self):
+        '''Rewrites the fact tables sorted by FACT_ORDER. DuckDB keeps the min and max of each column in every row group (about 120k
+        rows) and skips the row groups a filter can't match, so in this order the facts of some aircrafts, or of some of their
+        dates, are read without scanning the rest of the history. Run by the full loads before refreshing the rollups, in their
+        transaction. It rewrites the whole history, so the incremental merges only sort the rows they add (see load.upsert_load).
+        Each table is created again from its own definition (with its foreign keys), since deleting its rows and inserting them
+        back would leave the deleted ones in its last row group'''
+        for table_name, order in self.FACT_ORDER.items():
+            definition = self.conn_duckdb.execute('SELECT sql FROM duckdb_tables() WHERE table_name = ?', [table_name]).fetchone()[0]
+            self.conn_duckdb.execute(f'ALTER TABLE {table_name} RENAME TO {table_name}_unsorted')
+            self.conn_duckdb.execute(definition)
+            self.conn_duckdb.execute(f'INSERT INTO {table_name} SELECT * FROM {table_name}_unsorted ORDER BY {", ".join(order)}')
+            self.conn_duckdb.execute(f'DROP TABLE {table_name}_unsorted')
+
+    # endregion
+
+
+
+    # TODO: Rewrite the queries exemplified in "extract.py"
+    @cached_query
+    def query_utilization(self, use_rollups:bool|None = None, manufacturer:str|None = None, model:str|None = None,
+                          registration:str|None = None, date_from:date|None = None, date_to:date|None = None):
+        '''use_rollups=None reads the rollups if they are fresh and can answer the filters (see rollup_source), and the fact tables otherwise'''
+
+        rollup = rollup_source(manufacturer, model, registration, date_from, date_to)
+        if rollup is not None and (use_rollups if use_rollups is not None else self.rollups_fresh()):
+            return self.cursor().execute(f"""
+                SELECT  manufacturer, year,
+                        ROUND(fh/n_aircrafts, 2),
+                        ROUND(tos/n_aircrafts, 2),
+
+                        ROUND(adoss/n_aircrafts, 2),
+                        ROUND(adosu/n_aircrafts, 2),
+                        ROUND(ados/n_aircrafts, 2),
+                        ROUND(adis/n_aircrafts, 2),
+
+                        ROUND(fh/(24*adis), 2)                  AS du,
+                        ROUND(tos/adis, 2)                      AS dc,
+
+                        ROUND(100*dy/(sto), 2)                  AS dyr,
+                        ROUND(100*cn/tos, 2)                    AS cnr,
+                        ROUND(100*(1-(dy+cn)/sto), 2)           AS tdr,
+                        ROUND(100*60*dh/dy, 2)                  AS add
+                FROM {rollup[0]}
+                WHERE daily_rows > 0 AND monthly_rows > 0
+                ORDER BY manufacturer, year;
+                """, rollup[1]).fetchall()
+
+        keys = key_ranges(date_from, date_to)
+        daily, daily_params = fact_conditions('du', 'day_id', manufacturer, model, registration, keys['day_id'])
+        monthly, monthly_params = fact_conditions('mu', 'month_id', manufacturer, model, registration, keys['month_id'])
+
+        result = self.cursor().execute(f"""
                                           
             WITH year_daily_agg AS (
             SELECT
@@ -172,7 +557,7 @@ class DW:
                 COUNT(DISTINCT( a.registration )) AS n_aircrafts
  
             FROM daily_usage du, days d, months m, aircrafts a        
-            WHERE du.day_id = d.day_id AND d.month_id = m.month_id AND a.registration = du.registration
+            WHERE du.day_id = d.day_id AND d.month_id = m.month_id AND a.registration = du.registration {daily}
             GROUP BY a.manufacturer, m.year
             ),
         
@@ -189,7 +574,7 @@ class DW:
                 SUM(mu.cn) AS cn,
                                         
             FROM monthly_usage mu, months m, aircrafts a        
-            WHERE mu.month_id = m.month_id AND a.registration = mu.registration
+            WHERE mu.month_id = m.month_id AND a.registration = mu.registration {monthly}
             GROUP BY a.manufacturer, m.year
             )
 
@@ -215,14 +600,33 @@ class DW:
             ORDER BY yma.manufacturer, yma.year;
                                           
                         
-            """).fetchall()  
+            """, daily_params + monthly_params).fetchall()
         return result
 
 
 
 
-    def query_reporting(self):
-        result = self.conn_duckdb.execute("""
+    @cached_query
+    def query_reporting(self, use_rollups:bool|None = None, manufacturer:str|None = None, model:str|None = None,
+                        registration:str|None = None, date_from:date|None = None, date_to:date|None = None):
+        '''use_rollups=None reads the rollups if they are fresh and can answer the filters (see rollup_source), and the fact tables otherwise'''
+
+        rollup = rollup_source(manufacturer, model, registration, date_from, date_to)
+        if rollup is not None and (use_rollups if use_rollups is not None else self.rollups_fresh()):
+            return self.cursor().execute(f"""
+                SELECT manufacturer, year,
+                        1000*ROUND(reps/fh, 3)              AS rrh,
+                        100*ROUND(reps/tos, 2)              AS rrc
+                FROM {rollup[0]}
+                WHERE daily_rows > 0 AND reportage_rows > 0
+                ORDER BY manufacturer, year;
+                """, rollup[1]).fetchall()
+
+        keys = key_ranges(date_from, date_to)
+        daily, daily_params = fact_conditions('du', 'day_id', manufacturer, model, registration, keys['day_id'])
+        reportage, reportage_params = fact_conditions('ru', 'month_id', manufacturer, model, registration, keys['month_id'])
+
+        result = self.cursor().execute(f"""
             
             WITH year_daily_agg AS (
             SELECT
@@ -231,7 +635,7 @@ class DW:
                 SUM(du.fh) AS fh,
                 SUM(du.tos) AS tos
             FROM daily_usage du, days d, months m, aircrafts a        
-            WHERE du.day_id = d.day_id AND d.month_id = m.month_id AND a.registration = du.registration
+            WHERE du.day_id = d.day_id AND d.month_id = m.month_id AND a.registration = du.registration {daily}
             GROUP BY a.manufacturer, m.year
             ),
         
@@ -241,7 +645,7 @@ class DW:
                 m.year,
                 SUM(ru.reps) as reps                
             FROM reportage_usage ru, months m, aircrafts a        
-            WHERE ru.month_id = m.month_id AND a.registration = ru.registration
+            WHERE ru.month_id = m.month_id AND a.registration = ru.registration {reportage}
             GROUP BY a.manufacturer, m.year
             )
                                     
@@ -253,14 +657,36 @@ class DW:
             WHERE yda.manufacturer = yra.manufacturer AND yda.year = yra.year
             ORDER BY yra.manufacturer, yra.year;
             
-            """).fetchall()
+            """, daily_params + reportage_params).fetchall()
         return result
 
 
 
 
-    def query_reporting_per_role(self):
-        result = self.conn_duckdb.execute("""
+    @cached_query
+    def query_reporting_per_role(self, use_rollups:bool|None = None, manufacturer:str|None = None, model:str|None = None,
+                                 registration:str|None = None, date_from:date|None = None, date_to:date|None = None):
+        '''use_rollups=None reads the rollups if they are fresh and can answer the filters (see rollup_source), and the fact tables otherwise'''
+
+        rollup = rollup_source(manufacturer, model, registration, date_from, date_to)
+        if rollup is not None and (use_rollups if use_rollups is not None else self.rollups_fresh()):
+            return self.cursor().execute(f"""
+                SELECT manufacturer, year, role, rrh, rrc
+                FROM (
+                    SELECT manufacturer, year, 'MAREP' AS role, 1000 * ROUND(mareps / fh, 3) AS rrh, 100 * ROUND(mareps / tos, 2) AS rrc
+                    FROM {rollup[0]} WHERE daily_rows > 0 AND reportage_rows > 0
+                    UNION ALL
+                    SELECT manufacturer, year, 'PIREP' AS role, 1000 * ROUND(pireps / fh, 3) AS rrh, 100 * ROUND(pireps / tos, 2) AS rrc
+                    FROM {rollup[0]} WHERE daily_rows > 0 AND reportage_rows > 0
+                )
+                ORDER BY manufacturer, year, role;
+                """, rollup[1] * 2).fetchall()
+
+        keys = key_ranges(date_from, date_to)
+        daily, daily_params = fact_conditions('du', 'day_id', manufacturer, model, registration, keys['day_id'])
+        reportage, reportage_params = fact_conditions('ru', 'month_id', manufacturer, model, registration, keys['month_id'])
+
+        result = self.cursor().execute(f"""
             
             WITH year_daily_agg AS (
             SELECT
@@ -269,7 +695,7 @@ class DW:
                 SUM(du.fh) AS fh,
                 SUM(du.tos) AS tos
             FROM daily_usage du, days d, months m, aircrafts a        
-            WHERE du.day_id = d.day_id AND d.month_id = m.month_id AND a.registration = du.registration
+            WHERE du.day_id = d.day_id AND d.month_id = m.month_id AND a.registration = du.registration {daily}
             GROUP BY a.manufacturer, m.year
             ),
         
@@ -278,9 +704,9 @@ class DW:
                 a.manufacturer,
                 m.year,
                 SUM(ru.mareps) as mareps,     
-                SUM(ru.mareps) as pireps               
+                SUM(ru.pireps) as pireps               
             FROM reportage_usage ru, months m, aircrafts a        
-            WHERE ru.month_id = m.month_id AND a.registration = ru.registration
+            WHERE ru.month_id = m.month_id AND a.registration = ru.registration {reportage}
             GROUP BY a.manufacturer, m.year
             )
                                     
@@ -310,11 +736,26 @@ class DW:
 
             ORDER BY manufacturer, year, role;
             
-            """).fetchall()
+            """, daily_params + reportage_params).fetchall()
         return result
 
 
+    def validate(self) -> list[str]:
+        '''Checks that the DW is complete enough to be published. Returns the problems found (none if it can be)'''
+        problems = []
+        for table_name in self.tables_dict:
+            try:
+                rows = self.conn_duckdb.execute(f'SELECT COUNT(*) FROM {table_name}').fetchone()[0]
+            except duckdb.CatalogException:
+                problems.append(f"Table {table_name} doesn't exist")
+                continue
+            if rows == 0: problems.append(f"Table {table_name} is empty")
+        if not self.rollups_fresh(): problems.append("The KPI rollups were not refreshed after the last load")
+        return problems
+
+
     def close(self):
+        with self.readers_changed: self.close_cursors()
         self.conn_pygrametl.commit()
         self.conn_pygrametl.close()
     
@@ -323,3 +764,89 @@ class DW:
     
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()  # Esto hace que 'with' funcione
+
+
+
+# region SHADOW BUILDS
+# A shadow build writes the new DW into another file, and only when it is complete and valid it replaces dw.duckdb, with a
+# rename. Readers never see a half-loaded DW: a connection that was already open keeps reading the previous file (the
+# rename doesn't modify it) until it reopens (see DW.is_stale). The replaced DWs are kept as snapshots, to roll back to them
+
+def snapshot_dir(filename:str) -> Path:
+    return Path(f"{filename}.snapshots")
+
+
+def start_shadow_build(copy_current:bool = False, resume:bool = False) -> str:
+    '''Makes the DWs created from now on use the shadow file of the DW instead of the DW itself, until publish_shadow_build.
+    With copy_current, the shadow starts as a copy of the current DW (for incremental loads). With resume, the shadow file
+    left by a failed build is kept. Returns the shadow filename'''
+    global duckdb_filename, published_filename
+    published_filename = duckdb_filename
+    duckdb_filename = f"{published_filename}.shadow"
+    if not resume:
+        for filename in [duckdb_filename, f"{duckdb_filename}.wal"]:
+            if os.path.exists(filename): os.remove(filename)
+        if copy_current and os.path.exists(published_filename): shutil.copy2(published_filename, duckdb_filename)
+    return duckdb_filename
+
+
+def publish_shadow_build(keep_snapshots:int = 3) -> Path|None:
+    '''Validates the shadow DW and, if it is valid, atomically replaces the DW with it. The DW it replaces is kept as the newest
+    snapshot, and only the keep_snapshots newest snapshots are kept. Returns that snapshot (None if there was no DW before).
+    Raises ValueError if the shadow DW is not valid, leaving the DW as it was'''
+    global duckdb_filename, published_filename
+    if published_filename is None: raise ValueError("There is no shadow build to publish")
+
+    shadow = DW()
+    shadow.conn_duckdb.execute('CHECKPOINT')  # Everything in the database file, nothing left in its WAL
+    problems = shadow.validate()
+    shadow.close()
+    if problems: raise ValueError(f"The shadow DW '{duckdb_filename}' was not published: " + "; ".join(problems))
+
+    snapshot = keep_as_snapshot(published_filename)
+    os.replace(duckdb_filename, published_filename)
+    print(f"Published the DW built in '{duckdb_filename}'")
+
+    duckdb_filename, published_filename = published_filename, None
+    prune_snapshots(keep_snapshots)
+    return snapshot
+
+
+def keep_as_snapshot(filename:str) -> Path|None:
+    '''Adds the current file of a DW to its snapshots, before it is replaced. Returns the snapshot (None if there is no DW)'''
+    if not os.path.exists(filename): return None
+    snapshot_dir(filename).mkdir(exist_ok=True)
+    snapshot = snapshot_dir(filename) / f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}.duckdb"
+    os.link(filename, snapshot)  # Another name for the same file, nothing is copied
+    if os.path.exists(f"{filename}.wal"): os.replace(f"{filename}.wal", f"{snapshot}.wal")  # It belongs to the old file
+    return snapshot
+
+
+def list_snapshots(filename:str|None = None) -> list[Path]:
+    '''The snapshots of a DW (by default, this one), oldest first'''
+    return sorted(snapshot_dir(filename or duckdb_filename).glob('*.duckdb'))
+
+
+def prune_snapshots(keep_snapshots:int):
+    '''Deletes all the snapshots but the keep_snapshots newest ones. Readers that opened them can keep reading them'''
+    snapshots = list_snapshots()
+    for snapshot in snapshots[:max(len(snapshots) - keep_snapshots, 0)]:
+        for filename in [snapshot, Path(f"{snapshot}.wal")]: filename.unlink(missing_ok=True)
+
+
+def rollback(snapshot:Path|None = None) -> Path:
+    '''Publishes a snapshot (by default, the newest one) again. It is copied, so later loads into the DW can't modify it,
+    and the DW it replaces becomes a snapshot too. Returns the snapshot that was published'''
+    snapshots = list_snapshots()
+    if snapshot is None:
+        if not snapshots: raise ValueError(f"The DW '{duckdb_filename}' has no snapshots")
+        snapshot = snapshots[-1]
+    temporary = f"{duckdb_filename}.rollback"
+    shutil.copy2(snapshot, temporary)
+    keep_as_snapshot(duckdb_filename)
+    if os.path.exists(f"{snapshot}.wal"): shutil.copy2(f"{snapshot}.wal", f"{duckdb_filename}.wal")
+    os.replace(temporary, duckdb_filename)
+    print(f"Published the snapshot '{snapshot}' again")
+    return snapshot
+
+# endregion
@@ -0,0 +1,37 @@
+import time
+import dw
+import extract
+import load
+import transform
+import transform_elt
+
+
+def build(engine:str, apply_business_rules:bool) -> tuple[dw.DW, float]:
+    '''Builds a DW in memory with the Python transform and bulk load, or with the ELT engine. Returns it and the seconds it took'''
+    warehouse = dw.DW(create=True)
+    sources = extract.extract(fetchsize=50000, backend='copy')
+    start = time.perf_counter()
+    if engine == 'elt':
+        transform_elt.stage(warehouse, sources)
+        transform_elt.transform_staged(warehouse, apply_business_rules)
+        transform_elt.load_transformed(warehouse)
+    else:
+        load.load(warehouse, transform.transform(sources, apply_business_rules, engine=engine), bulk=True)
+    return warehouse, time.perf_counter() - start
+
+
+def table_rows(warehouse:dw.DW, table_name:str) -> list[tuple]:
+    return warehouse.conn_duckdb.execute(f'SELECT * FROM {table_name} ORDER BY ALL').fetchall()
+
+
+if __name__ == '__main__':
+    dw.duckdb_filename = ':memory:'
+    for apply_business_rules in [True, False]:
+        print(f"\n*************************************************** Business rules: {apply_business_rules}")
+        expected, python_time = build('python', apply_business_rules)
+        result, elt_time = build('elt', apply_business_rules)
+        for table_name in expected.tables_dict:
+            assert table_rows(result, table_name) == table_rows(expected, table_name), f"The ELT engine and the Python transform disagree on {table_name}"
+        print(f"python: {python_time:8.4f} seconds, elt: {elt_time:8.4f} seconds, every table is identical")
+        expected.close()
+        result.close()
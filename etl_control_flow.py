@@ -1,16 +1,158 @@
-from dw import DW
+import argparse
+import logging
+import os
+import sys
+from dw import DW, duckdb_filename, start_shadow_build, publish_shadow_build, rollback
 import extract
 import transform
 import load
+import transform_elt
+import checkpoint
+from metrics import RunMetrics, count_sources
+import violations
+
+
+def start_stage_on_first_batch(batches, metrics:RunMetrics, stage:str):
+    '''Starts the given stage when the first batch arrives (in streaming mode transform and load are interleaved)'''
+    for i, batch in enumerate(batches):
+        if i == 0: metrics.start(stage)
+        yield batch
+
+
+def record_sources(metrics:RunMetrics, stage:str, sources:dict):
+    '''Records the rows read from each (counted) source in the stage'''
+    for name, source in sources.items():
+        metrics.add_rows(stage, name, rows_in=source.rows)
+
+
+def record_load(metrics:RunMetrics, report:dict[str, dict], transform_stage:str|None = None):
+    '''Records the rows of each table in the load stage and, if given, as rows that came out of the transform stage'''
+    for table_name, table_report in report.items():
+        metrics.add_rows('load', table_name, rows_in=table_report['rows'], rows_out=table_report['inserted'], rejected=len(table_report['rejected']), seconds=table_report.get('seconds'))
+        if transform_stage is not None: metrics.add_rows(transform_stage, table_name, rows_out=table_report['rows'])
 
 
 if __name__ == '__main__':
-    dw = DW(create=True)
+    parser = argparse.ArgumentParser(description="Builds the DW from the AIMS and AMOS sources")
+    parser.add_argument('--incremental', action='store_true', help="Only extract the rows added since the last load and merge them into the existing DW")
+    parser.add_argument('--streaming', action='store_true', help="Stream the sources through transform and load in batches, with bounded memory")
+    parser.add_argument('--engine', choices=['python', 'numpy', 'parallel', 'elt'], default='python', help="Transform engine (the streaming mode always uses 'python'). 'elt' stages the raw sources in DuckDB and transforms them there with SQL")
+    parser.add_argument('--transform-workers', type=int, default=None, help="Processes of the 'parallel' engine (default: one per CPU)")
+    parser.add_argument('--extract-backend', choices=['sql', 'copy'], default='sql', help="'copy' extracts only the needed columns with COPY, in typed column batches")
+    parser.add_argument('--extract-workers', type=int, default=1, help="Extract the sources concurrently with this many threads (1 extracts them one after another, lazily)")
+    parser.add_argument('--pushdown', action='store_true', help="Let the source database filter the reports and, with --skip-business-rules, aggregate the sources (see extract.extract_pushdown)")
+    parser.add_argument('--skip-business-rules', action='store_true', help="Don't apply the cleaning business rules (BR-21 and BR-23)")
+    parser.add_argument('--batch-size', type=int, default=load.BULK_BATCH_SIZE, help="Rows per fetch and per load batch")
+    parser.add_argument('--stage-dir', default=None, help="First copy the sources into Arrow snapshots in this directory and run on them. Later runs can replay them with ETL_REPLAY_DIR")
+    parser.add_argument('--checkpoint-dir', default=None, help="Save the output of the transform to this directory and commit the load batch by batch, so a failed load can be resumed with --resume")
+    parser.add_argument('--resume', action='store_true', help="Resume the failed load of the checkpoint in --checkpoint-dir, without extracting nor transforming again")
+    parser.add_argument('--shadow-build', action='store_true', help="Build the DW in a shadow file and replace the DW with it only when it is complete and valid, so readers never see a half-loaded DW")
+    parser.add_argument('--keep-snapshots', type=int, default=3, help="DWs replaced by shadow builds that are kept, to roll back to them")
+    parser.add_argument('--rollback', action='store_true', help="Publish the newest snapshot of the DW again, and exit")
+    parser.add_argument('--metrics-json', default='etl_run_report.json', help="File to write the run report (time, rows and memory per stage and table) to")
+    parser.add_argument('--violations-file', default=violations.FILENAME, help="File to write the counts and a sample of the violations of the business rules to (see violations.ViolationLog.write)")
+    parser.add_argument('--metrics-prometheus', default=None, help="Also write the run report in the Prometheus text format to this file")
+    args = parser.parse_args()
+    if args.incremental and (extract.replay_dir is not None or args.stage_dir is not None):
+        parser.error("--incremental queries the PostgreSQL source, it can't run on staging snapshots")
+    if args.pushdown and args.engine == 'elt':
+        parser.error("--engine elt transforms the raw sources, it can't run on the pushed down aggregates")
+    if args.rollback:
+        rollback()
+        sys.exit(0)
+    if args.resume and args.checkpoint_dir is None:
+        parser.error("--resume needs the --checkpoint-dir of the failed load")
+    if args.resume and args.stage_dir is not None:
+        parser.error("--resume doesn't extract, it can't stage the sources")
+    if args.checkpoint_dir is not None and (args.incremental or args.streaming or args.engine == 'elt'):
+        parser.error("--checkpoint-dir saves the transformed tables, which --incremental, --streaming and --engine elt don't build")
+    business_rules = not args.skip_business_rules
+    metrics = RunMetrics()
+    # The summary of the violations goes to the log. Its records go through a queue to a background thread that writes them
+    violations.queue_logging(filename='cleaning.log', level=logging.INFO, format='%(message)s')
+
+    incremental = args.incremental and os.path.exists(duckdb_filename)
+    dw_filename = start_shadow_build(copy_current=incremental, resume=args.resume) if args.shadow_build else duckdb_filename
+    if args.resume and not os.path.exists(dw_filename):
+        parser.error(f"There is no DW to resume the load into in '{dw_filename}'")
+    dw = DW(create=not (incremental or args.resume))
+    since = dw.get_watermarks()
+    if incremental and not (since and dw.has_integer_date_keys()):
+        print("The DW has no watermarks or uses the old VARCHAR date keys, doing a full load")
+        dw.close()
+        incremental, dw = False, DW(create=True)
+
+    if args.stage_dir is not None:
+        metrics.start('stage')
+        for table, rows in extract.stage_sources(args.stage_dir, fetchsize=args.batch_size).items():
+            metrics.add_rows('stage', table, rows_out=rows)
+        extract.replay_dir = args.stage_dir
+
+    # Read the watermarks before extracting: rows added meanwhile are extracted again next time, which the upsert makes harmless.
+    # A resumed load keeps those of the run that saved the checkpoint
+    if not args.resume: until = extract.get_source_watermarks()
 
-    load.load(dw,
-        transform.transform(
-            extract.extract(), apply_business_rules=True
+    if args.resume:
+        manifest, transform_sources = checkpoint.read(args.checkpoint_dir)
+        until = manifest['watermarks']
+        metrics.start('load')
+        record_load(metrics, load.checkpointed_load(dw, transform_sources, manifest['run_id'], manifest['batch_size']))
+    elif incremental:
+        metrics.start('extract + transform')
+        sources = count_sources(extract.extract_incremental(since, until))
+        transform_sources = transform.transform(sources, apply_business_rules=business_rules)
+        record_sources(metrics, 'extract + transform', sources)
+        metrics.start('load')
+        record_load(metrics, load.upsert_load(dw, transform_sources), 'extract + transform')
+    elif args.streaming:
+        metrics.start('extract + transform')
+        if args.pushdown: sources = count_sources(extract.extract_pushdown(business_rules, fetchsize=args.batch_size))
+        else: sources = count_sources(extract.extract(server_side=True, fetchsize=args.batch_size, backend=args.extract_backend))
+        report = load.stream_load(dw,
+            start_stage_on_first_batch(
+                transform.transform_streaming(sources, apply_business_rules=business_rules, batch_size=args.batch_size),
+                metrics, 'load'
+            )
         )
-    )
+        record_sources(metrics, 'extract + transform', sources)
+        record_load(metrics, report, 'extract + transform')
+    else:
+        if args.pushdown:
+            sources = count_sources(extract.extract_pushdown(business_rules, fetchsize=args.batch_size))
+            transform_stage = 'extract + transform'
+        elif args.extract_workers > 1:
+            # The sources are read completely here, so extract and transform are measured apart
+            metrics.start('extract')
+            timings: dict[str, float] = {}
+            sources = count_sources(extract.extract_concurrent(args.extract_workers, fetchsize=args.batch_size, backend=args.extract_backend, timings=timings))
+            for name, source in sources.items():
+                metrics.add_rows('extract', name, rows_out=source.total or 0, seconds=timings.get(name))
+            transform_stage = 'transform'
+        else:
+            sources = count_sources(extract.extract(fetchsize=args.batch_size, backend=args.extract_backend))
+            transform_stage = 'extract + transform'
+        metrics.start(transform_stage)
+        if args.engine == 'elt':
+            transform_elt.stage(dw, sources, batch_size=args.batch_size)
+            transform_elt.transform_staged(dw, apply_business_rules=business_rules)
+            record_sources(metrics, transform_stage, sources)
+            metrics.start('load')
+            record_load(metrics, transform_elt.load_transformed(dw), transform_stage)
+        else:
+            transform_sources = transform.transform(sources, apply_business_rules=business_rules, engine=args.engine, workers=args.transform_workers)
+            record_sources(metrics, transform_stage, sources)
+            if args.checkpoint_dir is not None:
+                run_id = checkpoint.save(args.checkpoint_dir, transform_sources, until, args.batch_size)
+                metrics.start('load')
+                record_load(metrics, load.checkpointed_load(dw, transform_sources, run_id, args.batch_size), transform_stage)
+            else:
+                metrics.start('load')
+                record_load(metrics, load.load(dw, transform_sources, bulk=True, batch_size=args.batch_size), transform_stage)
 
+    dw.set_watermarks(until)
     dw.close()
+    if not args.resume: violations.log.write(args.violations_file)  # A resumed load didn't check the rules
+    metrics.print_report()
+    metrics.write_json(args.metrics_json)
+    if args.metrics_prometheus is not None: metrics.write_prometheus(args.metrics_prometheus)
+    if args.shadow_build: publish_shadow_build(args.keep_snapshots)
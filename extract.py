@@ -1,56 +1,232 @@
 from pathlib import Path
+from datetime import datetime
+from typing import Iterator
+import csv
+import io
+import json
+import tempfile
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
+import psycopg2.pool
 from pygrametl.datasources import CSVSource, SQLSource
 import os
+import reference_data
+
+try:
+    import pyarrow as pa  # Optional: parses the COPY output into typed columns much faster than the csv module
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = pa_csv = None
+
+
+# Directory with CSV dumps of the source tables (named like "AIMS.flights.csv") to read instead of the PostgreSQL source
+source_dir = os.environ.get('ETL_SOURCE_DIR')
+# Staging directory with Arrow snapshots of the source tables (see stage_sources) to replay instead of the PostgreSQL source
+replay_dir = os.environ.get('ETL_REPLAY_DIR')
+
+
+def read_db_parameters() -> dict[str, str]:
+    '''Reads the connection parameters of the PostgreSQL source from db_conf.txt (or the file in ETL_DB_CONF, e.g. a local stand-in),
+    as keyword arguments of psycopg2.connect'''
+    path = Path(os.environ.get('ETL_DB_CONF', "db_conf.txt"))
+    if not path.is_file():
+        raise FileNotFoundError(f"Database configuration file '{path.absolute()}' not found.")
+    try:
+        parameters = {}
+        # Read the database configuration from the provided txt file, line by line
+        with open(path, 'r') as f:
+            lines = f.readlines()
+            for line in lines:
+                parameters[line.split('=', 1)[0]] = line.split('=', 1)[1].strip()
+        return {
+            'dbname': parameters['dbname'],
+            'user': parameters['user'],
+            'password': parameters['password'],
+            'host': parameters['ip'],
+            'port': parameters['port']
+        }
+    except Exception as e:
+        print(e)
+        raise ValueError(f"Database configuration file '{path.absolute()}' not properly formatted (check file 'db_conf.example.txt'.")
+
+
+def connect() -> psycopg2.extensions.connection:
+    '''Connects to the PostgreSQL source described in db_conf.txt (see read_db_parameters)'''
+    parameters = read_db_parameters()
+    try:
+        conn = psycopg2.connect(**parameters)
+        print("Connected!")
+        return conn
+    except psycopg2.Error as e:
+        print(e)
+        raise ValueError(f"Unable to connect to the database: {parameters}")
 
 
 # Connect to the PostgreSQL source
-path = Path("db_conf.txt")
-if not path.is_file():
-    raise FileNotFoundError(f"Database configuration file '{path.absolute()}' not found.")
-try:
-    parameters = {}
-    # Read the database configuration from the provided txt file, line by line
-    with open(path, 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            parameters[line.split('=', 1)[0]] = line.split('=', 1)[1].strip()
-    conn = psycopg2.connect(
-        dbname=parameters['dbname'],
-        user=parameters['user'],
-        password=parameters['password'],
-        host=parameters['ip'],
-        port=parameters['port']
-    )
-    print("Connected!")
+if replay_dir is not None:
+    conn = None
+    print(f"Replaying the sources from the snapshots in '{replay_dir}'")
+elif source_dir is None:
+    conn = connect()
+else:
+    conn = None
+    print(f"Reading the sources from the files in '{source_dir}'")
 
-except psycopg2.Error as e:
-    print(e)
-    raise ValueError(f"Unable to connect to the database: {parameters}")
-except Exception as e:
-    print(e)
-    raise ValueError(f"Database configuration file '{path.absolute()}' not properly formatted (check file 'db_conf.example.txt'.")
 
 
 
 
 
+# ====================================================================================================================================
+# Columnar extraction
+# Only the columns that transform reads, and the column that gives each source its order
+EXTRACT_COLUMNS = {
+    'AIMS.flights':             ['aircraftregistration', 'scheduleddeparture', 'scheduledarrival', 'actualdeparture', 'actualarrival', 'cancelled'],
+    'AIMS.maintenance':         ['aircraftregistration', 'scheduleddeparture', 'scheduledarrival', 'programmed'],
+    'AMOS.postflightreports':   ['aircraftregistration', 'reportingdate', 'reporteurid', 'reporteurclass']
+}
+ORDER_COLUMNS = {
+    'AIMS.flights':             'actualdeparture',
+    'AIMS.maintenance':         'scheduleddeparture'
+}
+
+
+def parse_timestamp(value:str) -> datetime|None:
+    return datetime.fromisoformat(value) if value else None
+
+def parse_boolean(value:str) -> bool|None:
+    return value == 't' if value else None
+
+def parse_text(value:str) -> str|None:
+    return value if value else None
+
+COLUMN_PARSERS = {
+    'scheduleddeparture': parse_timestamp,
+    'scheduledarrival': parse_timestamp,
+    'actualdeparture': parse_timestamp,
+    'actualarrival': parse_timestamp,
+    'reportingdate': parse_timestamp,
+    'cancelled': parse_boolean,
+    'programmed': parse_boolean
+}
+
+
+class ColumnarSource:
+    '''Extracts some columns of a source table with COPY ... TO STDOUT (or, if ETL_SOURCE_DIR is set, from its CSV dump,
+    which must have a header and be sorted like the query) and hands them out in typed column batches.
+    The COPY output is spooled to a temporary file, so the client never holds more than one batch.
+    With pyarrow the CSV is parsed by Arrow and the columns are numpy arrays (datetime64[us], bool, object),
+    without it they are lists of Python values of fetchsize rows.
+    Iterating it yields one dict per row, so it can be used anywhere a SQLSource is'''
+
+    def __init__(self, table:str, columns:list[str], order_by:str|None = None, fetchsize:int = 50000, connection = None):
+        self.table = table
+        self.columns = columns
+        self.order_by = order_by
+        self.fetchsize = fetchsize
+        self.connection = connection if connection is not None else conn
+        self.total: int|None = None  # Number of rows, if known (see extract_source)
+
+    def open(self) -> io.BufferedIOBase:
+        '''Returns the CSV bytes of the source, with a header'''
+        if source_dir is not None:
+            return open(Path(source_dir) / f"{self.table}.csv", 'rb')
+
+        schema, name = self.table.split('.')
+        query = f'SELECT {", ".join(self.columns)} FROM "{schema}"."{name}"'
+        if self.order_by: query += f' ORDER BY {self.order_by}'
+        spool = tempfile.TemporaryFile('w+b')
+        cur = self.connection.cursor()
+        cur.execute("SET DateStyle TO ISO")
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", spool)
+        cur.close()
+        spool.seek(0)
+        return spool
+
+    def batches(self) -> Iterator[dict[str, list]]:
+        '''Yields batches as a dictionary with one sequence of typed values per column'''
+        with self.open() as stream:
+            if pa_csv is not None: yield from self.arrow_batches(stream)
+            else: yield from self.csv_batches(io.TextIOWrapper(stream, encoding='utf-8', newline=''))
+
+    def arrow_batches(self, stream:io.BufferedIOBase) -> Iterator[dict]:
+        for batch in self.record_batches(stream):
+            yield { column: batch.column(column).to_numpy(zero_copy_only=False) for column in self.columns }
+
+    def record_batches(self, stream:io.BufferedIOBase) -> 'pa_csv.CSVStreamingReader':
+        '''Returns a reader that parses the CSV bytes of the source into Arrow record batches (needs pyarrow)'''
+        types = { column: pa.timestamp('us') if COLUMN_PARSERS.get(column) is parse_timestamp else pa.bool_() if COLUMN_PARSERS.get(column) is parse_boolean else pa.string()
+                  for column in self.columns }
+        return pa_csv.open_csv(stream,
+            read_options=pa_csv.ReadOptions(block_size=max(self.fetchsize * 64, 1 << 16)),  # Roughly fetchsize rows per batch
+            convert_options=pa_csv.ConvertOptions(include_columns=self.columns, column_types=types, true_values=['t'], false_values=['f'], strings_can_be_null=True))
+
+    def csv_batches(self, text:io.TextIOBase) -> Iterator[dict]:
+        reader = csv.reader(text)
+        header = next(reader)
+        positions = [ header.index(column) for column in self.columns ]
+        parsers = [ COLUMN_PARSERS.get(column, parse_text) for column in self.columns ]
+        while True:
+            rows = [ row for _, row in zip(range(self.fetchsize), reader) ]
+            if not rows: break
+            yield { column: list(map(parser, [ row[position] for row in rows ])) for column, position, parser in zip(self.columns, positions, parsers) }
+
+    def __iter__(self) -> Iterator[dict]:
+        for batch in self.batches():
+            columns = [ values.tolist() if hasattr(values, 'tolist') else values for values in batch.values() ]
+            for values in zip(*columns):
+                yield dict(zip(self.columns, values))
+
+
+
+SQL_QUERIES = {
+    'AIMS.flights':             'SELECT * FROM "AIMS"."flights" ORDER BY actualdeparture',
+    'AIMS.maintenance':         'SELECT * FROM "AIMS"."maintenance" ORDER BY scheduleddeparture', 
+    'AMOS.postflightreports':   'SELECT aircraftregistration, reportingdate, reporteurid, reporteurclass FROM "AMOS"."postflightreports"'
+}
+
+
+def count_rows(table:str, connection = None) -> int:
+    '''Returns the number of rows of a source table (or of its CSV dump, if ETL_SOURCE_DIR is set)'''
+    if source_dir is not None:
+        with open(Path(source_dir) / f"{table}.csv", 'rb') as file:
+            return sum( chunk.count(b'\n') for chunk in iter(lambda: file.read(1 << 20), b'') ) - 1  # Minus the header
+    schema, name = table.split('.')
+    cur = (connection if connection is not None else conn).cursor()
+    cur.execute(f'SELECT COUNT(*) FROM "{schema}"."{name}"')
+    count = cur.fetchone()[0]
+    cur.close()
+    return count
+
+
+def extract_source(table:str, server_side:bool = False, fetchsize:int = 500, backend:str = 'sql', connection = None) -> SQLSource|ColumnarSource:
+    '''Returns the source of one of the tables of SQL_QUERIES, read through the given connection (the module one by default).
+    Its number of rows is stored in its total attribute, for the progress bars and the run metrics'''
+    if replay_dir is not None:
+        return StagedSource(table, replay_dir, fetchsize)
+    connection = connection if connection is not None else conn
+    if backend == 'copy' or source_dir is not None:
+        source = ColumnarSource(table, EXTRACT_COLUMNS[table], ORDER_COLUMNS.get(table), fetchsize, connection)
+    else:
+        cursor_name = table.replace('.', '_').lower() if server_side else None
+        source = SQLSource(connection=connection, query=SQL_QUERIES[table], cursorarg=cursor_name, fetchsize=fetchsize)
+    source.total = count_rows(table, connection)
+    return source
+
 
-def extract() -> dict[str, SQLSource|CSVSource]:
-    '''Extracts the data from the original AIMS and AMOS databases and returns a dictionary readable for transform function'''
+def extract(server_side:bool = False, fetchsize:int = 500, backend:str = 'sql') -> dict[str, SQLSource|CSVSource|ColumnarSource]:
+    '''Extracts the data from the original AIMS and AMOS databases and returns a dictionary readable for transform function.
+    With server_side, each query uses a named cursor, so only fetchsize rows at a time are held in client memory.
+    backend='copy' (forced when reading from ETL_SOURCE_DIR) uses COPY and only the columns transform reads, see ColumnarSource'''
 
     print("\n\n  --- Starting extraction... ---  \n...")
     
-    extracted_sources: dict[str, SQLSource|CSVSource] = {}
-
-    queries = {
-        'AIMS.flights':             'SELECT * FROM "AIMS"."flights" ORDER BY actualdeparture',
-        'AIMS.maintenance':         'SELECT * FROM "AIMS"."maintenance" ORDER BY scheduleddeparture', 
-        'AMOS.postflightreports':   'SELECT aircraftregistration, reportingdate, reporteurid, reporteurclass FROM "AMOS"."postflightreports"'
-    }
+    extracted_sources: dict[str, SQLSource|CSVSource|ColumnarSource] = {}
 
-    for table, query in queries.items():
-        extracted_sources[table] = SQLSource(connection=conn, query=query)
+    for table in SQL_QUERIES:
+        extracted_sources[table] = extract_source(table, server_side, fetchsize, backend)
 
     extracted_sources["aircraft-manufacturer-info"] = extract_aircrafts_csv()
     extracted_sources["maintenance-personnel"] = extract_personnel_csv()
@@ -60,61 +236,250 @@ def extract() -> dict[str, SQLSource|CSVSource]:
 
 
 
-def extract_aircrafts_csv() -> CSVSource:
-    """
-    Extrae la dimensión aircraft desde el CSV
-    Returns: CSVSource con rows de {registration, model, manufacturer}
-    """
+# ====================================================================================================================================
+# Concurrent extraction
+class BufferedColumnarSource(ColumnarSource):
+    '''ColumnarSource whose batches were already extracted into memory'''
+
+    def __init__(self, source:ColumnarSource):
+        super().__init__(source.table, source.columns, source.order_by, source.fetchsize, source.connection)
+        self.buffered_batches = list(source.batches())
+        self.total = sum( len(next(iter(batch.values()))) for batch in self.buffered_batches )
+
+    def batches(self) -> Iterator[dict[str, list]]:
+        return iter(self.buffered_batches)
+
+
+def extract_concurrent(max_workers:int = 4, fetchsize:int = 50000, backend:str = 'sql', timings:dict[str, float]|None = None) -> dict[str, list|BufferedColumnarSource]:
+    '''Like extract, but reads the three queries and the two CSV files at the same time, with up to max_workers threads.
+    Each query gets its own connection from a pool. Every source is read completely into memory before returning,
+    and the time spent on each one is stored in timings'''
+
+    print(f"\n\n  --- Starting concurrent extraction ({max_workers} workers)... ---  \n...")
+
+    timings = timings if timings is not None else {}
+    start_all = time.perf_counter()
+    pool = psycopg2.pool.ThreadedConnectionPool(1, max_workers, **read_db_parameters()) if source_dir is None and replay_dir is None else None
+
+    def extract_table(table:str) -> list|BufferedColumnarSource:
+        start = time.perf_counter()
+        connection = pool.getconn() if pool is not None else None
+        try:
+            source = extract_source(table, fetchsize=fetchsize, backend=backend, connection=connection)
+            extracted = BufferedColumnarSource(source) if isinstance(source, ColumnarSource) else list(source)
+        finally:
+            if pool is not None: pool.putconn(connection)
+        timings[table] = time.perf_counter() - start
+        return extracted
+
+    def extract_csv(name:str, extract_function) -> list[dict]:
+        start = time.perf_counter()
+        extracted = list(extract_function())
+        timings[name] = time.perf_counter() - start
+        return extracted
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = { table: executor.submit(extract_table, table) for table in SQL_QUERIES }
+            futures["aircraft-manufacturer-info"] = executor.submit(extract_csv, "aircraft-manufacturer-info", extract_aircrafts_csv)
+            futures["maintenance-personnel"] = executor.submit(extract_csv, "maintenance-personnel", extract_personnel_csv)
+            extracted_sources = { name: future.result() for name, future in futures.items() }
+    finally:
+        if pool is not None: pool.closeall()
+
+    for name, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+        print(f"{name:<28} {seconds:8.4f} seconds")
+    print(f"{'Wall clock':<28} {time.perf_counter() - start_all:8.4f} seconds")
 
-    possible_filenames = [
-        'aircraft-manufacturerinfo-lookup.csv',
-        'aircraft-manufaturerinfo-lookup.csv'
-    ]
-    
-    csv_file = None
-    for filename in possible_filenames:
-        if Path(filename).exists():
-            csv_file = filename
-            break
+    print("  --- Extraction finished ---  ")
+    return extracted_sources
 
-    if csv_file is None:
-        raise FileNotFoundError(f"Didn't find aricraft's manufacturer csv file... Searched: {possible_filenames}")
 
 
-    # Crear CSVSource 
-    aircraft_source = CSVSource(
-        open(csv_file, 'r', encoding='utf-8'),
-        delimiter=','
-    )
-    
-    def transform_aircraft_row(row):
-        return {
-            'registration': row['aircraft_reg_code'],
-            'model': row['aircraft_model'],
-            'manufacturer': row['aircraft_manufacturer']
-        }
-    
-    return (transform_aircraft_row(row) for row in aircraft_source)
+# ====================================================================================================================================
+# Staging snapshots
+# stage_sources copies the source tables once into Arrow IPC files, and with ETL_REPLAY_DIR pointing to them the ETL reads
+# those files instead of the PostgreSQL source, so transform and load can be rerun without touching the network
+class StagedSource(ColumnarSource):
+    '''ColumnarSource read from the Arrow IPC snapshot of a table. The file is memory-mapped and its record batches are handed
+    out as they were written: timestamp columns without nulls are views of the mapped pages, not copies'''
+
+    def __init__(self, table:str, directory:str, fetchsize:int = 50000):
+        super().__init__(table, EXTRACT_COLUMNS[table], ORDER_COLUMNS.get(table), fetchsize, connection=None)
+        if pa is None: raise ImportError("Replaying the staging snapshots needs pyarrow")
+        self.path = Path(directory) / f"{table}.arrow"
+        with pa.memory_map(str(self.path)) as mapped:
+            reader = pa.ipc.open_file(mapped)
+            self.total = sum( reader.get_batch(i).num_rows for i in range(reader.num_record_batches) )
+
+    def batches(self) -> Iterator[dict]:
+        with pa.memory_map(str(self.path)) as mapped:
+            reader = pa.ipc.open_file(mapped)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                yield { column: batch.column(column).to_numpy(zero_copy_only=False) for column in self.columns }
+
+
+def stage_sources(directory:str, fetchsize:int = 50000) -> dict[str, int]:
+    '''Writes the columns transform reads of every source table (extracted with COPY, or from ETL_SOURCE_DIR) to an Arrow IPC file
+    in directory, along with the current watermarks of the sources. Returns the number of rows written per table'''
+    if pa is None: raise ImportError("Writing the staging snapshots needs pyarrow")
+    print(f"\n\n  --- Staging the sources in '{directory}'... ---  \n...")
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    written = {}
+    for table in EXTRACT_COLUMNS:
+        source = ColumnarSource(table, EXTRACT_COLUMNS[table], ORDER_COLUMNS.get(table), fetchsize)
+        path = Path(directory) / f"{table}.arrow"
+        temporary = path.with_name(f"{path.name}.tmp")
+        written[table] = 0
+        with source.open() as stream, pa.OSFile(str(temporary), 'wb') as sink:
+            reader = source.record_batches(stream)
+            with pa.ipc.new_file(sink, reader.schema) as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+                    written[table] += batch.num_rows
+        os.replace(temporary, path)  # Atomic, a replay never sees half a file
+        print(f"{table:<28} {written[table]:10} rows")
+
+    with open(Path(directory) / "watermarks.json", 'w') as file:
+        json.dump({ table: watermark.isoformat() if watermark is not None else None for table, watermark in get_source_watermarks().items() }, file, indent=2)
+    print("  --- Staging finished ---  ")
+    return written
+
+
+def read_staged_watermarks(directory:str) -> dict[str, datetime]:
+    try:
+        with open(Path(directory) / "watermarks.json") as file: watermarks = json.load(file)
+    except OSError:
+        return {}
+    return { table: datetime.fromisoformat(watermark) if watermark is not None else None for table, watermark in watermarks.items() }
+
+
+
+# ====================================================================================================================================
+# Incremental extraction
+# Column of each source whose maximum value tells up to where it was already extracted
+WATERMARK_COLUMNS = {
+    'AIMS.flights':             'actualdeparture',
+    'AIMS.maintenance':         'scheduleddeparture',
+    'AMOS.postflightreports':   'reportingdate'
+}
+
+
+def get_source_watermarks() -> dict[str, datetime]:
+    '''Returns the current maximum value of the watermark column of each source (the ones stored with the snapshots when replaying them,
+    none when reading from files)'''
+    watermarks = {}
+    if replay_dir is not None: return read_staged_watermarks(replay_dir)
+    if conn is None: return watermarks
+    cur = conn.cursor()
+    for table, column in WATERMARK_COLUMNS.items():
+        schema, name = table.split('.')
+        cur.execute(f'SELECT MAX({column}) FROM "{schema}"."{name}"')
+        watermarks[table] = cur.fetchone()[0]
+    cur.close()
+    return watermarks
+
+
+def watermark_condition(table:str, since:datetime|None, until:datetime|None, alias:str = '') -> tuple[str, list]:
+    '''Returns the SQL condition (and its parameters) that selects the rows of a source with a watermark in (since, until].
+    Cancelled flights have no actualdeparture, so their scheduleddeparture is used instead'''
+
+    def bounded(column):
+        conditions, parameters = [], []
+        if since is not None:
+            conditions.append(f'{alias}{column} > %s')
+            parameters.append(since)
+        if until is not None:
+            conditions.append(f'{alias}{column} <= %s')
+            parameters.append(until)
+        return ' AND '.join(conditions) or 'TRUE', parameters
+
+    condition, parameters = bounded(WATERMARK_COLUMNS[table])
+    if table == 'AIMS.flights':
+        condition_cancelled, parameters_cancelled = bounded('scheduleddeparture')
+        condition = f'({condition}) OR ({alias}actualdeparture IS NULL AND {condition_cancelled})'
+        parameters += parameters_cancelled
+    return f'({condition})', parameters
+
+
+def get_affected_aircrafts(tables:list[str], date_column:str, since:dict[str, datetime], until:dict[str, datetime]) -> list[tuple[str, datetime]]:
+    '''Returns the aircrafts that have new rows in any of the tables, with the first day of the earliest month they affect'''
+
+    subqueries, parameters = [], []
+    for table in tables:
+        schema, name = table.split('.')
+        condition, condition_parameters = watermark_condition(table, since.get(table), until.get(table))
+        subqueries.append(f'SELECT aircraftregistration, {date_column} AS date FROM "{schema}"."{name}" WHERE {condition}')
+        parameters += condition_parameters
+
+    cur = conn.cursor()
+    cur.execute(f'''
+        SELECT aircraftregistration, DATE_TRUNC('month', MIN(date))
+        FROM ({" UNION ALL ".join(subqueries)}) AS new_rows
+        GROUP BY aircraftregistration''', parameters)
+    result = cur.fetchall()
+    cur.close()
+    return result
+
+
+def extract_incremental(since:dict[str, datetime], until:dict[str, datetime]) -> dict[str, SQLSource|CSVSource|list]:
+    '''Like extract, but only returns the rows needed to recompute the (aircraft, day) and (aircraft, month) aggregates
+    affected by the rows added after the watermarks in since (up to the ones in until).
+    For every aircraft with new rows, all its rows from the first affected month on are extracted, so those aggregates are complete'''
+
+    print("\n\n  --- Starting incremental extraction... ---  \n...")
+
+    extracted_sources: dict[str, SQLSource|CSVSource|list] = {}
+
+    # Flights and maintenances share the BR-21 slots, so both are recomputed for the aircrafts affected by either of them
+    usage_aircrafts = get_affected_aircrafts(['AIMS.flights', 'AIMS.maintenance'], 'scheduleddeparture', since, until)
+    report_aircrafts = get_affected_aircrafts(['AMOS.postflightreports'], 'reportingdate', since, until)
+
+    queries = {
+        'AIMS.flights':             ('SELECT f.* FROM "AIMS"."flights" f', 'f.scheduleddeparture', usage_aircrafts, 'ORDER BY f.actualdeparture'),
+        'AIMS.maintenance':         ('SELECT f.* FROM "AIMS"."maintenance" f', 'f.scheduleddeparture', usage_aircrafts, 'ORDER BY f.scheduleddeparture'),
+        'AMOS.postflightreports':   ('SELECT f.aircraftregistration, f.reportingdate, f.reporteurid, f.reporteurclass FROM "AMOS"."postflightreports" f', 'f.reportingdate', report_aircrafts, '')
+    }
+
+    for table, (select, date_column, aircrafts, order) in queries.items():
+        if not aircrafts:
+            extracted_sources[table] = []
+            continue
+        cur = conn.cursor()
+        affected = ','.join( cur.mogrify('(%s, %s)', aircraft).decode() for aircraft in aircrafts )
+        cur.close()
+        condition, parameters = watermark_condition(table, None, until.get(table), alias='f.')
+        query = f'''{select}
+            JOIN (VALUES {affected}) AS affected(registration, since) ON f.aircraftregistration = affected.registration AND {date_column} >= affected.since
+            WHERE {condition} {order}'''
+        extracted_sources[table] = SQLSource(connection=conn, query=query, parameters=parameters)
+
+    print(f"{len(usage_aircrafts)} aircrafts with new flights or maintenances, {len(report_aircrafts)} with new reports")
+
+    extracted_sources["aircraft-manufacturer-info"] = extract_aircrafts_csv()
+    extracted_sources["maintenance-personnel"] = extract_personnel_csv()
+
+    print("  --- Extraction finished ---  ")
+    return extracted_sources
 
 
 
-def extract_personnel_csv() -> CSVSource:
+def extract_aircrafts_csv() -> list[dict]:
     """
-    Extrae el personal de mantenimiento desde el CSV
-    Returns: CSVSource con rows de {reporteurid, airport}
+    Extrae la dimensión aircraft desde el CSV (parseado una sola vez, ver reference_data)
+    Returns: rows de {registration, model, manufacturer}
     """
-    personnel_source = CSVSource(
-        open('maintenance_personnel.csv', 'r', encoding='utf-8'),
-        delimiter=','
-    )
-    
-    def transform_personnel_row(row):
-        return {
-            'reporteurid': row['reporteurid'],
-            'airport': row['airport']
-        } #type: ignore
-    
-    return (transform_personnel_row(row) for row in personnel_source)
+    return list(reference_data.aircrafts())
+
+
+
+def extract_personnel_csv() -> list[dict]:
+    """
+    Extrae el personal de mantenimiento desde el CSV (parseado una sola vez, ver reference_data)
+    Returns: rows de {reporteurid, airport}
+    """
+    return list(reference_data.personnel())
 
 
 
@@ -122,47 +487,17 @@ def extract_personnel_csv() -> CSVSource:
 # ====================================================================================================================================
 # Baseline queries
 def get_aircrafts_per_manufacturer() -> dict[str, list[str]]:
-
-    possible_filenames = [
-        'aircraft-manufacturerinfo-lookup.csv',
-        'aircraft-manufaturerinfo-lookup.csv'
-    ]
-    
-    csv_file = None
-    for filename in possible_filenames:
-        if Path(filename).exists():
-            csv_file = filename
-            break
-
-    if csv_file is None:
-        raise FileNotFoundError(f"Didn't find aricraft's manufacturer csv file... Searched: {possible_filenames}")
-
-    with open(csv_file) as file:
-        (next(file)) # Ignore header (aircraft_reg_code,manufacturer_serial_number,aircraft_model,aircraft_manufacturer)
-        aircrafts_per_manufacturer: dict[str, list[str]] = {}
-        for line in file:
-            #print(line)
-            linesplit = line.split(",")
-            aircraft_reg_code = linesplit[0]
-            manufacturer = linesplit[3][:-1]
-            if manufacturer not in aircrafts_per_manufacturer.keys():
-                  aircrafts_per_manufacturer[manufacturer] = []
-            aircrafts_per_manufacturer[manufacturer].append(aircraft_reg_code)
-    return(aircrafts_per_manufacturer)
+    return reference_data.aircrafts().group_by('manufacturer', 'registration')
 
 
 
-def query_utilization_baseline():
-    aircrafts = get_aircrafts_per_manufacturer()
-    cur = conn.cursor()
-    cur.execute(f"""
+# The manufacturer of each aircraft is joined from a temporary table instead of pasting every registration in the queries,
+# and the queries are prepared once per connection (see prepare_baseline)
+BASELINE_QUERIES = {
+    'query_utilization_baseline': """
         WITH atomic_data AS (
             SELECT f.aircraftregistration,
-                CASE 
-                    WHEN f.aircraftregistration in ('{"','".join(aircrafts.get("Airbus", []))}') THEN 'Airbus'
-                    WHEN f.aircraftregistration in ('{"','".join(aircrafts.get("Boeing", []))}') THEN 'Boeing'
-                    ELSE f.aircraftregistration
-                    END AS manufacturer, 
+                COALESCE(l.aircraft_manufacturer, f.aircraftregistration) AS manufacturer,
                 DATE_PART('year', f.scheduleddeparture)::text AS year,
                 CASE WHEN f.cancelled 
                     THEN 0
@@ -193,13 +528,10 @@ def query_utilization_baseline():
                 0 AS scheduledOutOfService,
                 0 AS unScheduledOutOfService
             FROM "AIMS".flights f
+                LEFT JOIN manufacturer_lookup l ON l.aircraft_reg_code = f.aircraftregistration
             UNION ALL
             SELECT m.aircraftregistration,           
-                CASE 
-                    WHEN m.aircraftregistration in ('{"','".join(aircrafts.get("Airbus", []))}') THEN 'Airbus'
-                    WHEN m.aircraftregistration in ('{"','".join(aircrafts.get("Boeing", []))}') THEN 'Boeing'
-                    ELSE m.aircraftregistration
-                    END AS manufacturer, 
+                COALESCE(l.aircraft_manufacturer, m.aircraftregistration) AS manufacturer,
                 DATE_PART('year', m.scheduleddeparture)::text AS year,
                 0 AS flightHours,
                 0 AS flightCycles,
@@ -215,6 +547,7 @@ def query_utilization_baseline():
                     ELSE EXTRACT(EPOCH FROM m.scheduledarrival-m.scheduleddeparture)/(24*3600)
                     END AS unScheduledOutOfService
             FROM "AIMS".maintenance m
+                LEFT JOIN manufacturer_lookup l ON l.aircraft_reg_code = m.aircraftregistration
             )
         SELECT a.manufacturer, a.year, 
             ROUND(SUM(a.flightHours)/COUNT(DISTINCT a.aircraftregistration), 2) AS FH,
@@ -233,25 +566,12 @@ def query_utilization_baseline():
         FROM atomic_data a
         GROUP BY a.manufacturer, a.year
         ORDER BY a.manufacturer, a.year;
-        """)
-    result = cur.fetchall()
-    cur.close()
-    return result
-
-
-
-def query_reporting_baseline():
-    aircrafts = get_aircrafts_per_manufacturer()
-    cur = conn.cursor()
-    cur.execute(f"""
+        """,
+    'query_reporting_baseline': """
         WITH 
             atomic_data_utilization AS (
                 SELECT
-                    CASE 
-                        WHEN f.aircraftregistration in ('{"','".join(aircrafts.get("Airbus", []))}') THEN 'Airbus'
-                        WHEN f.aircraftregistration in ('{"','".join(aircrafts.get("Boeing", []))}') THEN 'Boeing'
-                        ELSE f.aircraftregistration
-                        END AS manufacturer, 
+                    COALESCE(l.aircraft_manufacturer, f.aircraftregistration) AS manufacturer,
                     DATE_PART('year', f.scheduleddeparture)::text AS year,
                     CAST(SUM(CASE WHEN f.cancelled 
                         THEN 0
@@ -262,18 +582,16 @@ def query_reporting_baseline():
                         ELSE 1
                         END) AS numeric) AS flightCycles
                 FROM "AIMS".flights f
+                    LEFT JOIN manufacturer_lookup l ON l.aircraft_reg_code = f.aircraftregistration
                 GROUP BY manufacturer, YEAR
                 ),
             atomic_data_reporting AS (
                 SELECT
-                    CASE 
-                        WHEN f.aircraftregistration in ('{"','".join(aircrafts.get("Airbus", []))}') THEN 'Airbus'
-                        WHEN f.aircraftregistration in ('{"','".join(aircrafts.get("Boeing", []))}') THEN 'Boeing'
-                        ELSE f.aircraftregistration
-                        END AS manufacturer, 
+                    COALESCE(l.aircraft_manufacturer, f.aircraftregistration) AS manufacturer,
                     DATE_PART('year', f.reportingdate)::text AS year,
                     COUNT(*) AS counter
                 FROM "AMOS".postflightreports f
+                    LEFT JOIN manufacturer_lookup l ON l.aircraft_reg_code = f.aircraftregistration
                 GROUP BY manufacturer, YEAR
                 )
         SELECT f1.manufacturer, f1.year,
@@ -282,25 +600,12 @@ def query_reporting_baseline():
         FROM atomic_data_reporting f1
             JOIN atomic_data_utilization f2 ON f2.manufacturer = f1.manufacturer AND f1.year = f2.year
         ORDER BY f1.manufacturer, f1.YEAR;
-        """)
-    result = cur.fetchall()
-    cur.close()
-    return result
-
-
-
-def query_reporting_per_role_baseline():
-    aircrafts = get_aircrafts_per_manufacturer()
-    cur = conn.cursor()
-    cur.execute(f"""
+        """,
+    'query_reporting_per_role_baseline': """
         WITH 
             atomic_data_utilization AS (
                 SELECT
-                    CASE 
-                        WHEN f.aircraftregistration in ('{"','".join(aircrafts.get("Airbus", []))}') THEN 'Airbus'
-                        WHEN f.aircraftregistration in ('{"','".join(aircrafts.get("Boeing", []))}') THEN 'Boeing'
-                        ELSE f.aircraftregistration
-                        END AS manufacturer, 
+                    COALESCE(l.aircraft_manufacturer, f.aircraftregistration) AS manufacturer,
                     DATE_PART('year', f.scheduleddeparture)::text AS year,
                     CAST(SUM(CASE WHEN f.cancelled 
                         THEN 0
@@ -311,19 +616,17 @@ def query_reporting_per_role_baseline():
                         ELSE 1
                         END) AS numeric) AS flightCycles
                 FROM "AIMS".flights f
+                    LEFT JOIN manufacturer_lookup l ON l.aircraft_reg_code = f.aircraftregistration
                 GROUP BY manufacturer, YEAR
                 ),
             atomic_data_reporting AS (
                 SELECT
-                    CASE 
-                        WHEN f.aircraftregistration in ('{"','".join(aircrafts.get("Airbus", []))}') THEN 'Airbus'
-                        WHEN f.aircraftregistration in ('{"','".join(aircrafts.get("Boeing", []))}') THEN 'Boeing'
-                        ELSE f.aircraftregistration
-                        END AS manufacturer, 
+                    COALESCE(l.aircraft_manufacturer, f.aircraftregistration) AS manufacturer,
                     DATE_PART('year', f.reportingdate)::text AS year,
                     f.reporteurclass AS role,
                     COUNT(*) AS counter
                 FROM "AMOS".postflightreports f
+                    LEFT JOIN manufacturer_lookup l ON l.aircraft_reg_code = f.aircraftregistration
                 GROUP BY manufacturer, year, role
                 )
         SELECT f1.manufacturer, f1.year, f1.role,
@@ -332,7 +635,174 @@ def query_reporting_per_role_baseline():
         FROM atomic_data_reporting f1
             JOIN atomic_data_utilization f2 ON f2.manufacturer = f1.manufacturer AND f1.year = f2.year
         ORDER BY f1.manufacturer, f1.year, f1.role;
-        """)
+        """,
+}
+
+# Connections whose session already has the manufacturer lookup, and the ones that also have the prepared baseline queries
+lookup_connections: weakref.WeakSet = weakref.WeakSet()
+prepared_connections: weakref.WeakSet = weakref.WeakSet()
+
+
+def load_manufacturer_lookup(connection) -> None:
+    '''Copies the manufacturer of every aircraft into the temporary table manufacturer_lookup, the first time it is needed
+    on the connection (it lasts as long as its session)'''
+    if connection in lookup_connections: return
+    manufacturers = { registration: manufacturer for manufacturer, registrations in get_aircrafts_per_manufacturer().items() for registration in registrations }
+    cur = connection.cursor()
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS manufacturer_lookup (aircraft_reg_code text PRIMARY KEY, aircraft_manufacturer text NOT NULL)')
+    cur.execute('TRUNCATE manufacturer_lookup')
+    cur.copy_expert('COPY manufacturer_lookup (aircraft_reg_code, aircraft_manufacturer) FROM STDIN',
+                    io.StringIO(''.join( f"{registration}\t{manufacturer}\n" for registration, manufacturer in manufacturers.items() )))
+    cur.execute('ANALYZE manufacturer_lookup')
+    cur.close()
+    connection.commit()
+    lookup_connections.add(connection)
+
+
+def prepare_baseline(connection) -> None:
+    '''Loads the manufacturer lookup and prepares the baseline queries, the first time they are run on the connection'''
+    if connection in prepared_connections: return
+    load_manufacturer_lookup(connection)
+    cur = connection.cursor()
+    for name, query in BASELINE_QUERIES.items():
+        cur.execute(f'PREPARE {name} AS {query.strip().rstrip(";")}')
+    cur.close()
+    connection.commit()
+    prepared_connections.add(connection)
+
+
+def run_baseline(name:str) -> list[tuple]:
+    '''Runs one of the prepared BASELINE_QUERIES on the module connection'''
+    prepare_baseline(conn)
+    cur = conn.cursor()
+    cur.execute(f'EXECUTE {name}')
     result = cur.fetchall()
     cur.close()
     return result
+
+
+
+def query_utilization_baseline():
+    return run_baseline('query_utilization_baseline')
+
+
+
+def query_reporting_baseline():
+    return run_baseline('query_reporting_baseline')
+
+
+
+def query_reporting_per_role_baseline():
+    return run_baseline('query_reporting_per_role_baseline')
+
+
+
+
+# ====================================================================================================================================
+# Pushdown extraction
+# Available days of an (aircraft, month) before its maintenances are subtracted, like transform.MonthlyUsage.adis starts
+MONTH_DAYS = 365.25/12
+
+# Reports on aircrafts that are not in the manufacturer CSV are discarded by transform, so they are filtered in the source
+KNOWN_AIRCRAFT = 'r.aircraftregistration IN (SELECT aircraft_reg_code FROM manufacturer_lookup)'
+
+# The sums are ordered like the sources of extract, so the floats are added in the same order as in transform and match exactly
+PUSHDOWN_QUERIES = {
+    'AIMS.flights.daily': '''
+        WITH f AS (
+            SELECT aircraftregistration, scheduleddeparture, actualdeparture,
+                COALESCE(cancelled, false) OR actualarrival IS NULL OR actualdeparture IS NULL AS is_cancelled,
+                EXTRACT(EPOCH FROM actualarrival - actualdeparture)::float8 / 3600 AS flight_hours
+            FROM "AIMS"."flights")
+        SELECT aircraftregistration, to_char(scheduleddeparture, 'YYYYMMDD')::int AS day_id,
+            COALESCE(SUM(flight_hours ORDER BY actualdeparture) FILTER (WHERE NOT is_cancelled), 0) AS fh,
+            COUNT(*) FILTER (WHERE NOT is_cancelled) AS tos,
+            COUNT(*) AS sto
+        FROM f
+        GROUP BY 1, 2''',
+    'AIMS.flights.monthly': '''
+        WITH f AS (
+            SELECT aircraftregistration, scheduleddeparture, actualdeparture,
+                COALESCE(cancelled, false) OR actualarrival IS NULL OR actualdeparture IS NULL AS is_cancelled,
+                EXTRACT(EPOCH FROM actualdeparture - scheduleddeparture)::float8 / 3600 AS delay_hours
+            FROM "AIMS"."flights")
+        SELECT aircraftregistration, to_char(scheduleddeparture, 'YYYYMM')::int AS month_id,
+            COUNT(*) FILTER (WHERE NOT is_cancelled AND delay_hours > 0.25) AS dy,
+            COUNT(*) FILTER (WHERE is_cancelled) AS cn,
+            COALESCE(SUM(delay_hours ORDER BY actualdeparture) FILTER (WHERE NOT is_cancelled AND delay_hours > 0.25), 0) AS dh
+        FROM f
+        GROUP BY 1, 2''',
+    'AIMS.maintenance.monthly': '''
+        WITH m AS (
+            SELECT aircraftregistration, scheduleddeparture, COALESCE(programmed, false) AS programmed,
+                EXTRACT(EPOCH FROM scheduledarrival - scheduleddeparture)::float8 / 86400 AS days
+            FROM "AIMS"."maintenance")
+        SELECT aircraftregistration, to_char(scheduleddeparture, 'YYYYMM')::int AS month_id,
+            SUM(days ORDER BY scheduleddeparture) AS ados,
+            COALESCE(SUM(days ORDER BY scheduleddeparture) FILTER (WHERE programmed), 0) AS adoss,
+            COALESCE(SUM(days ORDER BY scheduleddeparture) FILTER (WHERE NOT programmed), 0) AS adosu,
+            pg_temp.subtract_all(days ORDER BY scheduleddeparture) AS adis
+        FROM m
+        GROUP BY 1, 2''',
+    'AMOS.postflightreports.monthly': f'''
+        SELECT r.aircraftregistration, to_char(r.reportingdate, 'YYYYMM')::int AS month_id, r.reporteurid,
+            COUNT(*) AS reps,
+            COUNT(*) FILTER (WHERE r.reporteurclass = 'MAREP') AS mareps,
+            COUNT(*) FILTER (WHERE r.reporteurclass = 'PIREP') AS pireps
+        FROM "AMOS"."postflightreports" r
+        WHERE {KNOWN_AIRCRAFT}
+        GROUP BY 1, 2, 3''',
+    # The role of a reporteur is the class of its last report, in the order of the table (that of a sequential scan)
+    'reporteur-roles': f'''
+        SELECT DISTINCT ON (r.reporteurid) r.reporteurid, r.reporteurclass
+        FROM "AMOS"."postflightreports" r
+        WHERE {KNOWN_AIRCRAFT}
+        ORDER BY r.reporteurid, r.ctid DESC'''
+}
+
+
+def extract_pushdown(apply_business_rules:bool = True, fetchsize:int = 500) -> dict[str, SQLSource|list]:
+    '''Extraction planner: like extract, but the source database does the reductions that don't change the DW, so only the rows
+    transform keeps come over the wire. Reports are semi-joined with the aircrafts of the manufacturer CSV and, when the business
+    rules are not applied (they need every flight and maintenance), flights, maintenances and reports are also grouped by
+    (aircraft, day) and (aircraft, month) in the source. Aggregated sources are named after the table and the grouping,
+    e.g. 'AIMS.flights.daily', see transform.transform_aggregated. With the business rules, the aircraft and date of the excluded
+    reports are extracted as 'AMOS.postflightreports.excluded', to count them as violations. Sources read from files are extracted as usual'''
+
+    if conn is None:
+        print("The sources are read from files, there is no source database to push the queries down to")
+        return extract(fetchsize=fetchsize, backend='copy')
+
+    print("\n\n  --- Starting pushdown extraction... ---  \n...")
+    load_manufacturer_lookup(conn)
+    extracted_sources: dict[str, SQLSource|list] = {}
+
+    if apply_business_rules:
+        for table in ['AIMS.flights', 'AIMS.maintenance']:
+            extracted_sources[table] = extract_source(table, fetchsize=fetchsize)
+        extracted_sources['AMOS.postflightreports'] = SQLSource(connection=conn, fetchsize=fetchsize, query=f'''
+            SELECT r.aircraftregistration, r.reportingdate, r.reporteurid, r.reporteurclass
+            FROM "AMOS"."postflightreports" r
+            WHERE {KNOWN_AIRCRAFT}
+            ORDER BY r.ctid''')
+        # Only the aircraft and date of the excluded reports come over, to record them as violations of the 'Reportage BR' rule
+        extracted_sources['AMOS.postflightreports.excluded'] = SQLSource(connection=conn, fetchsize=fetchsize, query=f'''
+            SELECT r.aircraftregistration, r.reportingdate
+            FROM "AMOS"."postflightreports" r
+            WHERE NOT COALESCE({KNOWN_AIRCRAFT}, false)
+            ORDER BY r.ctid''')
+    else:
+        # Subtracts the maintenances from the days of the month one by one, as transform does, instead of subtracting their sum
+        cur = conn.cursor()
+        cur.execute('DROP AGGREGATE IF EXISTS pg_temp.subtract_all(float8)')
+        cur.execute(f"CREATE AGGREGATE pg_temp.subtract_all(float8) (SFUNC = float8mi, STYPE = float8, INITCOND = '{MONTH_DAYS!r}')")
+        cur.close()
+        conn.commit()
+        for name, query in PUSHDOWN_QUERIES.items():
+            extracted_sources[name] = SQLSource(connection=conn, query=query, fetchsize=fetchsize)
+
+    extracted_sources["aircraft-manufacturer-info"] = extract_aircrafts_csv()
+    extracted_sources["maintenance-personnel"] = extract_personnel_csv()
+
+    print("  --- Extraction finished ---  ")
+    return extracted_sources
@@ -0,0 +1,35 @@
+import time
+import extract
+from metrics import PeakMemory
+
+
+def consume(source) -> int:
+    '''Traverses a source the way the transform engines do and returns the number of rows'''
+    if hasattr(source, 'batches'):
+        return sum( len(next(iter(batch.values()))) for batch in source.batches() )
+    return sum( 1 for _ in source )
+
+
+if __name__ == '__main__':
+    fetchsize = 50000
+    backends = {
+        'SELECT *, client cursor':  lambda: extract.extract(fetchsize=fetchsize),
+        'SELECT *, named cursor':   lambda: extract.extract(server_side=True, fetchsize=fetchsize),
+        'COPY, needed columns':     lambda: extract.extract(fetchsize=fetchsize, backend='copy')
+    }
+    if extract.replay_dir is not None:
+        backends = { 'Arrow snapshots, memory-mapped': backends['COPY, needed columns'] }
+    elif extract.source_dir is not None:
+        backends = { 'CSV files, needed columns': backends['COPY, needed columns'] }
+
+    for backend, extract_sources in backends.items():
+        print(f"\n*************************************************** {backend}")
+        memory = PeakMemory()
+        for table in extract.EXTRACT_COLUMNS:
+            source = extract_sources()[table]
+            memory.start(table)
+            start = time.perf_counter()
+            rows = consume(source)
+            end = time.perf_counter()
+            memory.stop()
+            print(f"{table:<24} {rows:>10} rows {end - start:10.4f} seconds {memory.stages[table]:10.1f} MB peak RSS")
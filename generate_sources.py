@@ -0,0 +1,261 @@
+import argparse
+import csv
+import math
+import os
+import random
+import string
+from datetime import datetime, timedelta
+from pathlib import Path
+from tqdm import tqdm
+
+
+# Our real dataset at scale factor 1: 283 aircrafts and 775 maintenance people, with these rates per aircraft and day
+FLEET_SIZE = 283
+PERSONNEL_SIZE = 775
+PILOTS_PER_AIRCRAFT = 4
+FLIGHTS_PER_DAY = 0.37
+MAINTENANCES_PER_DAY = 0.8
+REPORTS_PER_FLIGHT = 1.4
+REPORTS_PER_MAINTENANCE = 0.6
+
+# (model, manufacturer, share of the fleet), like aircraft-manufacturerinfo-lookup.csv
+MODELS = [
+    ('737', 'Boeing', 25), ('747', 'Boeing', 17), ('767', 'Boeing', 19), ('777', 'Boeing', 18),
+    ('A319', 'Airbus', 22), ('A320 family', 'Airbus', 34), ('A320neo family', 'Airbus', 28), ('A321', 'Airbus', 26),
+    ('A330', 'Airbus', 21), ('A330neo', 'Airbus', 19), ('A340', 'Airbus', 20), ('A350 XWB', 'Airbus', 34)
+]
+
+# Columns of the source tables. The CSV dumps have a header, and are sorted like the queries of extract.py
+SOURCE_COLUMNS = {
+    'AIMS.flights':             ['id', 'aircraftregistration', 'scheduleddeparture', 'scheduledarrival', 'actualdeparture', 'actualarrival', 'departureairport', 'arrivalairport', 'cancelled', 'delaycode'],
+    'AIMS.maintenance':         ['id', 'aircraftregistration', 'scheduleddeparture', 'scheduledarrival', 'programmed', 'airport'],
+    'AMOS.postflightreports':   ['id', 'aircraftregistration', 'reportingdate', 'reporteurid', 'reporteurclass', 'executionplace']
+}
+
+SOURCE_TABLES = {
+    'AIMS.flights': '''
+        id INTEGER PRIMARY KEY, aircraftregistration CHAR(6), scheduleddeparture TIMESTAMP, scheduledarrival TIMESTAMP,
+        actualdeparture TIMESTAMP, actualarrival TIMESTAMP, departureairport CHAR(3), arrivalairport CHAR(3), cancelled BOOLEAN, delaycode CHAR(2)''',
+    'AIMS.maintenance': '''
+        id INTEGER PRIMARY KEY, aircraftregistration CHAR(6), scheduleddeparture TIMESTAMP, scheduledarrival TIMESTAMP, programmed BOOLEAN, airport CHAR(3)''',
+    'AMOS.postflightreports': '''
+        id INTEGER PRIMARY KEY, aircraftregistration CHAR(6), reportingdate TIMESTAMP, reporteurid INTEGER, reporteurclass VARCHAR(5), executionplace CHAR(3)'''
+}
+
+
+
+# region HELPERS
+
+def registration(i:int) -> str:
+    '''Returns the i-th registration: XA-AAA, XA-AAB, ... (enough for 456976 aircrafts)'''
+    letters = []
+    for _ in range(3):
+        i, letter = divmod(i, 26)
+        letters.append(string.ascii_uppercase[letter])
+    return f"X{string.ascii_uppercase[i % 26]}-{''.join(reversed(letters))}"
+
+
+def poisson(rng:random.Random, rate:float) -> int:
+    '''Number of events of a Poisson process with the given rate (Knuth's method, fine for small rates)'''
+    limit, count, product = math.exp(-rate), 0, rng.random()
+    while product > limit:
+        count += 1
+        product *= rng.random()
+    return count
+
+
+def timestamp(date:datetime|None) -> str:
+    return date.strftime('%Y-%m-%d %H:%M:%S') if date is not None else ''
+
+
+def boolean(value:bool) -> str:
+    return 't' if value else 'f'
+
+# endregion
+
+
+
+class SourceGenerator:
+    '''Generates the AIMS and AMOS sources and both CSVs for a fleet of scale_factor times our real one, over days days from start.
+    Every aircraft follows a timeline of flights and maintenances, with the anomalies the business rules handle injected at the given rates:
+    events that overlap the previous one (BR-21), flights with departure and arrival swapped (BR-23) and reports on unknown aircrafts'''
+
+    def __init__(self, scale_factor:float = 1, days:int = 730, start:datetime = datetime(2023, 1, 1), seed:int = 0,
+                 cancel_rate:float = 0.03, overlap_rate:float = 0.02, swap_rate:float = 0.01, unknown_aircraft_rate:float = 0.01):
+        self.rng = random.Random(seed)
+        self.days = days
+        self.start = start
+        self.cancel_rate, self.overlap_rate, self.swap_rate, self.unknown_aircraft_rate = cancel_rate, overlap_rate, swap_rate, unknown_aircraft_rate
+
+        n_aircrafts = max(1, round(FLEET_SIZE * scale_factor))
+        self.airports = sorted({ ''.join(self.rng.choices(string.ascii_uppercase, k=3)) for _ in range(250) })
+        models = self.rng.choices(MODELS, weights=[share for _, _, share in MODELS], k=n_aircrafts)
+        self.aircrafts = [ (registration(i), f"MSN {self.rng.randint(1000, 9999)}", model, manufacturer) for i, (model, manufacturer, _) in enumerate(models) ]
+        self.unknown_aircrafts = [ registration(n_aircrafts + i) for i in range(max(1, n_aircrafts // 20)) ]
+        self.personnel = [ (reporteurid, self.rng.choice(self.airports)) for reporteurid in self.rng.sample(range(1000, 10000 + PERSONNEL_SIZE * math.ceil(scale_factor) * 10), max(1, round(PERSONNEL_SIZE * scale_factor))) ]
+        # Pilots make the PIREPs and, like in our data, are not in maintenance_personnel.csv
+        self.pilots = list(range(100000, 100000 + n_aircrafts * PILOTS_PER_AIRCRAFT))
+        self.counts = { 'flights': 0, 'cancelled': 0, 'maintenances': 0, 'reports': 0, 'overlaps': 0, 'swapped': 0, 'unknown aircraft reports': 0 }
+
+
+    def write_csvs(self, directory:Path):
+        '''Writes aircraft-manufacturerinfo-lookup.csv and maintenance_personnel.csv'''
+        with open(directory / 'aircraft-manufacturerinfo-lookup.csv', 'w', newline='') as file:
+            writer = csv.writer(file, lineterminator='\n')
+            writer.writerow(['aircraft_reg_code', 'manufacturer_serial_number', 'aircraft_model', 'aircraft_manufacturer'])
+            writer.writerows(self.aircrafts)
+        with open(directory / 'maintenance_personnel.csv', 'w', newline='') as file:
+            writer = csv.writer(file, lineterminator='\n')
+            writer.writerow(['reporteurid', 'airport'])
+            writer.writerows(self.personnel)
+
+
+    def write_sources(self, directory:Path):
+        '''Writes the CSV dumps of the three source tables (named like "AIMS.flights.csv", see extract.source_dir).
+        Days are generated one after another for the whole fleet, and the events of a day are sorted and written once no later
+        day can produce an earlier one, so only a couple of days of events are in memory at a time'''
+
+        files = { table: open(directory / f"{table}.csv", 'w', newline='') for table in SOURCE_COLUMNS }
+        writers = { table: csv.writer(file, lineterminator='\n') for table, file in files.items() }
+        ids = { table: 0 for table in SOURCE_COLUMNS }
+        for table, writer in writers.items(): writer.writerow(SOURCE_COLUMNS[table])
+
+        def write(table:str, rows:list[list]):
+            for row in rows:
+                ids[table] += 1
+                writers[table].writerow([ids[table]] + row)
+
+        busy_until = { aircraft[0]: self.start for aircraft in self.aircrafts }
+        location = { aircraft[0]: self.rng.choice(self.airports) for aircraft in self.aircrafts }
+        flights: dict[int, list] = {}       # Day of the actual departure -> flights
+        maintenances: dict[int, list] = {}  # Day of the scheduled departure -> maintenances
+        cancelled: list[list] = []          # Go last, like NULLs in ORDER BY actualdeparture
+
+        try:
+            for day in tqdm(range(self.days), desc="Days"):
+                for aircraft, *_ in self.aircrafts:
+                    self.generate_day(aircraft, day, busy_until, location, flights, maintenances, cancelled, lambda rows: write('AMOS.postflightreports', rows))
+
+                # Flights can depart some minutes early or, swapped, on the next day, so two days of margin are enough
+                for table, buckets, order in [('AIMS.flights', flights, 3), ('AIMS.maintenance', maintenances, 1)]:
+                    for ready in sorted( bucket for bucket in buckets if bucket < day - 1 ):
+                        write(table, sorted(buckets.pop(ready), key=lambda row: row[order]))
+
+            for table, buckets, order in [('AIMS.flights', flights, 3), ('AIMS.maintenance', maintenances, 1)]:
+                for ready in sorted(buckets):
+                    write(table, sorted(buckets.pop(ready), key=lambda row: row[order]))
+            write('AIMS.flights', cancelled)
+        finally:
+            for file in files.values(): file.close()
+
+
+    def generate_day(self, aircraft:str, day:int, busy_until:dict, location:dict, flights:dict, maintenances:dict, cancelled:list, write_reports):
+        '''Generates the flights, maintenances and reports of an aircraft in a day, one after another from where its timeline is'''
+
+        rng = self.rng
+        day_start = self.start + timedelta(days=day)
+        cursor = max(busy_until[aircraft], day_start + timedelta(hours=rng.randint(5, 9), minutes=rng.randint(0, 59)))
+        events = ['flight'] * poisson(rng, FLIGHTS_PER_DAY) + ['maintenance'] * poisson(rng, MAINTENANCES_PER_DAY)
+        rng.shuffle(events)
+        reports = []
+
+        for event in events:
+            if cursor >= day_start + timedelta(days=1): break
+            if rng.random() < self.overlap_rate:
+                cursor -= timedelta(minutes=rng.randint(10, 90))    # BR-21: starts before the previous event has finished
+                self.counts['overlaps'] += 1
+
+            if event == 'flight':
+                scheduled_departure = cursor.replace(second=0)
+                scheduled_arrival = scheduled_departure + timedelta(minutes=rng.randint(45, 660))
+                destination = rng.choice(self.airports)
+                self.counts['flights'] += 1
+                if rng.random() < self.cancel_rate:
+                    self.counts['cancelled'] += 1
+                    cancelled.append([aircraft, timestamp(scheduled_departure), timestamp(scheduled_arrival), '', '', location[aircraft], destination, 't', ''])
+                    cursor = scheduled_departure + timedelta(minutes=rng.randint(30, 120))
+                    continue
+                delay = timedelta(minutes=max(-5, int(rng.expovariate(1/12)) - 5))
+                actual_departure = scheduled_departure + delay
+                actual_arrival = scheduled_arrival + delay + timedelta(minutes=rng.randint(-10, 15))
+                if rng.random() < self.swap_rate:                   # BR-23: recorded with departure and arrival swapped
+                    actual_departure, actual_arrival = actual_arrival, actual_departure
+                    self.counts['swapped'] += 1
+                delay_code = f"{rng.randint(1, 99):02}" if delay > timedelta(minutes=15) else ''
+                flights.setdefault( (actual_departure - self.start).days, [] ).append(
+                    [aircraft, timestamp(scheduled_departure), timestamp(scheduled_arrival), timestamp(actual_departure), timestamp(actual_arrival), location[aircraft], destination, 'f', delay_code] )
+                arrival = max(actual_departure, actual_arrival)
+                for _ in range(poisson(rng, REPORTS_PER_FLIGHT)):
+                    reports.append( (arrival + timedelta(minutes=rng.randint(5, 600)), rng.choice(self.pilots), 'PIREP', destination) )
+                location[aircraft] = destination
+                cursor = arrival + timedelta(minutes=rng.randint(40, 180))
+
+            else:
+                programmed = rng.random() < 0.6
+                scheduled_departure = cursor.replace(second=0)
+                hours = rng.uniform(1, 8) if programmed else rng.uniform(0.5, 4)
+                if rng.random() < 0.05: hours = rng.uniform(24, 96)     # Checks that ground the aircraft for days
+                scheduled_arrival = scheduled_departure + timedelta(minutes=round(hours * 60))
+                self.counts['maintenances'] += 1
+                maintenances.setdefault( (scheduled_departure - self.start).days, [] ).append(
+                    [aircraft, timestamp(scheduled_departure), timestamp(scheduled_arrival), boolean(programmed), location[aircraft]] )
+                for _ in range(poisson(rng, REPORTS_PER_MAINTENANCE)):
+                    reporteurid, _ = rng.choice(self.personnel)
+                    reports.append( (scheduled_arrival + timedelta(minutes=rng.randint(0, 240)), reporteurid, 'MAREP', location[aircraft]) )
+                cursor = scheduled_arrival + timedelta(minutes=rng.randint(30, 120))
+
+        busy_until[aircraft] = cursor
+        rows = []
+        for reporting_date, reporteurid, reporteur_class, place in reports:
+            registration_reported = aircraft
+            if rng.random() < self.unknown_aircraft_rate:
+                registration_reported = rng.choice(self.unknown_aircrafts)
+                self.counts['unknown aircraft reports'] += 1
+            rows.append([registration_reported, timestamp(reporting_date), reporteurid, reporteur_class, place])
+        self.counts['reports'] += len(rows)
+        write_reports(rows)
+
+
+
+def load_postgres(directory:Path, replace:bool = False):
+    '''Copies the generated CSV dumps into the PostgreSQL source of db_conf.txt (or ETL_DB_CONF), creating the AIMS and AMOS tables'''
+    import extract
+    connection = extract.connect()
+    cur = connection.cursor()
+    for table, columns in SOURCE_TABLES.items():
+        schema, name = table.split('.')
+        cur.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
+        if replace: cur.execute(f'DROP TABLE IF EXISTS "{schema}"."{name}"')
+        cur.execute(f'CREATE TABLE "{schema}"."{name}" ({columns})')
+        with open(directory / f"{table}.csv") as file:
+            cur.copy_expert(f'COPY "{schema}"."{name}" ({", ".join(SOURCE_COLUMNS[table])}) FROM STDIN WITH (FORMAT csv, HEADER true)', file)
+        cur.execute(f'ANALYZE "{schema}"."{name}"')
+        print(f"Loaded {table}")
+    connection.commit()
+    connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates synthetic AIMS and AMOS sources, and their CSVs, at a scale factor of our fleet")
+    parser.add_argument('--scale-factor', type=float, default=1, help="Fleet size (and maintenance personnel) as a multiple of the real one")
+    parser.add_argument('--days', type=int, default=730, help="Days of operations to generate")
+    parser.add_argument('--start', type=datetime.fromisoformat, default=datetime(2023, 1, 1), help="First day (YYYY-MM-DD)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='synthetic', help="Directory for the CSVs and the source dumps. Run the ETL from it with ETL_SOURCE_DIR=. to read them")
+    parser.add_argument('--postgres', action='store_true', help="Also load the sources into the PostgreSQL of db_conf.txt (or ETL_DB_CONF)")
+    parser.add_argument('--replace', action='store_true', help="With --postgres, drop the source tables if they exist")
+    parser.add_argument('--cancel-rate', type=float, default=0.03)
+    parser.add_argument('--overlap-rate', type=float, default=0.02, help="Share of events that overlap the previous one of their aircraft (BR-21)")
+    parser.add_argument('--swap-rate', type=float, default=0.01, help="Share of flights with departure and arrival swapped (BR-23)")
+    parser.add_argument('--unknown-aircraft-rate', type=float, default=0.01, help="Share of reports on aircrafts that are not in the CSV")
+    args = parser.parse_args()
+
+    directory = Path(args.output)
+    os.makedirs(directory, exist_ok=True)
+    generator = SourceGenerator(args.scale_factor, args.days, args.start, args.seed, args.cancel_rate, args.overlap_rate, args.swap_rate, args.unknown_aircraft_rate)
+    generator.write_csvs(directory)
+    generator.write_sources(directory)
+    print(f"{len(generator.aircrafts)} aircrafts, {len(generator.personnel)} maintenance people")
+    for name, count in generator.counts.items(): print(f"{name:<26} {count:>10}")
+
+    if args.postgres: load_postgres(directory, args.replace)
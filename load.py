@@ -1,22 +1,43 @@
+import time
+import duckdb
 from tqdm import tqdm
+from typing import Iterable
+from pygrametl.tables import FactTable
 from dw import DW
 
+try:
+    import pyarrow as pa  # Optional: lets DuckDB scan each batch as a columnar Arrow table
+except ImportError:
+    pa = None
 
 
+BULK_BATCH_SIZE = 50000
+ROW_ERRORS = (duckdb.ConstraintException, duckdb.ConversionException)  # Errors of the rows themselves, the others fail the load
 
-def load(dw:DW, transform_sources:dict[str, list[dict]]):
-    '''Recieves the result of the transform function and loads all the data into the duckdb data warehouse'''
+
+
+
+def load(dw:DW, transform_sources:dict[str, list[dict]], bulk:bool = False, batch_size:int = BULK_BATCH_SIZE) -> dict[str, dict]|None:
+    '''Recieves the result of the transform function and loads all the data into the duckdb data warehouse.
+    As the last step, the KPI rollups are refreshed'''
+
+    dw.invalidate_rollups()
+    dw.bump_data_version()
+    if bulk:
+        report = bulk_load(dw, transform_sources, batch_size)
+        refresh_rollups(dw)
+        return report
 
     print("\n\n  --- Starting load... ---  ")
 
-    for table_name, table_content in transform_sources.items(): 
+    for table_name, table_content in transform_sources.items():
         table_obj = dw.get_table(table_name)
 
-        for row in tqdm(table_content, desc=table_name, total=len(table_content)): 
+        for row in tqdm(table_content, desc=table_name, total=len(table_content)):
 
-            try: 
+            try:
                 table_obj.insert(row)
-            except Exception as exc: 
+            except Exception as exc:
                 print(f"There was a problem adding row {row} into table {table_name}", 1)
                 print(exc)
                 break
@@ -25,5 +46,279 @@ def load(dw:DW, transform_sources:dict[str, list[dict]]):
 
     print("  --- Loading finished ---  ")
     dw.conn_duckdb.commit()
+    refresh_rollups(dw)
+
+
+def refresh_rollups(dw:DW):
+    '''Sorts the fact tables (see DW.cluster_facts) and rebuilds the KPI rollups of the DW after a load, and commits them
+    with a new data version in a single transaction'''
+    print("Sorting the facts and refreshing the KPI rollups")
+    dw.conn_duckdb.begin()
+    try:
+        dw.cluster_facts()
+        dw.refresh_rollups()
+        dw.bump_data_version()
+        dw.conn_duckdb.commit()
+    except Exception:
+        dw.conn_duckdb.rollback()
+        raise
+
+
+
+# region BULK LOAD
+
+def insert_batch(dw:DW, table_name:str, columns:list[str], rows:list[dict]):
+    '''Inserts a list of rows into a table with a single statement, so DuckDB checks the constraints once for the whole batch'''
+
+    if pa is not None:
+        batch = pa.Table.from_pydict({ column: [row.get(column) for row in rows] for column in columns })
+        dw.conn_duckdb.register('load_batch', batch)
+        try:
+            dw.conn_duckdb.execute(f'INSERT INTO {table_name} ({", ".join(columns)}) SELECT {", ".join(columns)} FROM load_batch')
+        finally:
+            dw.conn_duckdb.unregister('load_batch')
+    else:
+        placeholders = ", ".join(["?"] * len(columns))
+        values = ", ".join([f"({placeholders})"] * len(rows))
+        parameters = [row.get(column) for row in rows for column in columns]
+        dw.conn_duckdb.execute(f'INSERT INTO {table_name} ({", ".join(columns)}) VALUES {values}', parameters)
+
+
+def insert_batch_isolating_errors(dw:DW, table_name:str, columns:list[str], rows:list[dict], rejected:list[dict]) -> int:
+    '''Inserts a batch, and if it violates a constraint it splits it in halves until the offending rows are found.
+    Those rows are appended to rejected. Returns the number of rows that were inserted. Other errors are raised'''
+
+    if not rows: return 0
+    try:
+        insert_batch(dw, table_name, columns, rows)
+        return len(rows)
+    except ROW_ERRORS as exc:
+        if len(rows) == 1:
+            rejected.append( {'row': rows[0], 'error': str(exc)} )
+            return 0
+        half = len(rows) // 2
+        return  insert_batch_isolating_errors(dw, table_name, columns, rows[:half], rejected) + \
+                insert_batch_isolating_errors(dw, table_name, columns, rows[half:], rejected)
+
+
+def bulk_load(dw:DW, transform_sources:dict[str, list[dict]], batch_size:int = BULK_BATCH_SIZE) -> dict[str, dict]:
+    '''Same as load, but sends every table to DuckDB in batches of batch_size rows instead of one INSERT per row.
+    Rows that break a constraint are skipped (not the whole table) and returned in a per-table report'''
+
+    print("\n\n  --- Starting bulk load... ---  ")
+
+    report: dict[str, dict] = {}
+
+    for table_name, table_content in transform_sources.items():
+        table_obj = dw.get_table(table_name)
+        columns = table_obj.all
+        rejected: list[dict] = []
+        inserted = 0
+        start = time.perf_counter()
+
+        for batch_start in tqdm(range(0, len(table_content), batch_size), desc=table_name, unit="batch"):
+            inserted += insert_batch_isolating_errors(dw, table_obj.name, columns, table_content[batch_start:batch_start+batch_size], rejected)
+
+        report[table_name] = { 'rows': len(table_content), 'inserted': inserted, 'rejected': rejected, 'seconds': time.perf_counter() - start }
+
+        if rejected:
+            print(f"{len(rejected)}/{len(table_content)} rows from {table_name} were rejected. First one: {rejected[0]['row']}")
+            print(rejected[0]['error'])
+        print(f"{inserted} elements from {table_name} inserted into the database\n")
+
+    print("  --- Loading finished ---  ")
+    dw.conn_duckdb.commit()
+    return report
+
+def stream_load(dw:DW, batches:Iterable[tuple[str, list[dict]]]) -> dict[str, dict]:
+    '''Same as bulk_load, but loads (table_name, batch) pairs as they are produced (see transform.transform_streaming),
+    so only one batch is in memory at a time'''
+
+    print("\n\n  --- Starting streaming load... ---  ")
+
+    report: dict[str, dict] = {}
+    dw.invalidate_rollups()
+    dw.bump_data_version()
+
+    for table_name, batch in batches:
+        start = time.perf_counter()
+        table_obj = dw.get_table(table_name)
+        table_report = report.setdefault(table_name, { 'rows': 0, 'inserted': 0, 'rejected': [], 'seconds': 0.0 })
+        table_report['rows'] += len(batch)
+        table_report['inserted'] += insert_batch_isolating_errors(dw, table_obj.name, table_obj.all, batch, table_report['rejected'])
+        table_report['seconds'] += time.perf_counter() - start
+
+    for table_name, table_report in report.items():
+        if table_report['rejected']:
+            print(f"{len(table_report['rejected'])}/{table_report['rows']} rows from {table_name} were rejected. First one: {table_report['rejected'][0]['row']}")
+        print(f"{table_report['inserted']} elements from {table_name} inserted into the database")
+
+    print("  --- Loading finished ---  ")
+    dw.conn_duckdb.commit()
+    refresh_rollups(dw)
+    return report
+
+# endregion
+
+
+
+# region CHECKPOINTED LOAD
+
+def rows_that_insert(dw:DW, table_name:str, columns:list[str], rows:list[dict], rejected:list[dict]) -> list[dict]:
+    '''Same search as insert_batch_isolating_errors, but every attempt is rolled back. Returns the rows of the batch that can be
+    inserted, and appends the others to rejected. Other errors are raised'''
+
+    if not rows: return []
+    dw.conn_duckdb.begin()
+    try:
+        insert_batch(dw, table_name, columns, rows)
+        error = None
+    except ROW_ERRORS as exc:
+        error = exc
+    finally:
+        dw.conn_duckdb.rollback()
+
+    if error is None: return rows
+    if len(rows) == 1:
+        rejected.append( {'row': rows[0], 'error': str(error)} )
+        return []
+    half = len(rows) // 2
+    return  rows_that_insert(dw, table_name, columns, rows[:half], rejected) + \
+            rows_that_insert(dw, table_name, columns, rows[half:], rejected)
+
+
+def insert_batch_once(dw:DW, run_id:str, table_name:str, batch:int, rows:list[dict], rejected:list[dict]) -> int:
+    '''Inserts a batch of a checkpointed load and marks it as committed in the same transaction, so either both happen or none.
+    Rows that break a constraint are appended to rejected. Returns the number of rows that were inserted. Any other error is
+    raised without marking the batch, so the load fails and a resumed load starts again from this batch'''
+
+    table_obj = dw.get_table(table_name)
+    for attempt in ['whole batch', 'isolating errors']:
+        if attempt == 'isolating errors':
+            rows = rows_that_insert(dw, table_obj.name, table_obj.all, rows, rejected)
+        dw.conn_duckdb.begin()
+        try:
+            if rows: insert_batch(dw, table_obj.name, table_obj.all, rows)
+            dw.record_load_batch(run_id, table_name, batch, len(rows), len(rejected))
+            dw.conn_duckdb.commit()
+            return len(rows)
+        except Exception as exc:
+            dw.conn_duckdb.rollback()
+            if attempt == 'isolating errors' or not isinstance(exc, ROW_ERRORS): raise
+    return 0
+
+
+def checkpointed_load(dw:DW, transform_sources:dict[str, list[dict]], run_id:str, batch_size:int = BULK_BATCH_SIZE) -> dict[str, dict]:
+    '''Same as bulk_load, but every batch is committed together with a record of it in etl_load_progress (see DW.record_load_batch).
+    If the load fails, calling it again with the same run_id and batch_size (see checkpoint.read) skips the batches that were
+    committed and goes on from the first one that wasn't. Batches are never inserted twice, so a resumed load has no duplicate rows.
+    As the last step, the KPI rollups are refreshed'''
+
+    print("\n\n  --- Starting checkpointed load... ---  ")
+
+    progress = dw.get_load_progress()
+    if any( other_run != run_id for other_run in progress ):
+        raise ValueError(f"The DW holds batches of another load, it can't resume the load {run_id}")
+    committed = progress.get(run_id, {})
+    if committed: print(f"Resuming the load {run_id}: {len(committed)} batches were already committed")
+
+    dw.invalidate_rollups()
+    dw.bump_data_version()
+    report: dict[str, dict] = {}
+
+    for table_name, table_content in transform_sources.items():
+        rejected: list[dict] = []
+        inserted, resumed, rejected_before = 0, 0, 0
+        start = time.perf_counter()
 
+        for batch, batch_start in enumerate(tqdm(range(0, len(table_content), batch_size), desc=table_name, unit="batch")):
+            if (table_name, batch) in committed:
+                batch_inserted, batch_rejected = committed[(table_name, batch)]
+                inserted += batch_inserted
+                rejected_before += batch_rejected
+                resumed += 1
+                continue
+            batch_rejected: list[dict] = []
+            inserted += insert_batch_once(dw, run_id, table_name, batch, table_content[batch_start:batch_start+batch_size], batch_rejected)
+            rejected += batch_rejected
+
+        report[table_name] = { 'rows': len(table_content), 'inserted': inserted, 'rejected': rejected, 'resumed_batches': resumed, 'seconds': time.perf_counter() - start }
+
+        if rejected_before:
+            print(f"{rejected_before} rows from {table_name} were rejected before resuming")
+        if rejected:
+            print(f"{len(rejected)}/{len(table_content)} rows from {table_name} were rejected. First one: {rejected[0]['row']}")
+            print(rejected[0]['error'])
+        print(f"{inserted} elements from {table_name} inserted into the database\n")
+
+    print("  --- Loading finished ---  ")
+    refresh_rollups(dw)
+    return report
+
+# endregion
+
+
+
+# region UPSERT LOAD
+
+def upsert_load(dw:DW, transform_sources:dict[str, list[dict]], batch_size:int = BULK_BATCH_SIZE) -> dict[str, dict]:
+    '''Merges the result of an incremental transform into an already loaded DW, in a single transaction.
+    Dimension rows are inserted or, if their key exists, updated with their non-null attributes.
+    Fact rows replace the rows with the same keys, since the incremental transform recomputes every aggregate it emits'''
+
+    print("\n\n  --- Starting upsert load... ---  ")
+
+    report: dict[str, dict] = {}
+    dw.conn_duckdb.begin()
+    try:
+        dw.bump_data_version()
+        # The (registration, month_id) pairs of the replaced facts, whose rollup groups have to be refreshed
+        dw.conn_duckdb.execute('CREATE OR REPLACE TEMP TABLE rollup_touched AS SELECT registration, month_id FROM monthly_usage LIMIT 0')
+        regrouped = False
+        for table_name, table_content in transform_sources.items():
+            start = time.perf_counter()
+            table_obj = dw.get_table(table_name)
+            columns = table_obj.all
+
+            # Stage the rows so the merge is done by DuckDB with set operations
+            dw.conn_duckdb.execute(f'CREATE OR REPLACE TEMP TABLE upsert_staging AS SELECT {", ".join(columns)} FROM {table_obj.name} LIMIT 0')
+            for batch_start in tqdm(range(0, len(table_content), batch_size), desc=table_name, unit="batch"):
+                insert_batch(dw, 'upsert_staging', columns, table_content[batch_start:batch_start+batch_size])
+
+            if isinstance(table_obj, FactTable):
+                keys_match = ' AND '.join( f'{table_obj.name}.{key} = upsert_staging.{key}' for key in table_obj.keyrefs )
+                months = 'upsert_staging s, days d WHERE s.day_id = d.day_id' if 'day_id' in table_obj.keyrefs else 'upsert_staging s'
+                dw.conn_duckdb.execute(f'INSERT INTO rollup_touched SELECT DISTINCT s.registration, month_id FROM {months}')
+                replaced = dw.conn_duckdb.execute(f'DELETE FROM {table_obj.name} WHERE EXISTS (SELECT 1 FROM upsert_staging WHERE {keys_match})').fetchone()[0]
+                dw.conn_duckdb.execute(f'''
+                    INSERT INTO {table_obj.name} ({", ".join(columns)}) SELECT {", ".join(columns)} FROM upsert_staging
+                    ORDER BY {", ".join(dw.FACT_ORDER[table_obj.name])}''')  # Appended in the order of DW.cluster_facts
+            else:
+                if table_obj.name == 'aircrafts':  # A new manufacturer or model moves all the facts of the aircraft to other rollup groups
+                    regrouped = regrouped or dw.conn_duckdb.execute('''
+                        SELECT COUNT(*) FROM upsert_staging s, aircrafts a WHERE s.registration = a.registration
+                        AND (COALESCE(s.manufacturer, a.manufacturer) IS DISTINCT FROM a.manufacturer OR COALESCE(s.model, a.model) IS DISTINCT FROM a.model)
+                    ''').fetchone()[0] > 0
+                updates = ', '.join( f'{attribute} = COALESCE(EXCLUDED.{attribute}, {table_obj.name}.{attribute})' for attribute in table_obj.attributes )
+                dw.conn_duckdb.execute(f'''
+                    INSERT INTO {table_obj.name} ({", ".join(columns)}) SELECT {", ".join(columns)} FROM upsert_staging
+                    ON CONFLICT ({table_obj.key}) DO UPDATE SET {updates}''')
+                replaced = None
+
+            report[table_name] = { 'rows': len(table_content), 'inserted': len(table_content), 'replaced': replaced, 'rejected': [], 'seconds': time.perf_counter() - start }
+            print(f"{len(table_content)} elements from {table_name} merged into the database\n")
+
+        dw.conn_duckdb.execute('DROP TABLE IF EXISTS upsert_staging')
+        print("Refreshing the KPI rollups")
+        dw.refresh_rollups(None if regrouped else 'rollup_touched')
+        dw.conn_duckdb.execute('DROP TABLE rollup_touched')
+        dw.bump_data_version()
+        dw.conn_duckdb.commit()
+    except Exception:
+        dw.conn_duckdb.rollback()
+        raise
+
+    print("  --- Loading finished ---  ")
+    return report
 
+# endregion
@@ -0,0 +1,188 @@
+import json
+import resource
+import sys
+import time
+from datetime import datetime
+
+
+
+# region PEAK MEMORY
+
+def peak_rss_mb() -> float:
+    '''Returns the peak resident set size of the process in MB (since the last reset_peak_rss, where supported)'''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'): return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB on Linux
+
+
+def reset_peak_rss() -> bool:
+    '''Resets the peak RSS of the process to its current RSS. Only Linux allows it, returns whether it was done'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs: clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class PeakMemory:
+    '''Records the peak RSS of each stage of the ETL. Stages are consecutive: starting one finishes the previous one'''
+
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+        self.current: str|None = None
+
+    def start(self, stage:str):
+        self.stop()
+        reset_peak_rss()
+        self.current = stage
+
+    def stop(self):
+        if self.current is not None:
+            self.stages[self.current] = peak_rss_mb()
+            self.current = None
+
+    def print_report(self):
+        self.stop()
+        print("\n  --- Peak RSS per stage ---  ")
+        for stage, peak in self.stages.items():
+            print(f"{stage:<24} {peak:10.1f} MB")
+
+# endregion
+
+
+
+# region RUN METRICS
+
+class CountingSource:
+    '''Wraps a source and counts the rows read from it, whether row by row or in column batches (see extract.ColumnarSource)'''
+
+    def __init__(self, source):
+        self.source = source
+        self.rows = 0
+        if hasattr(source, 'batches'): self.batches = self.counted_batches
+
+    def __iter__(self):
+        for row in self.source:
+            self.rows += 1
+            yield row
+
+    def counted_batches(self):
+        for batch in self.source.batches():
+            self.rows += len(next(iter(batch.values()))) if batch else 0
+            yield batch
+
+    @property
+    def total(self) -> int|None:
+        return len(self.source) if hasattr(self.source, '__len__') else getattr(self.source, 'total', None)
+
+    def __getattr__(self, name:str):
+        if name == 'source': raise AttributeError(name)  # Not set yet (e.g. while copying)
+        return getattr(self.source, name)
+
+
+def count_sources(sources:dict) -> dict[str, CountingSource]:
+    '''Wraps every source so the rows read from it can be reported afterwards'''
+    return { name: CountingSource(source) for name, source in sources.items() }
+
+
+def cpu_seconds() -> float:
+    '''CPU time of the process and of its finished children (the workers of the parallel engine)'''
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class RunMetrics(PeakMemory):
+    '''Per-stage metrics of an ETL run: wall and CPU time and peak RSS of each stage, and the rows that went in and out of it,
+    in total and per table (with the rejected ones and, when known, the seconds spent on the table)'''
+
+    def __init__(self):
+        super().__init__()
+        self.started_at = datetime.now()
+        self.records: dict[str, dict] = {}
+        self.clock: tuple[float, float]|None = None
+
+    def start(self, stage:str):
+        super().start(stage)
+        self.records.setdefault(stage, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'tables': {}})
+        self.clock = (time.perf_counter(), cpu_seconds())
+
+    def stop(self):
+        if self.current is not None and self.clock is not None:
+            record = self.records[self.current]
+            record['wall_seconds'] += time.perf_counter() - self.clock[0]
+            record['cpu_seconds'] += cpu_seconds() - self.clock[1]
+            self.clock = None
+        super().stop()
+
+    def add_rows(self, stage:str, table:str, rows_in:int = 0, rows_out:int = 0, rejected:int = 0, seconds:float|None = None):
+        tables = self.records.setdefault(stage, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'tables': {}})['tables']
+        counts = tables.setdefault(table, {'rows_in': 0, 'rows_out': 0, 'rejected': 0})
+        counts['rows_in'] += rows_in
+        counts['rows_out'] += rows_out
+        counts['rejected'] += rejected
+        if seconds is not None:
+            counts['seconds'] = counts.get('seconds', 0.0) + seconds
+            counts['rows_per_second'] = (counts['rows_in'] or counts['rows_out']) / counts['seconds'] if counts['seconds'] > 0 else None
+
+    def report(self) -> dict:
+        '''Returns the run report, with the totals and throughput of each stage'''
+        self.stop()
+        stages = {}
+        for stage, record in self.records.items():
+            rows_in = sum( counts['rows_in'] for counts in record['tables'].values() )
+            rows_out = sum( counts['rows_out'] for counts in record['tables'].values() )
+            stages[stage] = {
+                'wall_seconds': record['wall_seconds'],
+                'cpu_seconds': record['cpu_seconds'],
+                'peak_rss_mb': self.stages.get(stage),
+                'rows_in': rows_in,
+                'rows_out': rows_out,
+                'rejected': sum( counts['rejected'] for counts in record['tables'].values() ),
+                'rows_per_second': (rows_in or rows_out) / record['wall_seconds'] if record['wall_seconds'] > 0 else None,
+                'tables': record['tables']
+            }
+        return {'started_at': self.started_at.isoformat(timespec='seconds'), 'stages': stages}
+
+    def write_json(self, path:str):
+        with open(path, 'w') as file: json.dump(self.report(), file, indent=2)
+
+    def write_prometheus(self, path:str):
+        '''Writes the report in the Prometheus text exposition format (e.g. for the node exporter textfile collector)'''
+        metrics = [
+            ('etl_stage_wall_seconds', 'gauge', "Wall time of the stage", 'wall_seconds'),
+            ('etl_stage_cpu_seconds', 'gauge', "CPU time of the stage, including its worker processes", 'cpu_seconds'),
+            ('etl_stage_peak_rss_megabytes', 'gauge', "Peak resident set size during the stage", 'peak_rss_mb'),
+            ('etl_stage_rows_per_second', 'gauge', "Rows that went into (or, if none did, came out of) the stage per second of wall time", 'rows_per_second')
+        ]
+        table_metrics = [
+            ('etl_table_rows_in', 'gauge', "Rows of the table that went into the stage", 'rows_in'),
+            ('etl_table_rows_out', 'gauge', "Rows of the table that came out of the stage", 'rows_out'),
+            ('etl_table_rejected_rows', 'gauge', "Rows of the table rejected in the stage", 'rejected')
+        ]
+        stages = self.report()['stages']
+        lines = []
+        for name, kind, description, field in metrics:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            lines += [ f'{name}{{stage="{stage}"}} {values[field]}' for stage, values in stages.items() if values[field] is not None ]
+        for name, kind, description, field in table_metrics:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            lines += [ f'{name}{{stage="{stage}",table="{table}"}} {counts[field]}' for stage, values in stages.items() for table, counts in values['tables'].items() ]
+        with open(path, 'w') as file: file.write('\n'.join(lines) + '\n')
+
+    def print_report(self):
+        stages = self.report()['stages']
+        print("\n  --- Run metrics per stage ---  ")
+        print(f"{'stage':<30} {'wall s':>9} {'cpu s':>9} {'peak MB':>9} {'rows in':>10} {'rows out':>10} {'rejected':>9} {'rows/s':>10}")
+        for stage, values in stages.items():
+            peak = f"{values['peak_rss_mb']:9.1f}" if values['peak_rss_mb'] is not None else f"{'':>9}"
+            rate = f"{values['rows_per_second']:10.0f}" if values['rows_per_second'] is not None else f"{'':>10}"
+            print(f"{stage:<30} {values['wall_seconds']:9.2f} {values['cpu_seconds']:9.2f} {peak} {values['rows_in']:10} {values['rows_out']:10} {values['rejected']:9} {rate}")
+            for table, counts in values['tables'].items():
+                print(f"  {table:<28} {'':>9} {'':>9} {'':>9} {counts['rows_in']:10} {counts['rows_out']:10} {counts['rejected']:9}")
+
+# endregion
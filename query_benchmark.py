@@ -0,0 +1,182 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import date, datetime, timedelta
+from typing import Callable
+from dw import DW
+
+
+DW_QUERIES = ['query_utilization', 'query_reporting', 'query_reporting_per_role']
+BASELINE_QUERIES = ['query_utilization_baseline', 'query_reporting_baseline', 'query_reporting_per_role_baseline']
+
+
+def percentile(times:list[float], p:float) -> float:
+    '''Nearest-rank percentile of a list of times'''
+    ordered = sorted(times)
+    return ordered[max(0, math.ceil(p/100 * len(ordered)) - 1)]
+
+
+def summarize(times:list[float]) -> dict[str, float|int]:
+    return {
+        'runs': len(times),
+        'median': statistics.median(times),
+        'p95': percentile(times, 95),
+        'p99': percentile(times, 99),
+        'min': min(times),
+        'max': max(times)
+    }
+
+
+def time_runs(function:Callable, iterations:int, warmup:int = 0) -> list[float]:
+    '''Calls function warmup times without timing it, and then returns the time of each of the next iterations calls'''
+    for _ in range(warmup): function()
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+@contextlib.contextmanager
+def quiet():
+    '''Hides the prints of the DW and extract connections, which are opened once per cold run'''
+    with contextlib.redirect_stdout(io.StringIO()): yield
+
+
+def benchmark_dw(query:str, iterations:int, warmup:int) -> dict[str, dict]:
+    '''cold: each run opens a new DW connection and runs the query once. hot: runs on an open connection, without the result cache.
+    cached: runs on an open connection through the result cache, after the warm-up filled it'''
+
+    def cold_run() -> float:
+        with quiet(): dw = DW(cache_size=0)
+        start = time.perf_counter()
+        getattr(dw, query)()
+        elapsed = time.perf_counter() - start
+        with quiet(): dw.close()
+        return elapsed
+
+    results = {'cold': summarize([ cold_run() for _ in range(iterations) ])}
+    for mode, cache_size in [('hot', 0), ('cached', 128)]:
+        with quiet(): dw = DW(cache_size=cache_size)
+        results[mode] = summarize(time_runs(getattr(dw, query), iterations, max(1, warmup)))
+        with quiet(): dw.close()
+    return results
+
+
+def kpi_slices(dw:DW) -> dict[str, dict]:
+    '''Filters of the DW queries from the whole DW down to one month of one aircraft, taken from its data'''
+    manufacturer, model, registration = dw.cursor().execute(
+        'SELECT manufacturer, model, registration FROM aircrafts ORDER BY manufacturer, model, registration LIMIT 1').fetchone()
+    last_month = dw.cursor().execute('SELECT MAX(day_id) FROM daily_usage').fetchone()[0] // 100
+    month_start = date(last_month // 100, last_month % 100, 1)
+    return {
+        'all': {},
+        'manufacturer': {'manufacturer': manufacturer},
+        'model': {'model': model},
+        'aircraft': {'registration': registration},
+        'aircraft-month': {'registration': registration, 'date_from': month_start, 'date_to': (month_start + timedelta(days=31)).replace(day=1) - timedelta(days=1)}
+    }
+
+
+def benchmark_slices(query:str, iterations:int, warmup:int) -> dict[str, dict]:
+    '''hot runs of a DW query, without the result cache, on each of the kpi_slices'''
+    with quiet(): dw = DW(cache_size=0)
+    results = { name: summarize(time_runs(lambda: getattr(dw, query)(**filters), iterations, max(1, warmup)))
+                for name, filters in kpi_slices(dw).items() }
+    with quiet(): dw.close()
+    return results
+
+
+def benchmark_baseline(extract, query:str, iterations:int, warmup:int) -> dict[str, dict]:
+    '''cold: each run opens a new connection to the PostgreSQL source. hot: runs on the same connection after the warm-up'''
+
+    def cold_run() -> float:
+        with quiet(): extract.conn = extract.connect()
+        start = time.perf_counter()
+        getattr(extract, query)()
+        elapsed = time.perf_counter() - start
+        extract.conn.close()
+        return elapsed
+
+    connection = extract.conn
+    try:
+        results = {'cold': summarize([ cold_run() for _ in range(iterations) ])}
+    finally:
+        extract.conn = connection
+    results['hot'] = summarize(time_runs(getattr(extract, query), iterations, warmup))
+    return results
+
+
+def compare(results:dict, baseline:dict, threshold:float, min_difference:float = 0.0) -> list[str]:
+    '''Returns a message for every query and mode whose median is more than threshold times the one of the baseline file and
+    also more than min_difference seconds slower, so the noise of sub-millisecond medians (e.g. the cached runs) isn't flagged'''
+    regressions = []
+    for query, modes in results.items():
+        for mode, summary in modes.items():
+            previous = baseline.get('results', {}).get(query, {}).get(mode)
+            if previous is None: continue
+            ratio = summary['median'] / previous['median'] if previous['median'] > 0 else math.inf
+            if ratio > threshold and summary['median'] - previous['median'] > min_difference:
+                regressions.append(f"{query} ({mode}): median {summary['median']*1000:.3f} ms vs {previous['median']*1000:.3f} ms in the baseline, x{ratio:.2f}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the KPI queries of the DW and their baseline versions over the sources")
+    parser.add_argument('--iterations', type=int, default=30, help="Timed runs of each query and mode")
+    parser.add_argument('--warmup', type=int, default=3, help="Untimed runs before the hot runs")
+    parser.add_argument('--skip-baseline', action='store_true', help="Only benchmark the DW queries")
+    parser.add_argument('--slices', action='store_true', help="Also benchmark the DW queries filtered to smaller and smaller slices of the DW")
+    parser.add_argument('--db-conf', default=None, help="Connection file of the PostgreSQL source of the baseline queries (e.g. a local stand-in), instead of db_conf.txt")
+    parser.add_argument('--output', default='query_benchmark.json', help="JSON file to write the results to")
+    parser.add_argument('--compare', default=None, help="JSON file of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=1.2, help="Flag a regression when a median is more than this times the one in --compare")
+    parser.add_argument('--min-difference', type=float, default=0.5, help="Only flag a regression when the median is also more than these milliseconds slower than the one in --compare")
+    args = parser.parse_args()
+
+    results: dict[str, dict] = {}
+    for query in DW_QUERIES:
+        print(f"Benchmarking DW.{query}...")
+        results[f"DW.{query}"] = benchmark_dw(query, args.iterations, args.warmup)
+        if args.slices: results[f"DW.{query} slices"] = benchmark_slices(query, args.iterations, args.warmup)
+
+    if not args.skip_baseline:
+        if args.db_conf is not None: os.environ['ETL_DB_CONF'] = args.db_conf
+        import extract
+        if extract.conn is None:
+            print("The sources are read from files (ETL_SOURCE_DIR), there is no PostgreSQL source to run the baseline queries on")
+        else:
+            for query in BASELINE_QUERIES:
+                print(f"Benchmarking extract.{query}...")
+                results[f"extract.{query}"] = benchmark_baseline(extract, query, args.iterations, args.warmup)
+
+    print(f"\n{'query':<44} {'mode':<14} {'median ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for query, modes in results.items():
+        for mode, summary in modes.items():
+            print(f"{query:<44} {mode:<14} {summary['median']*1000:10.3f} {summary['p95']*1000:10.3f} {summary['p99']*1000:10.3f}")
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'iterations': args.iterations,
+        'warmup': args.warmup,
+        'results': results
+    }
+    with open(args.output, 'w') as file: json.dump(report, file, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as file: regressions = compare(results, json.load(file), args.threshold, args.min_difference / 1000)
+        if regressions:
+            print(f"\n{len(regressions)} regressions against {args.compare}:")
+            for regression in regressions: print("  " + regression)
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
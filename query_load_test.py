@@ -0,0 +1,100 @@
+import argparse
+import asyncio
+import json
+import platform
+import threading
+import time
+from datetime import datetime
+from query_benchmark import percentile, quiet
+from query_service import KPI_QUERIES, KPIService
+
+
+def summarize_load(latencies:list[float], seconds:float, errors:int) -> dict[str, float|int]:
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / seconds if seconds > 0 else 0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies)
+    }
+
+
+def run_threads(service:KPIService, clients:int, requests:int) -> dict[str, float|int]:
+    '''Each client is a thread that sends requests queries one after the other, cycling through the KPI queries'''
+    latencies: list[list[float]] = [ [] for _ in range(clients) ]
+    errors = [0] * clients
+    start_together = threading.Barrier(clients)
+
+    def client(i:int):
+        start_together.wait()
+        for request in range(requests):
+            start = time.perf_counter()
+            try:
+                service.query(KPI_QUERIES[(i + request) % len(KPI_QUERIES)])
+            except Exception:
+                errors[i] += 1
+            latencies[i].append(time.perf_counter() - start)
+
+    threads = [ threading.Thread(target=client, args=(i,)) for i in range(clients) ]
+    start = time.perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return summarize_load([ latency for client_latencies in latencies for latency in client_latencies ], time.perf_counter() - start, sum(errors))
+
+
+def run_async(service:KPIService, clients:int, requests:int) -> dict[str, float|int]:
+    '''Same as run_threads, but the clients are coroutines of one event loop that use query_async'''
+    latencies: list[float] = []
+    errors = 0
+
+    async def client(i:int):
+        nonlocal errors
+        for request in range(requests):
+            start = time.perf_counter()
+            try:
+                await service.query_async(KPI_QUERIES[(i + request) % len(KPI_QUERIES)])
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    async def all_clients():
+        await asyncio.gather(*( client(i) for i in range(clients) ))
+
+    start = time.perf_counter()
+    asyncio.run(all_clients())
+    return summarize_load(latencies, time.perf_counter() - start, errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test of the KPI query service: throughput and tail latency at N concurrent clients")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16, 64], help="Numbers of concurrent clients to test")
+    parser.add_argument('--requests', type=int, default=50, help="Queries sent by each client")
+    parser.add_argument('--workers', type=int, default=8, help="Worker threads of the service (for the async clients)")
+    parser.add_argument('--mode', choices=['threads', 'async'], default='threads', help="Clients as threads calling query, or as coroutines awaiting query_async")
+    parser.add_argument('--no-cache', action='store_true', help="Run every query on the DW, without the result cache")
+    parser.add_argument('--output', default='query_load_test.json', help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    results: dict[str, dict] = {}
+    with quiet(): service = KPIService(workers=args.workers, cache_size=0 if args.no_cache else 128)
+    with service:
+        for query in KPI_QUERIES: service.query(query)  # Warm-up
+        print(f"\n{'clients':>8} {'requests':>9} {'errors':>7} {'req/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+        for clients in args.clients:
+            summary = (run_async if args.mode == 'async' else run_threads)(service, clients, args.requests)
+            results[str(clients)] = summary
+            print(f"{clients:>8} {summary['requests']:>9} {summary['errors']:>7} {summary['throughput']:>10.1f} {summary['p50']*1000:>10.3f} "
+                  f"{summary['p95']*1000:>10.3f} {summary['p99']*1000:>10.3f} {summary['max']*1000:>10.3f}")
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'mode': args.mode,
+        'cache': not args.no_cache,
+        'requests_per_client': args.requests,
+        'results': results
+    }
+    with open(args.output, 'w') as file: json.dump(report, file, indent=2)
+    print(f"\nResults written to {args.output}")
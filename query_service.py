@@ -0,0 +1,57 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dw import DW
+
+
+
+# region KPI QUERY SERVICE
+
+KPI_QUERIES = ['query_utilization', 'query_reporting', 'query_reporting_per_role']
+
+
+class KPIService:
+    '''Serves the KPI queries of the DW to many concurrent readers. The DW is opened read-only, so any number of processes can
+    serve it at the same time (as long as no process has it open for writing, see dw.start_shadow_build), and each thread
+    queries it through its own cursor (see DW.cursor), sharing one result cache.
+    When a new DW is published, the service switches to it within reopen_interval seconds: the queries that are running
+    finish on the previous one, and the new ones wait for the switch (see DW.reopen)'''
+
+    def __init__(self, workers:int = 8, cache_size:int = 128, cache_dir:str|None = None, reopen_interval:float = 5.0):
+        self.dw = DW(read_only=True, cache_size=cache_size, cache_dir=cache_dir)
+        self.reopen_interval = reopen_interval
+        self.checked_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kpi-query')  # Of query_async
+
+    def current(self) -> DW:
+        '''Returns the DW to query, opening the latest published one if it changed'''
+        if time.monotonic() - self.checked_at < self.reopen_interval: return self.dw
+        with self.lock:
+            if time.monotonic() - self.checked_at >= self.reopen_interval:
+                if self.dw.is_stale(): self.dw.reopen()  # The result cache is kept, entries of the old data version are never served again
+                self.checked_at = time.monotonic()
+        return self.dw
+
+    def query(self, name:str, **kwargs) -> list[tuple]:
+        '''Runs one of the KPI_QUERIES (with the arguments of its DW method) and returns its rows. Can be called from any thread'''
+        if name not in KPI_QUERIES: raise ValueError(f"Unknown KPI query '{name}', expected one of {KPI_QUERIES}")
+        return getattr(self.current(), name)(**kwargs)
+
+    async def query_async(self, name:str, **kwargs) -> list[tuple]:
+        '''Same as query, but runs in the worker threads of the service, so the event loop isn't blocked'''
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(self.query, name, **kwargs))
+
+    def close(self):
+        self.executor.shutdown()
+        self.dw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+# endregion
@@ -0,0 +1,127 @@
+import csv
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+
+
+# region REFERENCE DATA
+# The aircraft and personnel CSVs are parsed once per process, and a JSON snapshot of the parsed rows is kept in
+# ETL_REFERENCE_CACHE (.reference_cache by default), so later runs skip the parsing until the file changes.
+# Snapshots are plain data: a tampered one can give wrong rows, but can't run code like a pickle would
+
+AIRCRAFT_FILENAMES = ['aircraft-manufacturerinfo-lookup.csv', 'aircraft-manufaturerinfo-lookup.csv']
+PERSONNEL_FILENAME = 'maintenance_personnel.csv'
+snapshot_dir = os.environ.get('ETL_REFERENCE_CACHE', '.reference_cache')
+
+
+class ReferenceTable:
+    '''The rows of a reference CSV file, in file order, and indexed by their key column'''
+
+    def __init__(self, rows:list[dict], key:str, mtime_ns:int|None = None):
+        self.rows = rows
+        self.key = key
+        self.mtime_ns = mtime_ns  # Of the file the rows were read from
+        self.index = { row[key]: row for row in rows }
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def get(self, key:str) -> dict|None:
+        return self.index.get(key)
+
+    def group_by(self, column:str, values:str) -> dict[str, list]:
+        '''Returns the values of a column grouped by the values of another one, e.g. the registrations per manufacturer'''
+        groups: dict[str, list] = {}
+        for row in self.rows: groups.setdefault(row[column], []).append(row[values])
+        return groups
+
+
+def parse_aircrafts(file) -> list[dict]:
+    return [ { 'registration': row['aircraft_reg_code'], 'model': row['aircraft_model'], 'manufacturer': row['aircraft_manufacturer'] }
+             for row in csv.DictReader(file) ]
+
+
+def parse_personnel(file) -> list[dict]:
+    return [ { 'reporteurid': row['reporteurid'].strip(), 'airport': row['airport'] } for row in csv.DictReader(file) ]
+
+
+def file_digest(path:Path) -> str:
+    with open(path, 'rb') as file: return hashlib.file_digest(file, 'sha256').hexdigest()
+
+
+def load_rows(path:Path, parse) -> list[dict]:
+    '''Returns the parsed rows of a CSV file from its snapshot, if there is one of the same file. A snapshot is reused right away
+    when the modification time and size of the file didn't change, and after checking the content hash when only the time did'''
+    stat = path.stat()
+    snapshot = Path(snapshot_dir) / f"{path.name}.json"
+    cached = read_snapshot(snapshot)
+
+    digest = None
+    if cached is not None and cached['size'] == stat.st_size:
+        if cached['mtime_ns'] == stat.st_mtime_ns: return cached['rows']
+        digest = file_digest(path)
+        if cached['sha256'] == digest:
+            cached['mtime_ns'] = stat.st_mtime_ns
+            write_snapshot(snapshot, cached)
+            return cached['rows']
+
+    with open(path, 'r', encoding='utf-8', newline='') as file: rows = parse(file)
+    write_snapshot(snapshot, { 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': digest or file_digest(path), 'rows': rows })
+    return rows
+
+
+def read_snapshot(snapshot:Path) -> dict|None:
+    '''Returns the content of a snapshot, or None if it's missing or not a valid snapshot'''
+    try:
+        with open(snapshot, 'r', encoding='utf-8') as file: cached = json.load(file)
+    except (OSError, ValueError):
+        return None
+    valid = ( isinstance(cached, dict) and isinstance(cached.get('size'), int) and isinstance(cached.get('mtime_ns'), int)
+              and isinstance(cached.get('sha256'), str) and isinstance(cached.get('rows'), list)
+              and all( isinstance(row, dict) for row in cached['rows'] ) )
+    return cached if valid else None
+
+
+def write_snapshot(snapshot:Path, content:dict):
+    try:
+        snapshot.parent.mkdir(parents=True, exist_ok=True)
+        temporary = snapshot.with_name(f"{snapshot.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temporary, 'w', encoding='utf-8') as file: json.dump(content, file)
+        os.replace(temporary, snapshot)  # Atomic, readers never see half a file
+    except OSError:
+        pass  # The snapshot is only a shortcut, the rows were parsed anyway
+
+
+loaded: dict[Path, ReferenceTable] = {}
+lock = threading.Lock()  # extract_concurrent loads both files at the same time
+
+
+def load_table(path:Path, parse, key:str) -> ReferenceTable:
+    '''Returns the table of a CSV file, parsing it (or reading its snapshot) only the first time, or if it changed since then'''
+    with lock:
+        table = loaded.get(path)
+        mtime_ns = path.stat().st_mtime_ns
+        if table is None or table.mtime_ns != mtime_ns:
+            table = ReferenceTable(load_rows(path, parse), key, mtime_ns)
+            loaded[path] = table
+        return table
+
+
+def aircrafts() -> ReferenceTable:
+    '''The aircrafts of the manufacturer lookup CSV, as rows of {registration, model, manufacturer} indexed by registration'''
+    for filename in AIRCRAFT_FILENAMES:
+        if Path(filename).exists(): return load_table(Path(filename), parse_aircrafts, 'registration')
+    raise FileNotFoundError(f"Didn't find aricraft's manufacturer csv file... Searched: {AIRCRAFT_FILENAMES}")
+
+
+def personnel() -> ReferenceTable:
+    '''The maintenance personnel CSV, as rows of {reporteurid, airport} indexed by reporteurid'''
+    return load_table(Path(PERSONNEL_FILENAME), parse_personnel, 'reporteurid')
+
+# endregion
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Callable, Hashable
+
+
+
+# region RESULT CACHE
+# The disk tier stores the rows as JSON, with the values JSON doesn't have (dates and decimals) tagged, so a file in a shared
+# cache directory can only give wrong rows, never run code
+
+def encode(value:Any) -> dict:
+    if isinstance(value, Decimal): return {'__decimal__': str(value)}
+    if isinstance(value, datetime): return {'__datetime__': value.isoformat()}
+    if isinstance(value, date): return {'__date__': value.isoformat()}
+    raise TypeError(f"Can't store a {type(value).__name__} in the disk cache")
+
+
+DECODERS: dict[str, Callable[[str], Any]] = {'__decimal__': Decimal, '__datetime__': datetime.fromisoformat, '__date__': date.fromisoformat}
+
+def decode(tagged:dict) -> Any:
+    if len(tagged) == 1:
+        (tag, value), = tagged.items()
+        if tag in DECODERS:
+            if not isinstance(value, str): raise ValueError(f"Invalid {tag} value {value!r}")
+            return DECODERS[tag](value)
+    return tagged
+
+
+def read_rows(path:str) -> list[tuple]|None:
+    '''Returns the rows stored in a file of the disk tier, or None if it's missing or not a valid list of rows'''
+    try:
+        with open(path, 'r', encoding='utf-8') as file: rows = json.load(file, object_hook=decode)
+    except (OSError, ValueError, ArithmeticError):
+        return None
+    if not isinstance(rows, list) or not all( isinstance(row, list) for row in rows ): return None
+    return [ tuple(row) for row in rows ]
+
+
+def write_rows(path:str, rows:list[tuple]):
+    try:
+        content = json.dumps([ list(row) for row in rows ], default=encode)
+    except TypeError:
+        return  # Values of other types are only cached in memory
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary, 'w', encoding='utf-8') as file: file.write(content)
+    os.replace(temporary, path)  # Atomic, readers never see half a file
+
+
+class ResultCache:
+    '''Two-tier cache of query results. Every entry is tagged with the data version it was computed on, and is only
+    served for that same version, so once the data changes (and its version with it) old results can't be returned.
+    The memory tier keeps the maxsize most recently used results, and the optional disk tier (one JSON file per result
+    in directory) survives process restarts. Results are lists of rows (tuples). It can be shared by several threads'''
+
+    def __init__(self, maxsize:int = 128, directory:str|None = None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.memory: OrderedDict[tuple, Any] = OrderedDict()
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()  # Of memory and the counters. Results are computed outside of it
+        if directory is not None: os.makedirs(directory, exist_ok=True)
+
+    def path(self, key:Hashable, version:str) -> str:
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, f"{version}-{digest}.json")
+
+    def get_or_compute(self, key:Hashable, version:str, compute:Callable[[], list[tuple]]) -> list[tuple]:
+        '''Returns the cached result of key at the given data version, calling compute (and storing its result) on a miss'''
+        entry = (key, version)
+        with self.lock:
+            if entry in self.memory:
+                self.memory.move_to_end(entry)
+                self.hits += 1
+                return self.memory[entry]
+
+        result = read_rows(self.path(key, version)) if self.directory is not None else None
+
+        if result is None:
+            with self.lock: self.misses += 1
+            result = compute()
+            if self.directory is not None: write_rows(self.path(key, version), result)
+        else:
+            with self.lock: self.hits += 1
+
+        if self.maxsize > 0:
+            with self.lock:
+                self.memory[entry] = result
+                if len(self.memory) > self.maxsize: self.memory.popitem(last=False)
+        return result
+
+    def clear(self, keep_version:str|None = None):
+        '''Drops every entry, except the ones of keep_version on disk. The .pkl files of older versions of the cache are dropped too'''
+        with self.lock: self.memory.clear()
+        if self.directory is None: return
+        for name in os.listdir(self.directory):
+            kept = keep_version is not None and name.startswith(f"{keep_version}-") and name.endswith('.json')
+            if name.endswith(('.json', '.pkl')) and not kept:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+# endregion
@@ -0,0 +1,60 @@
+import os
+import sys
+from pathlib import Path
+from typing import Callable
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# The tests never connect to a PostgreSQL source: extract reads the CSV dumps of generate_sources (see the sources fixture)
+os.environ.setdefault('ETL_SOURCE_DIR', '.')
+import dw  # noqa: E402
+import extract  # noqa: E402
+import reference_data  # noqa: E402
+from generate_sources import SourceGenerator  # noqa: E402
+
+
+@pytest.fixture
+def dw_file(tmp_path, monkeypatch) -> str:
+    '''Makes the DWs of the test use a file of its own'''
+    filename = str(tmp_path / 'dw.duckdb')
+    monkeypatch.setattr(dw, 'duckdb_filename', filename)
+    monkeypatch.setattr(dw, 'published_filename', None)
+    return filename
+
+
+def fill(warehouse:'dw.DW', fh:float = 10.0):
+    '''Loads two aircrafts flying every day of January 2023, fh flight hours a day each, and refreshes the rollups'''
+    warehouse.conn_duckdb.execute('''
+        INSERT INTO months VALUES (202301, 1, 2023);
+        INSERT INTO days SELECT 20230100 + d, d, 202301 FROM range(1, 32) t(d);
+        INSERT INTO aircrafts VALUES ('XA-AAA', 'A320', 'Airbus'), ('XA-BBB', '737', 'Boeing');
+        INSERT INTO reporteurs VALUES ('R1', 'BCN', 'PIREP');
+    ''')
+    warehouse.conn_duckdb.execute('''
+        INSERT INTO daily_usage SELECT registration, day_id, ?, 2, 2 FROM aircrafts, days''', [fh])
+    warehouse.conn_duckdb.execute('''
+        INSERT INTO monthly_usage SELECT registration, 202301, 1, 1, 1, 2, 1, 1, 29 FROM aircrafts;
+        INSERT INTO reportage_usage SELECT registration, 202301, 'R1', 3, 1, 2 FROM aircrafts;
+    ''')
+    warehouse.cluster_facts()
+    warehouse.refresh_rollups()
+    warehouse.bump_data_version()
+
+
+@pytest.fixture(scope='session')
+def source_files(tmp_path_factory) -> Path:
+    '''CSV dumps and reference CSVs of a small synthetic source, with far more anomalies than the real one so every rule fires'''
+    directory = tmp_path_factory.mktemp('sources')
+    generator = SourceGenerator(scale_factor=0.05, days=60, seed=1, overlap_rate=0.6, swap_rate=0.05, unknown_aircraft_rate=0.05)
+    generator.write_csvs(directory)
+    generator.write_sources(directory)
+    return directory
+
+
+@pytest.fixture
+def sources(source_files, monkeypatch) -> Callable[[], dict]:
+    '''Extracts the synthetic source. Each call extracts it again, since the engines consume their sources'''
+    monkeypatch.chdir(source_files)  # reference_data reads the reference CSVs from the working directory
+    monkeypatch.setattr(extract, 'source_dir', str(source_files))
+    monkeypatch.setattr(reference_data, 'loaded', {})
+    return lambda: extract.extract(backend='copy')
@@ -0,0 +1,28 @@
+from datetime import datetime
+import pytest
+import checkpoint
+
+TABLES = {
+    'aircrafts': [{'registration': 'XA-AAA', 'model': 'A320', 'manufacturer': None}],
+    'daily_usage': [{'registration': 'XA-AAA', 'day_id': 20230101 + day, 'fh': 0.1 * day, 'tos': day, 'sto': 2} for day in range(3)],
+    'reportage_usage': []
+}
+
+
+@pytest.mark.parametrize('arrow', [True, False], ids=['arrow', 'json'])
+def test_saved_tables_are_read_back(tmp_path, monkeypatch, arrow):
+    if not arrow: monkeypatch.setattr(checkpoint, 'pa', None)
+    elif checkpoint.pa is None: pytest.skip("pyarrow is not installed")
+    run_id = checkpoint.save(str(tmp_path), TABLES, {'AIMS.flights': datetime(2023, 1, 3), 'AMOS.postflightreports': None}, 500)
+    manifest, tables = checkpoint.read(str(tmp_path))
+    assert manifest['run_id'] == run_id and manifest['batch_size'] == 500 and manifest['watermarks']['AIMS.flights'] == datetime(2023, 1, 3)
+    assert tables == TABLES
+    assert not list(tmp_path.glob('*.pkl'))
+
+
+def test_old_checkpoints_are_not_unpickled(tmp_path):
+    checkpoint.save(str(tmp_path), TABLES, {}, 500)
+    manifest = (tmp_path / checkpoint.MANIFEST).read_text().replace('"format"', '"old_format"')
+    (tmp_path / checkpoint.MANIFEST).write_text(manifest)
+    with pytest.raises(ValueError):
+        checkpoint.read(str(tmp_path))
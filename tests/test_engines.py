@@ -0,0 +1,59 @@
+import random
+import numpy as np
+import pytest
+import dw
+import load
+import transform
+import transform_elt
+import violations
+from transform_vectorized import br21_accepted
+
+
+def build(sources, engine:str, apply_business_rules:bool) -> tuple[dict[str, list[tuple]], dict, dict]:
+    '''Builds a DW from the sources with an engine (the parallel one with 2 workers, 'elt' staging, transforming and loading in
+    DuckDB), and returns its tables and the violation counts and checked events (of the log merged from the workers, for the
+    parallel engine)'''
+    warehouse = dw.DW(create=True, cache_size=0)
+    if engine == 'elt':
+        transform_elt.stage(warehouse, sources())
+        transform_elt.transform_staged(warehouse, apply_business_rules)
+        transform_elt.load_transformed(warehouse)
+    else:
+        load.load(warehouse, transform.transform(sources(), apply_business_rules, engine=engine, workers=2), bulk=True)
+    tables = { table_name: warehouse.conn_duckdb.execute(f'SELECT * FROM {table_name} ORDER BY ALL').fetchall() for table_name in warehouse.tables_dict }
+    warehouse.close()
+    return tables, dict(violations.log.counts), dict(violations.log.checked)
+
+
+@pytest.mark.parametrize('apply_business_rules', [True, False], ids=['business rules', 'no business rules'])
+@pytest.mark.parametrize('engine', ['numpy', 'parallel', 'elt'])
+def test_engine_builds_the_same_dw_as_python(dw_file, sources, engine, apply_business_rules):
+    tables, counts, checked = build(sources, engine, apply_business_rules)
+    expected_tables, expected_counts, expected_checked = build(sources, 'python', apply_business_rules)
+    assert all( expected_tables.values() )
+    if apply_business_rules: assert all( expected_counts.get(key) for key in [('BR-21', 'flight'), ('BR-21', 'maintenance'), ('BR-23', 'flight'), ('Reportage BR', 'report')] )
+    for table_name, rows in expected_tables.items():
+        assert tables[table_name] == rows, f"{engine} and python disagree on {table_name}"
+    assert (counts, checked) == (expected_counts, expected_checked)
+
+
+def br21_sequential(keys:list[int], slots:list[tuple[float, float]]) -> list[bool]:
+    '''BR-21 as the Python engine applied it originally: each slot is checked against the accepted slots of its key, in order'''
+    accepted_slots: dict[int, list] = {}
+    accepted = []
+    for key, slot in zip(keys, slots):
+        accepted.append( not transform.overlaps_with_dict(slot, accepted_slots.setdefault(key, [])) )
+        if accepted[-1]: accepted_slots[key].append(slot)
+    return accepted
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_br21_accepted_resolves_crowded_groups_in_processing_order(seed):
+    '''A crowded (aircraft, day) with hundreds of mostly overlapping events, interleaved with sparse ones, with regular,
+    zero-length and midnight-crossing slots'''
+    rng = random.Random(seed)
+    keys = [ 0 if rng.random() < 0.6 else rng.randint(1, 40) for _ in range(500) ]
+    slots = [ (float(rng.randint(0, 23)), float(rng.randint(0, 23))) for _ in keys ]
+    accepted = br21_accepted(np.array(keys), np.array([ start for start, _ in slots ]), np.array([ end for _, end in slots ]))
+    assert accepted.tolist() == br21_sequential(keys, slots)
+    assert not accepted[[ i for i, key in enumerate(keys) if key == 0 ]].all()
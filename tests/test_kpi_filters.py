@@ -0,0 +1,32 @@
+from datetime import date
+import pytest
+import dw
+from conftest import fill
+
+QUERIES = ['query_utilization', 'query_reporting', 'query_reporting_per_role']
+
+
+@pytest.fixture
+def warehouse(dw_file):
+    warehouse = dw.DW(create=True, cache_size=0)
+    fill(warehouse)
+    yield warehouse
+    warehouse.close()
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_single_day_range_is_rejected(warehouse, query):
+    with pytest.raises(ValueError):
+        getattr(warehouse, query)(use_rollups=False, date_from=date(2023, 1, 31), date_to=date(2023, 1, 31))
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_filters_select_a_slice_of_the_unfiltered_rows(warehouse, query):
+    rows = getattr(warehouse, query)(use_rollups=False)
+    january = { 'date_from': date(2023, 1, 1), 'date_to': date(2023, 1, 31) }
+    assert getattr(warehouse, query)(**january) == rows
+    for filters in [{'manufacturer': 'Boeing'}, {'model': '737'}, {'registration': 'XA-BBB', **january}]:
+        assert getattr(warehouse, query)(**filters) == [ row for row in rows if row[0] == 'Boeing' ]
+    assert getattr(warehouse, query)(model='A380') == []
+    assert getattr(warehouse, query)(date_from=date(2023, 2, 1)) == []
+    assert getattr(warehouse, query)(manufacturer='Boeing') == getattr(warehouse, query)(manufacturer='Boeing', use_rollups=False)
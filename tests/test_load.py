@@ -0,0 +1,51 @@
+import duckdb
+import pytest
+import dw
+import load
+
+
+@pytest.fixture
+def warehouse(dw_file):
+    warehouse = dw.DW(create=True, cache_size=0)
+    yield warehouse
+    warehouse.close()
+
+
+MONTHS = [ {'month_id': 202300 + month, 'month': month, 'year': 2023} for month in range(1, 13) ]
+
+
+def failing_from(monkeypatch, call:int):
+    '''Makes every insert_batch from the call-th one on fail with an error that isn't the fault of the rows'''
+    insert_batch, calls = load.insert_batch, []
+    def failing(*args):
+        calls.append(None)
+        if len(calls) >= call: raise duckdb.IOException("Injected fault")
+        insert_batch(*args)
+    monkeypatch.setattr(load, 'insert_batch', failing)
+
+
+def test_constraint_violations_are_rejected(warehouse):
+    rows = MONTHS + [MONTHS[3]]
+    report = load.bulk_load(warehouse, {'months': rows}, batch_size=5)
+    assert report['months']['inserted'] == 12 and [ rejected['row'] for rejected in report['months']['rejected'] ] == [MONTHS[3]]
+    report = load.checkpointed_load(warehouse, {'months': rows}, 'run', batch_size=5)
+    assert report['months']['inserted'] == 0 and len(report['months']['rejected']) == 13
+
+
+def test_other_errors_fail_the_bulk_load(warehouse, monkeypatch):
+    failing_from(monkeypatch, 2)
+    with pytest.raises(duckdb.IOException):
+        load.bulk_load(warehouse, {'months': MONTHS}, batch_size=5)
+
+
+def test_other_errors_fail_the_checkpointed_load_and_resume_from_that_batch(warehouse, monkeypatch):
+    insert_batch = load.insert_batch
+    failing_from(monkeypatch, 2)
+    with pytest.raises(duckdb.IOException):
+        load.checkpointed_load(warehouse, {'months': MONTHS}, 'run', batch_size=5)
+    assert warehouse.get_load_progress() == {'run': {('months', 0): (5, 0)}}
+
+    monkeypatch.setattr(load, 'insert_batch', insert_batch)
+    report = load.checkpointed_load(warehouse, {'months': MONTHS}, 'run', batch_size=5)
+    assert report['months']['inserted'] == 12 and report['months']['rejected'] == []
+    assert warehouse.conn_duckdb.execute('SELECT COUNT(*) FROM months').fetchone()[0] == 12
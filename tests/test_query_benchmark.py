@@ -0,0 +1,10 @@
+from query_benchmark import compare
+
+
+def test_compare_needs_both_the_ratio_and_the_difference():
+    baseline = {'results': {'DW.query_utilization': {'hot': {'median': 0.010}, 'cached': {'median': 0.000004}}}}
+    results = {'DW.query_utilization': {'hot': {'median': 0.020}, 'cached': {'median': 0.000005}}}
+    assert len(compare(results, baseline, 1.2)) == 2
+    regressions = compare(results, baseline, 1.2, min_difference=0.0005)
+    assert len(regressions) == 1 and '(hot)' in regressions[0]
+    assert compare(results, baseline, 3.0, min_difference=0.0005) == []
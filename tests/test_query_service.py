@@ -0,0 +1,25 @@
+import dw
+from conftest import fill
+from query_service import KPIService
+
+
+def build(fh:float):
+    warehouse = dw.DW(create=True)
+    fill(warehouse, fh)
+    warehouse.close()
+
+
+def test_service_switches_to_published_dw(dw_file):
+    build(fh=10.0)
+    with KPIService(workers=2, reopen_interval=0) as service:
+        before = service.query('query_utilization')
+        version = service.dw.data_version
+
+        dw.start_shadow_build()
+        build(fh=20.0)
+        dw.publish_shadow_build()
+
+        after = service.query('query_utilization')
+        assert service.dw.data_version != version
+        assert [ row[2] for row in after ] == [ 2 * row[2] for row in before ]  # Flight hours per aircraft
+        assert not service.dw.is_stale()
@@ -0,0 +1,30 @@
+import json
+import pytest
+import reference_data
+
+
+@pytest.fixture
+def personnel_csv(tmp_path, monkeypatch):
+    monkeypatch.setattr(reference_data, 'snapshot_dir', str(tmp_path / 'cache'))
+    path = tmp_path / 'maintenance_personnel.csv'
+    path.write_text('reporteurid,airport\n 7 ,BCN\n8,MAD\n')
+    return path
+
+
+def test_snapshot_is_json_and_reused(personnel_csv):
+    rows = reference_data.load_rows(personnel_csv, reference_data.parse_personnel)
+    assert rows == [{'reporteurid': '7', 'airport': 'BCN'}, {'reporteurid': '8', 'airport': 'MAD'}]
+    snapshot = personnel_csv.parent / 'cache' / 'maintenance_personnel.csv.json'
+    content = json.loads(snapshot.read_text())
+    content['rows'] = [{'reporteurid': '9', 'airport': 'LHR'}]
+    snapshot.write_text(json.dumps(content))
+    assert reference_data.load_rows(personnel_csv, reference_data.parse_personnel) == content['rows']
+
+
+@pytest.mark.parametrize('content', ['not json', '[]', '{"size": 1}', 'null'])
+def test_invalid_snapshot_is_parsed_again(personnel_csv, content):
+    rows = reference_data.load_rows(personnel_csv, reference_data.parse_personnel)
+    snapshot = personnel_csv.parent / 'cache' / 'maintenance_personnel.csv.json'
+    snapshot.write_text(content)
+    assert reference_data.load_rows(personnel_csv, reference_data.parse_personnel) == rows
+    assert json.loads(snapshot.read_text())['rows'] == rows
@@ -0,0 +1,30 @@
+import os
+from datetime import date, datetime
+from decimal import Decimal
+import pytest
+from result_cache import ResultCache
+
+ROWS = [('Airbus', 2023, Decimal('12.50'), 0.1, None, date(2023, 1, 31), datetime(2023, 1, 31, 7, 30)), ('Boeing', 2024, Decimal('-3'), 1e300, 'x', None, None)]
+
+
+def test_disk_tier_keeps_the_values_of_the_rows(tmp_path):
+    ResultCache(maxsize=0, directory=str(tmp_path)).get_or_compute('query', 'v1', lambda: ROWS)
+    cache = ResultCache(maxsize=0, directory=str(tmp_path))
+    assert cache.get_or_compute('query', 'v1', lambda: pytest.fail("Recomputed")) == ROWS
+    assert cache.hits == 1 and all( name.endswith('.json') for name in os.listdir(tmp_path) )
+
+
+@pytest.mark.parametrize('content', ['not json', '{"rows": 1}', '[1, 2]', '[[{"__decimal__": "nan?"}]]', '[[{"__date__": 3}]]'])
+def test_invalid_files_are_computed_again(tmp_path, content):
+    cache = ResultCache(maxsize=0, directory=str(tmp_path))
+    with open(cache.path('query', 'v1'), 'w') as file: file.write(content)
+    assert cache.get_or_compute('query', 'v1', lambda: ROWS) == ROWS
+    assert cache.misses == 1
+
+
+def test_clear_keeps_only_the_current_version(tmp_path):
+    cache = ResultCache(directory=str(tmp_path))
+    for version in ['v1', 'v2']: cache.get_or_compute('query', version, lambda: ROWS)
+    (tmp_path / 'v2-old.pkl').write_bytes(b'')
+    cache.clear(keep_version='v2')
+    assert os.listdir(tmp_path) == [os.path.basename(cache.path('query', 'v2'))]
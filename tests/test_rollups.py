@@ -0,0 +1,55 @@
+from datetime import date
+import pytest
+import dw
+from conftest import fill
+
+QUERIES = ['query_utilization', 'query_reporting', 'query_reporting_per_role']
+
+
+@pytest.fixture(scope='module')
+def warehouse(tmp_path_factory):
+    '''The DW of fill, plus February 2023 and January 2024, with a second Airbus model that flies only in 2024'''
+    original = dw.duckdb_filename, dw.published_filename
+    dw.duckdb_filename, dw.published_filename = str(tmp_path_factory.mktemp('rollups') / 'dw.duckdb'), None
+    warehouse = dw.DW(create=True, cache_size=0)
+    fill(warehouse)
+    warehouse.conn_duckdb.execute('''
+        INSERT INTO months VALUES (202302, 2, 2023), (202401, 1, 2024);
+        INSERT INTO days SELECT 20230200 + d, d, 202302 FROM range(1, 29) t(d);
+        INSERT INTO days SELECT 20240100 + d, d, 202401 FROM range(1, 32) t(d);
+        INSERT INTO aircrafts VALUES ('XA-CCC', 'A350', 'Airbus');
+        INSERT INTO daily_usage SELECT registration, day_id, 0.25 * (day_id % 7), 1 + day_id % 3, 2 FROM aircrafts, days
+            WHERE day_id > 20230131 AND (registration <> 'XA-CCC' OR day_id > 20240000);
+        INSERT INTO monthly_usage SELECT registration, month_id, 2, 1, 1.5, 3.25, 2, 1.25, 26 FROM aircrafts, months
+            WHERE month_id > 202301 AND (registration <> 'XA-CCC' OR month_id = 202401);
+        INSERT INTO reportage_usage SELECT registration, month_id, 'R1', 5, 2, 3 FROM aircrafts, months
+            WHERE month_id > 202301 AND (registration <> 'XA-CCC' OR month_id = 202401);
+    ''')
+    warehouse.cluster_facts()
+    warehouse.refresh_rollups()
+    yield warehouse
+    warehouse.close()
+    dw.duckdb_filename, dw.published_filename = original
+
+
+@pytest.mark.parametrize('query', QUERIES)
+@pytest.mark.parametrize('filters', [
+    {},
+    {'manufacturer': 'Airbus'},
+    {'date_from': date(2023, 1, 1), 'date_to': date(2023, 12, 31)},
+    {'model': 'A320'},
+    {'model': 'A350', 'date_from': date(2024, 1, 1)},
+    {'manufacturer': 'Airbus', 'date_from': date(2023, 2, 1), 'date_to': date(2024, 1, 31)},
+    {'date_to': date(2023, 1, 31)}
+], ids=['all', 'manufacturer', 'year', 'model', 'model from a month', 'months', 'up to a month'])
+def test_rollups_answer_like_the_facts(warehouse, query, filters):
+    facts = getattr(warehouse, query)(use_rollups=False, **filters)
+    assert facts
+    assert getattr(warehouse, query)(use_rollups=True, **filters) == facts
+
+
+def test_model_and_month_slices_read_kpi_model_monthly():
+    source, parameters = dw.rollup_source(None, 'A320', None, date(2023, 2, 1), None)
+    assert 'kpi_model_monthly' in source and parameters == ['A320', 202302]
+    assert 'kpi_yearly' in dw.rollup_source('Airbus', None, None, date(2023, 1, 1), date(2023, 12, 31))[0]
+    assert dw.rollup_source(None, None, 'XA-AAA', None, None) is None
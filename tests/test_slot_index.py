@@ -0,0 +1,34 @@
+import random
+import pytest
+from transform import SlotIndex, overlaps_with_dict
+
+
+def check_against_list(slots:list[tuple[float, float]]) -> int:
+    '''Applies BR-21 to the slots with a SlotIndex and with overlaps_with_dict on a list, asserting they agree on every slot.
+    Returns the number of accepted slots'''
+    index, accepted = SlotIndex(), []
+    for slot in slots:
+        overlaps = overlaps_with_dict(slot, accepted)
+        assert index.overlaps(slot) == overlaps, f"{slot} against {accepted}"
+        if not overlaps:
+            index.add(slot)
+            accepted.append(slot)
+    assert len(index) == len(accepted)
+    return len(accepted)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_slots(seed):
+    '''Whole hours (BR21_RESOLUTION of 3600) or minutes, so many slots share their boundaries, are zero-length or cross midnight'''
+    rng = random.Random(seed)
+    steps = rng.choice([24, 24 * 60])
+    slots = [ (rng.randrange(steps) * 24 / steps, rng.randrange(steps) * 24 / steps) for _ in range(rng.randint(1, 60)) ]
+    check_against_list(slots)
+
+
+def test_touching_and_zero_length_slots():
+    assert check_against_list([(8, 10), (10, 12), (6, 8), (12, 12), (10, 10), (8, 8), (9, 9), (7, 11)]) == 6
+    assert check_against_list([(5, 5), (5, 5), (4, 6), (3, 5), (5, 7)]) == 4
+    assert check_against_list([(22, 2), (23, 1), (21, 22), (2, 3), (0, 0), (23, 23), (1, 1), (21, 23)]) == 7
+    assert check_against_list([(10, 10), (9, 11)]) == 1
+    assert check_against_list([ (hour, hour + 1) for hour in range(23) ] + [(3, 3), (0, 24)]) == 24
@@ -0,0 +1,43 @@
+import pytest
+import dw
+import load
+from conftest import fill
+
+
+@pytest.fixture
+def warehouse(dw_file):
+    warehouse = dw.DW(create=True, cache_size=0)
+    fill(warehouse)
+    yield warehouse
+    warehouse.close()
+
+
+def rollups(warehouse:dw.DW) -> dict[str, list[tuple]]:
+    return { table: warehouse.conn_duckdb.execute(f'SELECT * FROM {table} ORDER BY ALL').fetchall() for table in warehouse.ROLLUP_TABLES }
+
+
+def merge(warehouse:dw.DW, aircrafts:list[dict]) -> dict[str, list[tuple]]:
+    '''Upserts February 2023 for XA-AAA and a new value of its first day of January, and returns the rollups left by upsert_load'''
+    load.upsert_load(warehouse, {
+        'months': [{'month_id': 202302, 'month': 2, 'year': 2023}],
+        'days': [{'day_id': 20230200 + day, 'day': day, 'month_id': 202302} for day in range(1, 29)],
+        'aircrafts': aircrafts,
+        'daily_usage': [{'registration': 'XA-AAA', 'day_id': 20230101, 'fh': 5.0, 'tos': 1, 'sto': 1}] +
+                       [{'registration': 'XA-AAA', 'day_id': 20230200 + day, 'fh': 7.0, 'tos': 2, 'sto': 2} for day in range(1, 29)],
+        'monthly_usage': [{'registration': 'XA-AAA', 'month_id': 202302, 'dy': 2, 'cn': 0, 'dh': 3, 'ados': 2, 'adoss': 1, 'adosu': 1, 'adis': 26}],
+        'reportage_usage': []
+    })
+    return rollups(warehouse)
+
+
+@pytest.mark.parametrize('aircrafts', [
+    [],
+    [{'registration': 'XA-AAA', 'model': None, 'manufacturer': None}],
+    [{'registration': 'XA-AAA', 'model': '737', 'manufacturer': 'Boeing'}]
+], ids=['facts only', 'unchanged aircraft', 'aircraft moved to another group'])
+def test_merge_refreshes_rollups_like_a_full_rebuild(warehouse, aircrafts):
+    before = rollups(warehouse)
+    merged = merge(warehouse, aircrafts)
+    assert merged != before
+    warehouse.refresh_rollups()
+    assert merged == rollups(warehouse)
@@ -1,39 +1,41 @@
 from tqdm import tqdm
-import logging
 from pygrametl.datasources import CSVSource, SQLSource
+from bisect import bisect_left, bisect_right, insort
 from datetime import datetime
-from typing import Any, TypeAlias
+from itertools import islice
+from typing import Any, Iterable, Iterator, TypeAlias
+import violations
+from violations import ViolationLog
 
 
 
-# Configure logging
-logging.basicConfig(
-    filename='cleaning.log',           # Log file name
-    level=logging.INFO,           # Logging level
-    format='%(message)s'  # Log message format
-)
-
-
 # region MANAGE DATETIMES
 
-def build_dateCode(date:datetime) -> str:
-    return f"{date.year}-{date.month}-{date.day}"
+def build_dateCode(date:datetime) -> int:
+    '''Returns the day_id of a date, as the integer yyyymmdd'''
+    return date.year*10000 + date.month*100 + date.day
 
 
-def build_monthCode(date:datetime) -> str:
-    return f"{date.year}{str(date.month).zfill(2)}"
+def build_monthCode(date:datetime) -> int:
+    '''Returns the month_id of a date, as the integer yyyymm'''
+    return date.year*100 + date.month
 
 
-def build_day_dimension_value(date:datetime) -> tuple[str, int, str]: #day_id, day, month_id
+def build_day_dimension_value(date:datetime) -> tuple[int, int, int]: #day_id, day, month_id
     '''Returns a tuple corresponding to a row of table days'''
     return ( build_dateCode(date), date.day, build_monthCode(date) )
 
 
-def build_month_dimension_value(date:datetime) -> tuple[str, int, int]: #month_id, month, year
+def build_month_dimension_value(date:datetime) -> tuple[int, int, int]: #month_id, month, year
     '''Returns a tuple corresponding to a row of table months'''
     return ( build_monthCode(date), date.month, date.year )
 
 
+def source_total(source) -> int|None:
+    '''Number of rows of a source, for the progress bars: its length, or the count extract stored in its total attribute (None if unknown)'''
+    return len(source) if hasattr(type(source), '__len__') else getattr(source, 'total', None)
+
+
 def time_difference( start:datetime, end:datetime ) -> int:
     '''Recieves two datetimes and returns their difference in seconds'''
     try:
@@ -63,21 +65,74 @@ def overlaps_with_dict(s:Slot, l:list[Slot]):
     '''Returns true if interval s overlaps with any of the intervals on list of intervals l'''
     return any( [ overlap(s, si) for si in l ] )
 
+
+# Granularity, in seconds, of the slot times. 3600 compares whole hours like the original rule, 60 compares minutes, 1 seconds
+BR21_RESOLUTION = 3600
+
+def slot_time(date:datetime) -> float:
+    '''Returns the time of the day of a datetime in hours, truncated to BR21_RESOLUTION'''
+    if BR21_RESOLUTION == 3600: return date.hour
+    return (date.hour*3600 + date.minute*60 + date.second) // BR21_RESOLUTION * BR21_RESOLUTION / 3600
+
+
+class SlotIndex:
+    '''Slots of one (aircraft, day) that passed BR-21, answering overlap queries in logarithmic time.
+    A slot is only added if it overlaps none of the stored ones, so the regular slots (start < end) are disjoint and
+    sorted by start they are sorted by end too: the only candidate to overlap (a, b) is the last one starting before b.
+    Zero-length slots (start == end, any events within the same BR21_RESOLUTION step) only overlap the regular slots (a, b)
+    with a < start < b, so they are kept sorted apart, and the first one after a tells if any lies inside (a, b).
+    Slots with start > end (crossing midnight) can't overlap each other nor the zero-length ones, and are few, so they are
+    kept apart in a list'''
+
+    __slots__ = ('starts', 'ends', 'points', 'crossing')
+
+    def __init__(self):
+        self.starts: list[float] = []
+        self.ends: list[float] = []
+        self.points: list[float] = []
+        self.crossing: list[Slot] = []
+
+    def overlaps(self, s:Slot) -> bool:
+        '''Returns whether s overlaps any stored slot (same result as overlaps_with_dict on the list of stored slots)'''
+        i = bisect_left(self.starts, s[1])
+        if i > 0 and self.ends[i-1] > s[0]: return True
+        if s[0] >= s[1]: return False  # Zero-length and crossing slots can only overlap the regular ones
+        i = bisect_right(self.points, s[0])
+        if i < len(self.points) and self.points[i] < s[1]: return True
+        return any( overlap(s, si) for si in self.crossing )
+
+    def add(self, s:Slot):
+        '''Stores a slot. It must not overlap any stored slot'''
+        if s[0] < s[1]:
+            i = bisect_left(self.starts, s[0])
+            self.starts.insert(i, s[0])
+            self.ends.insert(i, s[1])
+        elif s[0] == s[1]:
+            insort(self.points, s[0])
+        else:
+            self.crossing.append(s)
+
+    def __len__(self) -> int:
+        return len(self.starts) + len(self.points) + len(self.crossing)
+
+    def __repr__(self) -> str:
+        return str( list(zip(self.starts, self.ends)) + [ (point, point) for point in self.points ] + self.crossing )
+
 # endregion
 
 
 
 # region MANAGE CSV FILES
-def fill_aircrafts( table_aircrafts: dict[str, dict], aircrafts_csv_source:CSVSource ):
-    '''Recieves CSVSource of the aircrafts and adds them into their table dictionary'''
+def fill_aircrafts( table_aircrafts: dict[str, dict], aircrafts_csv_source:Iterable[dict] ):
+    '''Recieves the rows of the aircrafts CSV (see reference_data.aircrafts) and adds them into their table dictionary'''
 
     for row in aircrafts_csv_source:
         registration, model, manufacturer = row['registration'], row['model'], row['manufacturer']
         table_aircrafts[registration] = { 'model': model, 'manufacturer': manufacturer }
 
 
-def fill_reporteurs( table_reporteurs:dict[str, dict], personnel_csv_source:CSVSource  ):
-    '''Recieves CSVSource of the reporteurs and adds them into their table dictionary'''
+def fill_reporteurs( table_reporteurs:dict[str, dict], personnel_csv_source:Iterable[dict]  ):
+    '''Recieves the rows of the personnel CSV (see reference_data.personnel) and adds them into their table dictionary'''
 
     for row in personnel_csv_source:
         reporteurid, airport = str(row['reporteurid']).strip(), row['airport']
@@ -87,9 +142,88 @@ def fill_reporteurs( table_reporteurs:dict[str, dict], personnel_csv_source:CSVS
 
 
 
-def void_monthly_metrics() -> dict[str, Any]:
+# region COMPACT STATE
+# Aggregation keys are packed into a single int: registrations and reporteurs are dictionary-encoded into consecutive codes,
+# and days and months are their day_id and month_id (yyyymmdd and yyyymm integers). They are decoded only when the rows are emitted
+DAY_FACTOR = 10**8          # daily key = registration code * DAY_FACTOR + yyyymmdd
+MONTH_FACTOR = 10**6        # monthly key = registration code * MONTH_FACTOR + yyyymm
+REPORTEUR_FACTOR = 10**7    # reportage key = monthly key * REPORTEUR_FACTOR + reporteur code
+
+
+class KeyDictionary:
+    '''Integer codes of the registrations and reporteurs that appear in the aggregation keys'''
+
+    __slots__ = ('registration_codes', 'registrations', 'reporteur_codes', 'reporteurs')
+
+    def __init__(self):
+        self.registration_codes: dict[str, int] = {}
+        self.registrations: list[str] = []
+        self.reporteur_codes: dict[str, int] = {}
+        self.reporteurs: list[str] = []
+
+    def registration(self, registration:str) -> int:
+        code = self.registration_codes.get(registration)
+        if code is None:
+            code = self.registration_codes[registration] = len(self.registrations)
+            self.registrations.append(registration)
+        return code
+
+    def reporteur(self, reporteurid:str) -> int:
+        code = self.reporteur_codes.get(reporteurid)
+        if code is None:
+            code = self.reporteur_codes[reporteurid] = len(self.reporteurs)
+            self.reporteurs.append(reporteurid)
+        return code
+
+    def decode_daily(self, key:int) -> tuple[str, int]:
+        '''Returns the (registration, day_id) of a daily key'''
+        return self.registrations[key // DAY_FACTOR], key % DAY_FACTOR
+
+    def decode_monthly(self, key:int) -> tuple[str, int]:
+        '''Returns the (registration, month_id) of a monthly key'''
+        return self.registrations[key // MONTH_FACTOR], key % MONTH_FACTOR
+
+    def decode_reportage(self, key:int) -> tuple[str, int, str]:
+        '''Returns the (registration, month_id, reporteur_uid) of a reportage key'''
+        registration, month = self.decode_monthly(key // REPORTEUR_FACTOR)
+        return registration, month, self.reporteurs[key % REPORTEUR_FACTOR]
+
+
+class DailyUsage:
+    __slots__ = ('fh', 'tos', 'sto')
+
+    def __init__(self, fh:float = 0, tos:int = 0, sto:int = 0):
+        self.fh, self.tos, self.sto = fh, tos, sto
+
+    def as_dict(self) -> dict[str, Any]:
+        return {'fh': self.fh, 'tos': self.tos, 'sto': self.sto}
+
+
+class MonthlyUsage:
+    __slots__ = ('dy', 'cn', 'dh', 'ados', 'adoss', 'adosu', 'adis')
+
+    def __init__(self):
+        self.dy, self.cn, self.dh, self.ados, self.adoss, self.adosu, self.adis = 0, 0, 0, 0, 0, 0, 365.25/12
+
+    def as_dict(self) -> dict[str, Any]:
+        return {'dy': self.dy, 'cn': self.cn, 'dh': self.dh, 'ados': self.ados, 'adoss': self.adoss, 'adosu': self.adosu, 'adis': self.adis}
+
+
+class ReportageUsage:
+    __slots__ = ('reps', 'mareps', 'pireps')
+
+    def __init__(self):
+        self.reps, self.mareps, self.pireps = 0, 0, 0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {'reps': self.reps, 'mareps': self.mareps, 'pireps': self.pireps}
+
+
+def void_monthly_metrics() -> MonthlyUsage:
     '''Returns the default starting value for an element of table_monthly_usage'''
-    return {'dy': 0, 'cn': 0, 'dh': 0, 'ados': 0, 'adoss': 0, 'adosu': 0, 'adis': 365.25/12}
+    return MonthlyUsage()
+
+# endregion
 
 
 
@@ -97,32 +231,37 @@ def void_monthly_metrics() -> dict[str, Any]:
 
 ### -------------------------------------------------------------------------------------------------- ###
 def transform_flights(      source_flights:SQLSource, 
-                            table_daily_usage:dict[tuple[str,str], dict], 
-                            table_monthly_usage:dict[tuple[str, str], dict], 
-                            table_days:set[tuple[str, int, str]], 
-                            table_months:set[tuple[str, int, int]], 
-                            br21_slots: dict[ tuple[str, str], list[Slot] ], 
-                            apply_business_rules:bool = True
+                            table_daily_usage:dict[int, DailyUsage], 
+                            table_monthly_usage:dict[int, MonthlyUsage], 
+                            table_days:set[int], 
+                            table_months:set[int], 
+                            br21_slots: dict[ int, SlotIndex ], 
+                            keys:KeyDictionary,
+                            apply_business_rules:bool = True,
+                            violation_log:ViolationLog|None = None
                             ):
     
     '''Traverses all flights extracted from AMOS.flights and saves their information into the usage metrics tables'''
 
-    swapped_flights = 0
+    violation_log = violation_log if violation_log is not None else violations.log
+    checked_flights = 0
+    i = -1
 
     #Loop that traverses all flights
-    for i, flight in tqdm( enumerate(source_flights), total=69095, desc="Flights    "):
+    for i, flight in tqdm( enumerate(source_flights), total=source_total(source_flights), desc="Flights    "):
 
         # Get aircraft and date
         aircraft:str = flight['aircraftregistration']
         date:datetime = flight['scheduleddeparture']
-        day:str = build_dateCode(date)
-        month:str = build_monthCode(date)
-        monthly_key = (aircraft, month)
-        daily_key = (aircraft, day)
+        day:int = build_dateCode(date)
+        month:int = day // 100
+        registration:int = keys.registration(aircraft)
+        monthly_key = registration * MONTH_FACTOR + month
+        daily_key = registration * DAY_FACTOR + day
 
         #Add date into the months and days table
-        table_days.add( build_day_dimension_value(date) )
-        table_months.add( build_month_dimension_value(date) )
+        table_days.add( day )
+        table_months.add( month )
 
         #Raw flight variables
         actual_arrival:datetime = flight['actualarrival']
@@ -131,30 +270,33 @@ def transform_flights(      source_flights:SQLSource,
         scheduled_departure:datetime = flight['scheduleddeparture']
         cancelled:bool = flight['cancelled'] or actual_arrival is None or actual_departure is None 
 
-        if daily_key not in table_daily_usage: 
-            table_daily_usage[daily_key] = { 'fh': 0, 'tos': 0, 'sto': 0 }
+        daily_usage = table_daily_usage.get(daily_key)
+        if daily_usage is None: 
+            daily_usage = table_daily_usage[daily_key] = DailyUsage()
         
-        if monthly_key not in table_monthly_usage: 
-            table_monthly_usage[monthly_key] = void_monthly_metrics()
+        monthly_usage = table_monthly_usage.get(monthly_key)
+        if monthly_usage is None: 
+            monthly_usage = table_monthly_usage[monthly_key] = void_monthly_metrics()
 
         #Complex flight variables
         if cancelled: 
-            table_monthly_usage[monthly_key]['cn'] += 1
-            table_daily_usage[daily_key]['sto'] += 1
+            monthly_usage.cn += 1
+            daily_usage.sto += 1
         
         else:
 
             #Slot overlapping
             ignore:bool = False
             if apply_business_rules:
-                slot = (actual_departure.hour, actual_arrival.hour)
-                if daily_key not in br21_slots: br21_slots[daily_key] = []
-                ignore = overlaps_with_dict( slot, br21_slots[daily_key] )
+                slot = (slot_time(actual_departure), slot_time(actual_arrival))
+                if daily_key not in br21_slots: br21_slots[daily_key] = SlotIndex()
+                ignore = br21_slots[daily_key].overlaps(slot)
+                checked_flights += 1
                 
                 if ignore: 
-                    logging.error( f"BR-21: Flight of aircraft {aircraft} at time {slot} overlaps with an existing slot! That day there were those other slots: {br21_slots[daily_key]}")
+                    violation_log.record('BR-21', 'flight', aircraft, date, slot)
                 else: 
-                    br21_slots[daily_key].append(slot)
+                    br21_slots[daily_key].add(slot)
 
             if not ignore: 
                 this_flight_hours:float = time_difference(actual_departure, actual_arrival) / 3600
@@ -163,8 +305,7 @@ def transform_flights(      source_flights:SQLSource,
                 if apply_business_rules and this_flight_hours < 0: 
                     actual_arrival, actual_departure = actual_departure, actual_arrival
                     this_flight_hours:float = time_difference(actual_departure, actual_arrival) / 3600
-                    swapped_flights+=1
-                    logging.error( f"BR-23: Flight of aircraft {aircraft} at {build_day_dimension_value(date)} had departure and arrival swapped" )
+                    violation_log.record('BR-23', 'flight', aircraft, date)
                 
                 this_delay_hours:float = time_difference(scheduled_departure, actual_departure) / 3600
                 delayed:bool = (this_delay_hours > 15/60) #El profe dijo que ignorasemos lo de <6h
@@ -172,14 +313,16 @@ def transform_flights(      source_flights:SQLSource,
 
             
                 # Add the computations to the metrics tables
-                table_daily_usage[daily_key]['fh'] += this_flight_hours
-                table_daily_usage[daily_key]['tos'] += 1
-                table_daily_usage[daily_key]['sto'] += 1
+                daily_usage.fh += this_flight_hours
+                daily_usage.tos += 1
+                daily_usage.sto += 1
 
-                table_monthly_usage[monthly_key]['dh'] += this_delay_hours
-                table_monthly_usage[monthly_key]['dy'] += delayed
+                monthly_usage.dh += this_delay_hours
+                monthly_usage.dy += delayed
     
-    if apply_business_rules: logging.info( f"\n\nBR-23: There were {swapped_flights}/69095 that had arrival and departure times swapped!" )
+    if apply_business_rules:
+        violation_log.check('BR-21', 'flight', checked_flights)
+        violation_log.check('BR-23', 'flight', i+1)
 
 
 
@@ -187,22 +330,28 @@ def transform_flights(      source_flights:SQLSource,
 
 ### -------------------------------------------------------------------------------------------------- ###
 def transform_maintenances(     source_maintenances:SQLSource, 
-                                table_monthly_usage:dict[tuple[str, str], dict ], 
-                                table_months: set[tuple[str, int, int]],
-                                br21_slots: dict[ tuple[str, str], list[Slot] ],
-                                apply_business_rules:bool = True
+                                table_monthly_usage:dict[int, MonthlyUsage], 
+                                table_months: set[int],
+                                br21_slots: dict[ int, SlotIndex ],
+                                keys:KeyDictionary,
+                                apply_business_rules:bool = True,
+                                violation_log:ViolationLog|None = None
                                 ):
 
     '''Traverses all maintenances extracted from AMOS.maintenances and saves their information into the usage metrics tables'''
 
+    violation_log = violation_log if violation_log is not None else violations.log
+    i = -1
+
     #Traverse maintenances
-    for i, maintenance in tqdm( enumerate(source_maintenances), total=148524, desc="Maintenance"):
+    for i, maintenance in tqdm( enumerate(source_maintenances), total=source_total(source_maintenances), desc="Maintenance"):
 
         # Get aircraft and date
         aircraft:str = maintenance['aircraftregistration']
         date:datetime = maintenance['scheduleddeparture']
-        month:str = build_monthCode(date)
-        monthly_key = (aircraft, month)
+        day:int = build_dateCode(date)
+        registration:int = keys.registration(aircraft)
+        monthly_key = registration * MONTH_FACTOR + day // 100
 
         # Raw maintenance variables
         scheduled_arrival:datetime = maintenance['scheduledarrival']
@@ -210,19 +359,19 @@ def transform_maintenances(     source_maintenances:SQLSource,
         scheduled:bool = maintenance['programmed']
 
         #Add date into the months table
-        table_months.add( build_month_dimension_value(date) )
+        table_months.add( day // 100 )
 
         #Overlapping
         ignore = False
         if apply_business_rules:
-            daily_key = (aircraft, build_dateCode(date))
-            slot = (scheduled_departure.hour, scheduled_arrival.hour)
-            if daily_key not in br21_slots: br21_slots[daily_key] = []
+            daily_key = registration * DAY_FACTOR + day
+            slot = (slot_time(scheduled_departure), slot_time(scheduled_arrival))
+            if daily_key not in br21_slots: br21_slots[daily_key] = SlotIndex()
 
-            ignore =  overlaps_with_dict( slot, br21_slots[daily_key] )
+            ignore =  br21_slots[daily_key].overlaps(slot)
             
-            if ignore: logging.error( f"BR-21: Maintenance of aircraft {aircraft} at time {slot} overlaps with an existing slot! That day there were those other slots: {br21_slots[daily_key]}")
-            else: br21_slots[daily_key].append(slot)
+            if ignore: violation_log.record('BR-21', 'maintenance', aircraft, date, slot)
+            else: br21_slots[daily_key].add(slot)
         
         if not ignore: 
             #Complex maintenance variables
@@ -231,13 +380,16 @@ def transform_maintenances(     source_maintenances:SQLSource,
             unscheduled_maintenance_time = maintenance_time if not scheduled else 0
 
             # Add the computations to the metrics tables
-            if not monthly_key in table_monthly_usage:
-                table_monthly_usage[monthly_key] = void_monthly_metrics()
+            monthly_usage = table_monthly_usage.get(monthly_key)
+            if monthly_usage is None:
+                monthly_usage = table_monthly_usage[monthly_key] = void_monthly_metrics()
 
-            table_monthly_usage[monthly_key]['ados'] += maintenance_time
-            table_monthly_usage[monthly_key]['adoss'] += scheduled_maintenance_time
-            table_monthly_usage[monthly_key]['adosu'] += unscheduled_maintenance_time
-            table_monthly_usage[monthly_key]['adis'] -= maintenance_time
+            monthly_usage.ados += maintenance_time
+            monthly_usage.adoss += scheduled_maintenance_time
+            monthly_usage.adosu += unscheduled_maintenance_time
+            monthly_usage.adis -= maintenance_time
+
+    if apply_business_rules: violation_log.check('BR-21', 'maintenance', i+1)
 
 
 
@@ -247,19 +399,21 @@ def transform_maintenances(     source_maintenances:SQLSource,
 ### -------------------------------------------------------------------------------------------------- ###
 def transform_reports(      source_reports:SQLSource, 
                             table_aircrafts:dict[str, dict], 
-                            table_reportage_usage: dict[ tuple[str, str, str], dict ], 
+                            table_reportage_usage: dict[ int, ReportageUsage ], 
                             table_reporteurs:dict[str, dict[str, Any]], 
-                            table_months:set[tuple[str, int, int]], 
-                            apply_business_rules:bool = True
+                            table_months:set[int], 
+                            keys:KeyDictionary,
+                            apply_business_rules:bool = True,
+                            violation_log:ViolationLog|None = None
                             ):
 
     '''Traverses all reports extracted from AIMS.postflightreports and saves their information into the usage metrics tables'''
 
-    reports_list = list(source_reports)
-    foreign_aircraft_reports_count = 0 #Reports made on aircrafts that were not in our database
+    violation_log = violation_log if violation_log is not None else violations.log
+    i = -1
 
     #Loop that traverses all reports
-    for i, report in tqdm( enumerate(reports_list), total=180418, desc="Reports    "):
+    for i, report in tqdm( enumerate(source_reports), total=source_total(source_reports), desc="Reports    "):
     
         # Get aircraft and check if it is in our database
         aircraft:str = report['aircraftregistration']
@@ -267,13 +421,13 @@ def transform_reports(      source_reports:SQLSource,
             
             # Get other variables
             date = report['reportingdate']
-            month:str = build_monthCode(date)
+            month:int = build_monthCode(date)
             reporteurid = str(report['reporteurid'])
             reporteur_class = report['reporteurclass']
-            key = (aircraft, month, reporteurid)
+            key = (keys.registration(aircraft) * MONTH_FACTOR + month) * REPORTEUR_FACTOR + keys.reporteur(reporteurid)
 
             #Add date into the months table
-            table_months.add( build_month_dimension_value(date) )
+            table_months.add( month )
 
 
             # Not all reporteurs are in the csv file. Maybe we found a new one. Also the csv doesn't tell its role
@@ -284,63 +438,212 @@ def transform_reports(      source_reports:SQLSource,
 
 
             # Add the computations to the metrics tables
-            if not key in table_reportage_usage:
-                table_reportage_usage[key] = { 'reps': 0, 'mareps': 0, 'pireps': 0 }
+            reportage_usage = table_reportage_usage.get(key)
+            if reportage_usage is None:
+                reportage_usage = table_reportage_usage[key] = ReportageUsage()
 
-            table_reportage_usage[key]['reps'] += 1
-            if reporteur_class == 'MAREP': table_reportage_usage[key]['mareps'] += 1
-            elif reporteur_class == 'PIREP': table_reportage_usage[key]['pireps'] += 1
+            reportage_usage.reps += 1
+            if reporteur_class == 'MAREP': reportage_usage.mareps += 1
+            elif reporteur_class == 'PIREP': reportage_usage.pireps += 1
         
 
-        else: #Business Rule
-            logging.info( f"Reportage BR: Had a report on aircraft {aircraft} but that aircraft isn't in our database" )
-            foreign_aircraft_reports_count += 1
+        else: #Business Rule: reports made on aircrafts that were not in our database
+            violation_log.record('Reportage BR', 'report', aircraft, report['reportingdate'])
     
-    if apply_business_rules: logging.info( f"\n\nReportage BR: There were {foreign_aircraft_reports_count}/180418 reports with aircrafts that were not in our database\n\n" )
+    if apply_business_rules: violation_log.check('Reportage BR', 'report', i+1)
+
+
+def record_excluded_reports(source_reports:Iterable[dict], violation_log:ViolationLog):
+    '''Records the reports that extract.extract_pushdown left in the source database because their aircraft is not in our
+    database, so the 'Reportage BR' rule is counted on all the reports, as when they are traversed by transform_reports'''
+    i = -1
+    for i, report in enumerate(source_reports):
+        violation_log.record('Reportage BR', 'report', report['aircraftregistration'], report['reportingdate'])
+    violation_log.check('Reportage BR', 'report', i+1)
 
 
 
 
 
 ### -------------------------------------------------------------------------------------------------- ###
-def transform( sources_extract:dict[str, CSVSource|SQLSource], apply_business_rules:bool = True) -> dict[str, list[dict]]:
+def transform_aggregated(   sources_extract:dict[str, Iterable[dict]],
+                            table_aircrafts:dict[str, dict],
+                            table_daily_usage:dict[int, DailyUsage],
+                            table_monthly_usage:dict[int, MonthlyUsage],
+                            table_reportage_usage:dict[int, ReportageUsage],
+                            table_reporteurs:dict[str, dict[str, Any]],
+                            table_days:set[int],
+                            table_months:set[int],
+                            keys:KeyDictionary
+                            ):
+
+    '''Fills the usage metrics tables from the sources that were already grouped by (aircraft, day) and (aircraft, month) in the
+    source database (see extract.extract_pushdown). Gives the same tables as transform_flights, transform_maintenances and
+    transform_reports without business rules'''
+
+    for row in tqdm( sources_extract['AIMS.flights.daily'], desc="Flights    "):
+        day:int = row['day_id']
+        table_days.add( day )
+        table_months.add( day // 100 )
+        table_daily_usage[keys.registration(row['aircraftregistration']) * DAY_FACTOR + day] = DailyUsage(row['fh'], row['tos'], row['sto'])
+
+    for row in tqdm( sources_extract['AIMS.flights.monthly'], desc="Flights    "):
+        monthly_usage = table_monthly_usage.setdefault( keys.registration(row['aircraftregistration']) * MONTH_FACTOR + row['month_id'], void_monthly_metrics() )
+        monthly_usage.dy, monthly_usage.cn, monthly_usage.dh = row['dy'], row['cn'], row['dh']
+
+    for row in tqdm( sources_extract['AIMS.maintenance.monthly'], desc="Maintenance"):
+        table_months.add( row['month_id'] )
+        monthly_usage = table_monthly_usage.setdefault( keys.registration(row['aircraftregistration']) * MONTH_FACTOR + row['month_id'], void_monthly_metrics() )
+        monthly_usage.ados, monthly_usage.adoss, monthly_usage.adosu, monthly_usage.adis = row['ados'], row['adoss'], row['adosu'], row['adis']
+
+    # Only reports on the aircrafts of the CSV were extracted
+    for row in tqdm( sources_extract['AMOS.postflightreports.monthly'], desc="Reports    "):
+        table_months.add( row['month_id'] )
+        key = (keys.registration(row['aircraftregistration']) * MONTH_FACTOR + row['month_id']) * REPORTEUR_FACTOR + keys.reporteur(str(row['reporteurid']))
+        reportage_usage = table_reportage_usage[key] = ReportageUsage()
+        reportage_usage.reps, reportage_usage.mareps, reportage_usage.pireps = row['reps'], row['mareps'], row['pireps']
+
+    for row in sources_extract['reporteur-roles']:
+        reporteurid = str(row['reporteurid'])
+        if reporteurid in table_reporteurs:
+            table_reporteurs[reporteurid]['role'] = row['reporteurclass']
+        else:
+            table_reporteurs[reporteurid] = { 'airport': None, 'role': row['reporteurclass'] }
+
+
+
+
+
+### -------------------------------------------------------------------------------------------------- ###
+def aggregate( sources_extract:dict[str, CSVSource|SQLSource], apply_business_rules:bool = True, engine:str = 'python', workers:int|None = None, keys:KeyDictionary|None = None, violation_log:ViolationLog|None = None) -> dict[str, Any]:
+    '''Traverses all the extracted sources and returns the aggregated tables, keyed by their name in the DW, and the KeyDictionary of their keys under 'keys'.
+    engine='python' traverses the flights and maintenances row by row, engine='numpy' uses the vectorized engine of transform_vectorized,
+    and engine='parallel' splits the sources by aircraft among workers processes (see transform_parallel).
+    Sources that were already aggregated in the source database (see extract.extract_pushdown) need no engine, and the reports
+    it excluded there ('AMOS.postflightreports.excluded') are only recorded as violations.
+    The violations of the business rules are recorded in violation_log (by default, that of the current run)'''
+
+    pushed_down = 'AIMS.flights.daily' in sources_extract
+    violation_log = violation_log if violation_log is not None else violations.log
+    if apply_business_rules and 'AMOS.postflightreports.excluded' in sources_extract:
+        record_excluded_reports(sources_extract['AMOS.postflightreports.excluded'], violation_log)
+    if engine == 'parallel' and not pushed_down:
+        import transform_parallel
+        return transform_parallel.aggregate_parallel(sources_extract, apply_business_rules, workers, violation_log)
+
+    keys = keys if keys is not None else KeyDictionary()
 
-    print("\n\n  --- Starting transform... ---  ")
-    
     # Those dictionaries/sets contain the values to be added into the database
-    table_days: set[tuple[str, int, str]] = set()                       # Each one is a row (day_id, day, month_id)
-    table_months: set[tuple[str, int, int]] = set()                     # Each one is a row (month_id, month, year)
+    table_days: set[int] = set()                                        # Each one is a day_id (yyyymmdd)
+    table_months: set[int] = set()                                      # Each one is a month_id (yyyymm)
     table_reporteurs: dict[str, dict] = {}                              # La clave es el reporteur_id, el valor es un diccionario con airport y role
     table_aircrafts: dict[str, dict] = {}                               # La clave es el registration, el valor es un diccionario con el modelo y el manufacturer
 
-    table_daily_usage: dict[ tuple[str, str], dict ] = {}               # La clave es la combinación (aircraft, day), el valor es un diccionario con las métricas 
-    table_monthly_usage: dict[ tuple[str, str], dict ] = {}             # La clave es la combinación (aircraft, month), el valor es un diccionario con las métricas 
-    table_reportage_usage: dict[ tuple[str, str, str], dict ] = {}      # La clave es la combinación (aircraft, day, reporteur_uid), el valor es un diccionario con las métricas 
-    br21_slots: dict[ tuple[str, str], list[Slot] ] = {}                # Sirve para comprobar que no haya dos slots superpuestos (que un avión hiciese dos cosas a la vez), es de la BR-21
+    table_daily_usage: dict[ int, DailyUsage ] = {}                     # La clave es la combinación (aircraft, day) codificada (ver KeyDictionary), el valor son las métricas
+    table_monthly_usage: dict[ int, MonthlyUsage ] = {}                 # La clave es la combinación (aircraft, month) codificada, el valor son las métricas
+    table_reportage_usage: dict[ int, ReportageUsage ] = {}             # La clave es la combinación (aircraft, month, reporteur_uid) codificada, el valor son las métricas
+    br21_slots: dict[ int, SlotIndex ] = {}                             # Sirve para comprobar que no haya dos slots superpuestos (que un avión hiciese dos cosas a la vez), es de la BR-21
 
     
     #Fill the tables with the processed data from the extraction
     fill_aircrafts(table_aircrafts, sources_extract['aircraft-manufacturer-info']) # type: ignore
     fill_reporteurs(table_reporteurs, sources_extract['maintenance-personnel']) # type: ignore
 
-    transform_flights(sources_extract['AIMS.flights'], table_daily_usage, table_monthly_usage, table_days, table_months, br21_slots, apply_business_rules)
-    transform_maintenances(sources_extract['AIMS.maintenance'], table_monthly_usage, table_months, br21_slots, apply_business_rules)
-    transform_reports(sources_extract['AMOS.postflightreports'], table_aircrafts, table_reportage_usage, table_reporteurs, table_months, apply_business_rules)
+    if pushed_down:
+        transform_aggregated(sources_extract, table_aircrafts, table_daily_usage, table_monthly_usage, table_reportage_usage, table_reporteurs, table_days, table_months, keys)
+    else:
+        if engine == 'numpy':
+            import transform_vectorized
+            transform_vectorized.transform_flights_and_maintenances(sources_extract['AIMS.flights'], sources_extract['AIMS.maintenance'], table_daily_usage, table_monthly_usage, table_days, table_months, keys, apply_business_rules, violation_log)
+        elif engine == 'python':
+            transform_flights(sources_extract['AIMS.flights'], table_daily_usage, table_monthly_usage, table_days, table_months, br21_slots, keys, apply_business_rules, violation_log)
+            transform_maintenances(sources_extract['AIMS.maintenance'], table_monthly_usage, table_months, br21_slots, keys, apply_business_rules, violation_log)
+        else:
+            raise ValueError(f"Unknown transform engine '{engine}'")
+        br21_slots.clear()  # Not needed anymore, free it before the reports
+        transform_reports(sources_extract['AMOS.postflightreports'], table_aircrafts, table_reportage_usage, table_reporteurs, table_months, keys, apply_business_rules, violation_log)
 
+    return {
+        'days': table_days,
+        'months': table_months,
+        'aircrafts': table_aircrafts,
+        'reporteurs': table_reporteurs,
+        'daily_usage': table_daily_usage,
+        'monthly_usage': table_monthly_usage,
+        'reportage_usage': table_reportage_usage,
+        'keys': keys
+    }
 
-    #Turn the dictionaries into lists. Each element of the lists is a row ready to be inserted into the data warehouse
-    transform_sources = {}
 
-    transform_sources['days'] =   [    {'day_id': row[0], 'day': row[1], 'month_id': row[2]} for row in table_days    ]
-    transform_sources['months'] = [    {'month_id': row[0], 'month': row[1], 'year': row[2]} for row in table_months    ]
-    transform_sources['aircrafts'] =        [ {'registration': key} | value        for key, value in table_aircrafts.items() ]
-    transform_sources['reporteurs'] =       [ {'reporteur_uid': key} | value      for key, value in table_reporteurs.items() ]
-    
-    transform_sources['daily_usage'] =      [ {'registration': key1, 'day_id': key2} | value                               for (key1, key2),       value in table_daily_usage.items() ]
-    transform_sources['monthly_usage'] =    [ {'registration': key1, 'month_id': key2} | value                             for (key1, key2),       value in table_monthly_usage.items() ]
-    transform_sources['reportage_usage'] =  [ {'registration': key1, 'month_id': key2, 'reporteur_uid': key3} | value      for (key1, key2, key3), value in table_reportage_usage.items() ]
+def table_rows(tables:dict[str, Any], consume:bool = False) -> dict[str, Iterator[dict]]:
+    '''Returns, for each aggregated table, an iterator over its rows ready to be inserted into the data warehouse (decoding the keys).
+    If consume is True, each element is removed from its table as soon as its row is generated'''
+
+    def items(table:set|dict) -> Iterator:
+        if not consume: return iter(table.items()) if isinstance(table, dict) else iter(table)
+        pop = table.popitem if isinstance(table, dict) else table.pop
+        return ( pop() for _ in range(len(table)) )
+
+    keys:KeyDictionary = tables['keys']
+
+    def daily_rows() -> Iterator[dict]:
+        for key, value in items(tables['daily_usage']):
+            registration, day_id = keys.decode_daily(key)
+            yield {'registration': registration, 'day_id': day_id} | value.as_dict()
+
+    def monthly_rows() -> Iterator[dict]:
+        for key, value in items(tables['monthly_usage']):
+            registration, month_id = keys.decode_monthly(key)
+            yield {'registration': registration, 'month_id': month_id} | value.as_dict()
 
+    def reportage_rows() -> Iterator[dict]:
+        for key, value in items(tables['reportage_usage']):
+            registration, month_id, reporteur_uid = keys.decode_reportage(key)
+            yield {'registration': registration, 'month_id': month_id, 'reporteur_uid': reporteur_uid} | value.as_dict()
+
+    return {
+        'days':             ( {'day_id': day, 'day': day % 100, 'month_id': day // 100}         for day in items(tables['days']) ),
+        'months':           ( {'month_id': month, 'month': month % 100, 'year': month // 100}   for month in items(tables['months']) ),
+        'aircrafts':        ( {'registration': key} | value                                     for key, value in items(tables['aircrafts']) ),
+        'reporteurs':       ( {'reporteur_uid': key} | value                                    for key, value in items(tables['reporteurs']) ),
+        'daily_usage':      daily_rows(),
+        'monthly_usage':    monthly_rows(),
+        'reportage_usage':  reportage_rows()
+    }
+
+
+
+
+
+### -------------------------------------------------------------------------------------------------- ###
+def transform( sources_extract:dict[str, CSVSource|SQLSource], apply_business_rules:bool = True, engine:str = 'python', workers:int|None = None) -> dict[str, list[dict]]:
+    '''Transforms the extracted sources into rows of the DW tables (see aggregate for the engines)'''
+
+    print("\n\n  --- Starting transform... ---  ")
+
+    violation_log = violations.start()
+    tables = aggregate(sources_extract, apply_business_rules, engine, workers, violation_log=violation_log)
+    violation_log.log_summary()
+
+    #Turn the dictionaries into lists. Each element of the lists is a row ready to be inserted into the data warehouse
+    transform_sources = { table_name: list(rows) for table_name, rows in table_rows(tables).items() }
 
     print("  --- Transform finished ---  ")
     return transform_sources
 
+
+def transform_streaming( sources_extract:dict[str, CSVSource|SQLSource], apply_business_rules:bool = True, batch_size:int = 50000) -> Iterator[tuple[str, list[dict]]]:
+    '''Streaming version of transform. Sources are consumed as they are extracted, only the aggregates are kept in memory,
+    and the rows are handed out as (table_name, batch) pairs of at most batch_size rows, freeing each aggregate once it is in a batch'''
+
+    print("\n\n  --- Starting streaming transform... ---  ")
+
+    violation_log = violations.start()
+    tables = aggregate(sources_extract, apply_business_rules, violation_log=violation_log)
+    violation_log.log_summary()
+
+    for table_name, rows in table_rows(tables, consume=True).items():
+        while batch := list(islice(rows, batch_size)):
+            yield table_name, batch
+
+    print("  --- Transform finished ---  ")
@@ -0,0 +1,300 @@
+import time
+from itertools import islice
+from typing import Iterable, Iterator
+from tqdm import tqdm
+from pygrametl.tables import CachedDimension
+from dw import DW
+
+import load
+import transform
+import violations
+from violations import ViolationLog
+
+try:
+    import pyarrow as pa  # Optional: lets DuckDB scan each staged batch as a columnar Arrow table
+except ImportError:
+    pa = None
+
+
+
+# region STAGING
+# The raw sources are copied as they are into temporary tables of the DW. seq keeps the order of each source, which the
+# business rules and the roles of the reporteurs depend on
+STAGING_TABLES = {
+    'AIMS.flights': ('raw_flights', {
+        'aircraftregistration': 'VARCHAR', 'scheduleddeparture': 'TIMESTAMP', 'scheduledarrival': 'TIMESTAMP',
+        'actualdeparture': 'TIMESTAMP', 'actualarrival': 'TIMESTAMP', 'cancelled': 'BOOLEAN' }),
+    'AIMS.maintenance': ('raw_maintenance', {
+        'aircraftregistration': 'VARCHAR', 'scheduleddeparture': 'TIMESTAMP', 'scheduledarrival': 'TIMESTAMP', 'programmed': 'BOOLEAN' }),
+    'AMOS.postflightreports': ('raw_reports', {
+        'aircraftregistration': 'VARCHAR', 'reportingdate': 'TIMESTAMP', 'reporteurid': 'VARCHAR', 'reporteurclass': 'VARCHAR' }),
+    'aircraft-manufacturer-info': ('raw_aircrafts', { 'registration': 'VARCHAR', 'model': 'VARCHAR', 'manufacturer': 'VARCHAR' }),
+    'maintenance-personnel': ('raw_personnel', { 'reporteurid': 'VARCHAR', 'airport': 'VARCHAR' })
+}
+
+
+def column_batches(source:Iterable[dict], columns:list[str], batch_size:int) -> Iterator[dict[str, list]]:
+    '''Yields the source in batches of one sequence per column. Sources that already hand out column batches
+    (see extract.ColumnarSource) are passed through without building a dict per row'''
+    if hasattr(source, 'batches'):
+        for batch in source.batches(): yield { column: batch[column] for column in columns }
+        return
+    rows = iter(source)
+    while chunk := list(islice(rows, batch_size)):
+        yield { column: [ row[column] for row in chunk ] for column in columns }
+
+
+def stage_batch(dw:DW, table_name:str, columns:list[str], batch:dict[str, list], first_seq:int) -> int:
+    '''Appends a column batch to a staging table, numbering its rows from first_seq. Returns the number of rows'''
+    rows = len(batch[columns[0]])
+    if pa is not None:
+        arrow_batch = pa.table({ 'seq': pa.array(range(first_seq, first_seq + rows), pa.int64()) } | { column: batch[column] for column in columns })
+        dw.conn_duckdb.register('stage_batch', arrow_batch)
+        try:
+            dw.conn_duckdb.execute(f'INSERT INTO {table_name} (seq, {", ".join(columns)}) SELECT seq, {", ".join(columns)} FROM stage_batch')
+        finally:
+            dw.conn_duckdb.unregister('stage_batch')
+    else:
+        load.insert_batch(dw, table_name, ['seq'] + columns, [ {'seq': first_seq + i} | { column: batch[column][i] for column in columns } for i in range(rows) ])
+    return rows
+
+
+def stage(dw:DW, sources_extract:dict[str, Iterable[dict]], batch_size:int = load.BULK_BATCH_SIZE) -> dict[str, int]:
+    '''Bulk-loads every raw source into its staging table (see STAGING_TABLES). Returns the rows staged per source'''
+
+    print("\n\n  --- Staging the sources in DuckDB... ---  ")
+    staged = {}
+    for source_name, (table_name, columns) in STAGING_TABLES.items():
+        column_definitions = ', '.join( f'{column} {column_type}' for column, column_type in columns.items() )
+        dw.conn_duckdb.execute(f'CREATE OR REPLACE TEMP TABLE {table_name} (seq BIGINT, {column_definitions})')
+        staged[source_name] = 0
+        with tqdm(desc=table_name, total=transform.source_total(sources_extract[source_name]), unit="rows") as progress:
+            for batch in column_batches(sources_extract[source_name], list(columns), batch_size):
+                rows = stage_batch(dw, table_name, list(columns), batch, staged[source_name])
+                staged[source_name] += rows
+                progress.update(rows)
+    print("  --- Staging finished ---  ")
+    return staged
+
+# endregion
+
+
+
+# region TRANSFORM
+def slot_time(column:str) -> str:
+    '''SQL equivalent of transform.slot_time'''
+    resolution = transform.BR21_RESOLUTION
+    if resolution == 3600: return f'hour({column})'
+    return f'(hour({column})*3600 + minute({column})*60 + second({column})) // {resolution} * {resolution} / 3600'
+
+
+def hours_between(start:str, end:str, unit:int = 3600) -> str:
+    '''SQL equivalent of transform.time_difference(start, end) / unit, with the same floating point result'''
+    return f'(epoch_us({end}) - epoch_us({start}))::DOUBLE / 1000000 / {unit}'
+
+
+def transform_statements(apply_business_rules:bool) -> list[str]:
+    '''Returns the statements that compute the usage metrics from the staging tables, into temporary tables named elt_<DW table>.
+    They follow transform_flights, transform_maintenances and transform_reports: float sums are ordered like the sources,
+    so they are added in the same order and give the same floats'''
+
+    statements = [f'''
+        CREATE OR REPLACE TEMP TABLE elt_flights AS
+        SELECT seq, aircraftregistration AS registration, scheduleddeparture, actualdeparture, actualarrival,
+            year(scheduleddeparture)*10000 + month(scheduleddeparture)*100 + day(scheduleddeparture) AS day_id,
+            COALESCE(cancelled, false) OR actualarrival IS NULL OR actualdeparture IS NULL AS is_cancelled,
+            {slot_time('actualdeparture')} AS slot_start, {slot_time('actualarrival')} AS slot_end,
+            {hours_between('actualdeparture', 'actualarrival')} AS flight_hours
+        FROM raw_flights''', f'''
+        CREATE OR REPLACE TEMP TABLE elt_maintenance AS
+        SELECT seq, aircraftregistration AS registration, scheduleddeparture, COALESCE(programmed, false) AS programmed,
+            year(scheduleddeparture)*10000 + month(scheduleddeparture)*100 + day(scheduleddeparture) AS day_id,
+            {slot_time('scheduleddeparture')} AS slot_start, {slot_time('scheduledarrival')} AS slot_end,
+            {hours_between('scheduleddeparture', 'scheduledarrival', 3600*24)} AS days
+        FROM raw_maintenance''',
+        # Reports on aircrafts that are not in the CSV are discarded
+        '''
+        CREATE OR REPLACE TEMP TABLE elt_reports AS
+        SELECT seq, aircraftregistration AS registration, reporteurid, reporteurclass,
+            year(reportingdate)*100 + month(reportingdate) AS month_id
+        FROM raw_reports
+        WHERE aircraftregistration IN (SELECT registration FROM raw_aircrafts)''']
+
+    if apply_business_rules:
+        # BR-21: flights that were not cancelled come first, then all maintenances, both in source order. An event is accepted
+        # unless it overlaps an event of the same (aircraft, day) accepted before it, so the events of each (aircraft, day) are
+        # walked in that order, carrying the accepted slots. All the (aircraft, day) are walked at once, one event per step
+        statements += ['''
+        CREATE OR REPLACE TEMP TABLE elt_events AS
+        SELECT kind, seq, registration, day_id, slot_start, slot_end,
+            row_number() OVER (PARTITION BY registration, day_id ORDER BY kind, seq) AS n
+        FROM (  SELECT 0 AS kind, seq, registration, day_id, slot_start, slot_end FROM elt_flights WHERE NOT is_cancelled
+                UNION ALL
+                SELECT 1 AS kind, seq, registration, day_id, slot_start, slot_end FROM elt_maintenance )''', '''
+        CREATE OR REPLACE TEMP TABLE elt_accepted AS
+        WITH RECURSIVE walk(registration, day_id, n, kind, seq, slots, accepted) AS (
+            SELECT registration, day_id, n, kind, seq, [{'s': slot_start, 'e': slot_end}], true
+            FROM elt_events WHERE n = 1
+            UNION ALL
+            SELECT registration, day_id, n, kind, seq,
+                CASE WHEN overlapping THEN slots ELSE list_append(slots, {'s': slot_start, 'e': slot_end}) END,
+                NOT overlapping
+            FROM (  SELECT e.registration, e.day_id, e.n, e.kind, e.seq, e.slot_start, e.slot_end, w.slots,
+                        COALESCE(list_bool_or(list_transform(w.slots, lambda x: x.s < e.slot_end AND e.slot_start < x.e)), false) AS overlapping
+                    FROM walk w JOIN elt_events e ON e.registration = w.registration AND e.day_id = w.day_id AND e.n = w.n + 1 )
+        )
+        SELECT kind, seq, accepted FROM walk''']
+        flight_accepted = 'COALESCE((SELECT accepted FROM elt_accepted a WHERE a.kind = 0 AND a.seq = f.seq), true)'
+        maintenance_accepted = '(SELECT accepted FROM elt_accepted a WHERE a.kind = 1 AND a.seq = m.seq)'
+        swapped = 'counted AND flight_hours < 0'  # BR-23
+    else:
+        flight_accepted, maintenance_accepted, swapped = 'true', 'true', 'false'
+
+    statements += [f'''
+        CREATE OR REPLACE TEMP TABLE elt_flight_metrics AS
+        SELECT *, counted AND {hours_between('scheduleddeparture', 'departure')} > 15/60 AS delayed,
+            {hours_between('scheduleddeparture', 'departure')} AS delay_hours
+        FROM (  SELECT *,
+                    CASE WHEN swapped THEN -flight_hours ELSE flight_hours END AS fh,
+                    CASE WHEN swapped THEN actualarrival ELSE actualdeparture END AS departure
+                FROM (  SELECT *, {swapped} AS swapped
+                        FROM (SELECT f.*, NOT f.is_cancelled AND {flight_accepted} AS counted FROM elt_flights f) ) )''', f'''
+        CREATE OR REPLACE TEMP TABLE elt_maintenance_metrics AS
+        SELECT m.* FROM elt_maintenance m WHERE {maintenance_accepted}''', '''
+        CREATE OR REPLACE TEMP TABLE elt_days AS
+        SELECT DISTINCT day_id, day_id % 100 AS day, day_id // 100 AS month_id FROM elt_flights''', '''
+        CREATE OR REPLACE TEMP TABLE elt_months AS
+        SELECT DISTINCT month_id, month_id % 100 AS month, month_id // 100 AS year
+        FROM (  SELECT day_id // 100 AS month_id FROM elt_flights
+                UNION SELECT day_id // 100 FROM elt_maintenance
+                UNION SELECT month_id FROM elt_reports )''',
+        # Later rows of the CSVs replace earlier ones with the same key, and the role of a reporteur is the class of its last report
+        '''
+        CREATE OR REPLACE TEMP TABLE elt_aircrafts AS
+        SELECT registration, arg_max_null(model, seq) AS model, arg_max_null(manufacturer, seq) AS manufacturer
+        FROM raw_aircrafts GROUP BY registration''', '''
+        CREATE OR REPLACE TEMP TABLE elt_reporteurs AS
+        SELECT COALESCE(p.reporteurid, r.reporteurid) AS reporteur_uid, p.airport, r.role
+        FROM (SELECT trim(reporteurid) AS reporteurid, arg_max_null(airport, seq) AS airport FROM raw_personnel GROUP BY 1) p
+            FULL OUTER JOIN (SELECT reporteurid, arg_max_null(reporteurclass, seq) AS role FROM elt_reports GROUP BY 1) r
+            ON p.reporteurid = r.reporteurid''',
+        # Every flight creates its (aircraft, day), but only the flights that were counted add to it
+        '''
+        CREATE OR REPLACE TEMP TABLE elt_daily_usage AS
+        SELECT registration, day_id,
+            COALESCE(sum(fh ORDER BY seq) FILTER (WHERE counted), 0) AS fh,
+            count(*) FILTER (WHERE counted) AS tos,
+            count(*) FILTER (WHERE counted OR is_cancelled) AS sto
+        FROM elt_flight_metrics GROUP BY registration, day_id''',
+        # Every flight creates its (aircraft, month), but only maintenances that were not ignored do.
+        # adis starts at its default value and every maintenance is subtracted in order, like MonthlyUsage does
+        f'''
+        CREATE OR REPLACE TEMP TABLE elt_monthly_usage AS
+        WITH flights AS (
+                SELECT registration, day_id // 100 AS month_id,
+                    count(*) FILTER (WHERE delayed) AS dy,
+                    count(*) FILTER (WHERE is_cancelled) AS cn,
+                    COALESCE(sum(delay_hours ORDER BY seq) FILTER (WHERE delayed), 0) AS dh
+                FROM elt_flight_metrics GROUP BY 1, 2),
+            maintenances AS (
+                SELECT registration, day_id // 100 AS month_id,
+                    sum(days ORDER BY seq) AS ados,
+                    COALESCE(sum(days ORDER BY seq) FILTER (WHERE programmed), 0) AS adoss,
+                    COALESCE(sum(days ORDER BY seq) FILTER (WHERE NOT programmed), 0) AS adosu,
+                    list_reduce(list_prepend({transform.void_monthly_metrics().adis!r}::DOUBLE, list(days ORDER BY seq)), lambda a, b: a - b) AS adis
+                FROM elt_maintenance_metrics GROUP BY 1, 2)
+        SELECT COALESCE(f.registration, m.registration) AS registration, COALESCE(f.month_id, m.month_id) AS month_id,
+            COALESCE(f.dy, 0) AS dy, COALESCE(f.cn, 0) AS cn, COALESCE(f.dh, 0) AS dh,
+            COALESCE(m.ados, 0) AS ados, COALESCE(m.adoss, 0) AS adoss, COALESCE(m.adosu, 0) AS adosu,
+            COALESCE(m.adis, {transform.void_monthly_metrics().adis!r}) AS adis
+        FROM flights f FULL OUTER JOIN maintenances m ON f.registration = m.registration AND f.month_id = m.month_id''', '''
+        CREATE OR REPLACE TEMP TABLE elt_reportage_usage AS
+        SELECT registration, month_id, reporteurid AS reporteur_uid,
+            count(*) AS reps,
+            count(*) FILTER (WHERE reporteurclass = 'MAREP') AS mareps,
+            count(*) FILTER (WHERE reporteurclass = 'PIREP') AS pireps
+        FROM elt_reports GROUP BY 1, 2, 3''']
+    return statements
+
+
+def record_violations(dw:DW, apply_business_rules:bool, violation_log:ViolationLog):
+    '''Records the violations of the business rules in violation_log, like the other engines do'''
+    violating = {
+        'Reportage BR': "SELECT 'report', aircraftregistration, reportingdate, NULL, NULL FROM raw_reports WHERE seq NOT IN (SELECT seq FROM elt_reports) ORDER BY seq"
+    }
+    if apply_business_rules:
+        violating['BR-21'] = '''
+            SELECT CASE kind WHEN 0 THEN 'flight' ELSE 'maintenance' END, registration, day, slot_start, slot_end
+            FROM elt_accepted a JOIN (  SELECT 0 AS kind, seq, registration, scheduleddeparture AS day, slot_start, slot_end FROM elt_flights
+                                        UNION ALL
+                                        SELECT 1, seq, registration, scheduleddeparture, slot_start, slot_end FROM elt_maintenance ) e USING (kind, seq)
+            WHERE NOT a.accepted ORDER BY kind, seq'''
+        violating['BR-23'] = "SELECT 'flight', registration, scheduleddeparture, NULL, NULL FROM elt_flight_metrics WHERE swapped ORDER BY seq"
+    for rule, query in violating.items():
+        for event, aircraft, date, slot_start, slot_end in dw.conn_duckdb.execute(query).fetchall():
+            violation_log.record(rule, event, aircraft, date, (slot_start, slot_end) if slot_start is not None else None)
+
+    if apply_business_rules:
+        checked = dw.conn_duckdb.execute('''
+            SELECT (SELECT count(*) FROM elt_flights WHERE NOT is_cancelled), (SELECT count(*) FROM elt_maintenance),
+                   (SELECT count(*) FROM elt_flights), (SELECT count(*) FROM raw_reports)''').fetchone()
+        for (rule, event), events in zip([('BR-21', 'flight'), ('BR-21', 'maintenance'), ('BR-23', 'flight'), ('Reportage BR', 'report')], checked):
+            violation_log.check(rule, event, events)
+
+
+def transform_staged(dw:DW, apply_business_rules:bool = True):
+    '''ELT equivalent of transform.transform: computes the rows of the DW tables from the staging tables (see stage) with
+    set-based SQL, into the elt_<table> temporary tables that load_transformed inserts'''
+
+    print("\n\n  --- Starting transform in DuckDB... ---  ")
+    for statement in transform_statements(apply_business_rules):
+        dw.conn_duckdb.execute(statement)
+    violation_log = violations.start()
+    record_violations(dw, apply_business_rules, violation_log)
+    violation_log.log_summary()
+    print("  --- Transform finished ---  ")
+
+# endregion
+
+
+
+# region LOAD
+def dimension_keys(dw:DW) -> dict[str, str]:
+    '''Returns the dimension table referenced by each foreign key column of the facts'''
+    return { table.key: table.name for table in dw.tables_dict.values() if isinstance(table, CachedDimension) }
+
+
+def load_transformed(dw:DW) -> dict[str, dict]:
+    '''ELT equivalent of load.load: inserts the result of transform_staged with INSERT ... SELECT. Like bulk_load, the rows that
+    would break a foreign key are not inserted, and are returned in the report. As the last step, the KPI rollups are refreshed'''
+
+    print("\n\n  --- Starting load... ---  ")
+    dw.invalidate_rollups()
+    dw.bump_data_version()
+    references = dimension_keys(dw)
+    report: dict[str, dict] = {}
+    for table_name, table_obj in dw.tables_dict.items():
+        start = time.perf_counter()
+        columns = ', '.join(table_obj.all)
+        keys_exist = ' AND '.join( f'{key} IN (SELECT {key} FROM {references[key]})' for key in getattr(table_obj, 'keyrefs', []) ) or 'true'
+        rows = dw.conn_duckdb.execute(f'SELECT count(*) FROM elt_{table_name}').fetchone()[0]
+        dw.conn_duckdb.execute(f'INSERT INTO {table_obj.name} ({columns}) SELECT {columns} FROM elt_{table_name} WHERE {keys_exist}')
+        cursor = dw.conn_duckdb.execute(f'SELECT {columns} FROM elt_{table_name} WHERE NOT ({keys_exist})')
+        rejected = [ {'row': dict(zip(table_obj.all, row)), 'error': "Violates a foreign key"} for row in cursor.fetchall() ]
+        report[table_name] = { 'rows': rows, 'inserted': rows - len(rejected), 'rejected': rejected, 'seconds': time.perf_counter() - start }
+
+        if rejected:
+            print(f"{len(rejected)}/{rows} rows from {table_name} were rejected. First one: {rejected[0]['row']}")
+        print(f"{rows - len(rejected)} elements from {table_name} inserted into the database")
+
+    for table_name in [ f'elt_{table_name}' for table_name in dw.tables_dict ] + ['elt_flights', 'elt_maintenance', 'elt_reports', 'elt_events', 'elt_accepted', 'elt_flight_metrics', 'elt_maintenance_metrics']:
+        dw.conn_duckdb.execute(f'DROP TABLE IF EXISTS {table_name}')
+    for table_name, _ in STAGING_TABLES.values():
+        dw.conn_duckdb.execute(f'DROP TABLE IF EXISTS {table_name}')
+
+    print("  --- Loading finished ---  ")
+    dw.conn_duckdb.commit()
+    load.refresh_rollups(dw)
+    return report
+
+# endregion
@@ -0,0 +1,133 @@
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+from pygrametl.datasources import CSVSource, SQLSource
+
+import transform
+import violations
+from violations import ViolationLog
+
+
+
+# Shards of the sources, set before the workers are forked so they inherit them instead of receiving them pickled
+shards: list[dict[str, list]] = []
+
+
+def partition(sources_extract:dict[str, CSVSource|SQLSource], workers:int, keys:transform.KeyDictionary) -> list[dict[str, list]]:
+    '''Hash-partitions the flights, maintenances and reports by aircraft registration. Every shard keeps the rows in source order,
+    and the reports also keep their position in the source, to know which report of each reporteur was the last one.
+    Registrations and reporteurs are encoded in keys on the way, so all the shards build their aggregation keys with the same codes'''
+
+    shard_list = [ {'AIMS.flights': [], 'AIMS.maintenance': [], 'AMOS.postflightreports': [], 'report_positions': []} for _ in range(workers) ]
+    shard_of: dict[str, int] = {}
+
+    def shard_for(registration:str) -> dict[str, list]:
+        if registration not in shard_of:
+            shard_of[registration] = zlib.crc32(str(registration).encode()) % workers
+            keys.registration(registration)
+        return shard_list[shard_of[registration]]
+
+    for table in ['AIMS.flights', 'AIMS.maintenance']:
+        for row in sources_extract[table]:
+            shard_for(row['aircraftregistration'])[table].append(row)
+
+    for position, row in enumerate(sources_extract['AMOS.postflightreports']):
+        shard = shard_for(row['aircraftregistration'])
+        shard['AMOS.postflightreports'].append(row)
+        shard['report_positions'].append(position)
+        keys.reporteur(str(row['reporteurid']))
+
+    return shard_list
+
+
+def aggregate_shard(shard_index:int, aircrafts:list[dict], apply_business_rules:bool, keys:transform.KeyDictionary, shard:dict[str, list]|None = None) -> dict[str, Any]:
+    '''Runs transform.aggregate on one shard. Besides the partial tables, returns for each reporteur the position
+    of its first and last report in the source and the class of the last one, and the violations of the business rules found in the shard'''
+
+    shard = shard if shard is not None else shards[shard_index]
+    violation_log = ViolationLog(seed=shard_index)
+    tables = transform.aggregate({
+        'AIMS.flights': shard['AIMS.flights'],
+        'AIMS.maintenance': shard['AIMS.maintenance'],
+        'AMOS.postflightreports': shard['AMOS.postflightreports'],
+        'aircraft-manufacturer-info': aircrafts,
+        'maintenance-personnel': []
+    }, apply_business_rules, keys=keys, violation_log=violation_log)
+
+    tables.pop('keys')
+    known_aircrafts = tables.pop('aircrafts')
+    tables.pop('reporteurs')
+    reporteur_reports: dict[str, list] = {}
+    for position, report in zip(shard['report_positions'], shard['AMOS.postflightreports']):
+        if report['aircraftregistration'] not in known_aircrafts: continue
+        reporteurid = str(report['reporteurid'])
+        if reporteurid in reporteur_reports:
+            reporteur_reports[reporteurid][1:] = [position, report['reporteurclass']]
+        else:
+            reporteur_reports[reporteurid] = [position, position, report['reporteurclass']]
+    tables['reporteur_reports'] = reporteur_reports
+    tables['violations'] = violation_log
+    return tables
+
+
+def aggregate_parallel(sources_extract:dict[str, CSVSource|SQLSource], apply_business_rules:bool = True, workers:int|None = None, violation_log:ViolationLog|None = None) -> dict[str, Any]:
+    '''Parallel equivalent of transform.aggregate. All its state is keyed by aircraft, so the sources are partitioned by aircraft
+    and each partition is aggregated by a different process. The partial tables are disjoint and are merged into the same
+    tables as the serial path (only the reporteurs, which are not per aircraft, need to be reconciled)'''
+
+    global shards
+    workers = workers or os.cpu_count() or 1
+    violation_log = violation_log if violation_log is not None else violations.log
+
+    table_aircrafts: dict[str, dict] = {}
+    table_reporteurs: dict[str, dict] = {}
+    transform.fill_aircrafts(table_aircrafts, sources_extract['aircraft-manufacturer-info']) # type: ignore
+    transform.fill_reporteurs(table_reporteurs, sources_extract['maintenance-personnel']) # type: ignore
+    aircrafts = [ {'registration': registration} | value for registration, value in table_aircrafts.items() ]
+
+    keys = transform.KeyDictionary()
+    shards = partition(sources_extract, workers, keys)
+    forked = 'fork' in multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if forked else None)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [ executor.submit(aggregate_shard, i, aircrafts, apply_business_rules, keys, None if forked else shards[i]) for i in range(workers) ]
+            partials = [ future.result() for future in futures ]
+    finally:
+        shards = []
+
+    tables: dict[str, Any] = {
+        'days': set(),
+        'months': set(),
+        'aircrafts': table_aircrafts,
+        'reporteurs': table_reporteurs,
+        'daily_usage': {},
+        'monthly_usage': {},
+        'reportage_usage': {},
+        'keys': keys
+    }
+    reporteur_reports: dict[str, list] = {}
+    for partial in partials:
+        tables['days'] |= partial['days']
+        tables['months'] |= partial['months']
+        violation_log.merge(partial['violations'])
+        for name in ['daily_usage', 'monthly_usage', 'reportage_usage']:
+            tables[name].update(partial[name])
+        for reporteurid, (first, last, reporteur_class) in partial['reporteur_reports'].items():
+            if reporteurid not in reporteur_reports:
+                reporteur_reports[reporteurid] = [first, last, reporteur_class]
+            else:
+                merged = reporteur_reports[reporteurid]
+                merged[0] = min(merged[0], first)
+                if last > merged[1]: merged[1:] = [last, reporteur_class]
+
+    # The role of a reporteur is the class of its last report, and new reporteurs are added in order of their first report
+    for reporteurid, (_, _, reporteur_class) in sorted(reporteur_reports.items(), key=lambda item: item[1][0]):
+        if reporteurid in table_reporteurs:
+            table_reporteurs[reporteurid]['role'] = reporteur_class
+        else:
+            table_reporteurs[reporteurid] = { 'airport': None, 'role': reporteur_class }
+
+    return tables
@@ -0,0 +1,275 @@
+import numpy as np
+from datetime import datetime, timedelta
+from operator import itemgetter
+from typing import Any, Iterable
+from tqdm import tqdm
+from pygrametl.datasources import SQLSource
+
+import transform
+import violations
+from transform import DAY_FACTOR, MONTH_FACTOR, DailyUsage, KeyDictionary, MonthlyUsage, void_monthly_metrics
+from violations import ViolationLog
+
+try:
+    import pyarrow as pa  # Optional: converts datetime objects to arrays faster than numpy
+except ImportError:
+    pa = None
+
+
+
+# region COLUMN ARRAYS
+
+def to_columns(source:Iterable[dict], columns:list[str], desc:str) -> dict[str, list]:
+    '''Traverses a source once and returns one list per column. Sources that already hand out column batches
+    (see extract.ColumnarSource) are concatenated without building a dict per row'''
+    if hasattr(source, 'batches'):
+        lists: dict[str, list] = { column: [] for column in columns }
+        with tqdm(desc=desc, total=transform.source_total(source), unit="rows") as progress:
+            for batch in source.batches():
+                for column in columns: lists[column].append(batch[column])
+                progress.update(len(batch[columns[0]]))
+        return { column: np.concatenate(chunks) if chunks and isinstance(chunks[0], np.ndarray) else [ value for chunk in chunks for value in chunk ]
+                 for column, chunks in lists.items() }
+
+    rows = list(map( itemgetter(*columns), tqdm(source, desc=desc, total=transform.source_total(source)) ))
+    if not rows: return { column: [] for column in columns }
+    return dict(zip( columns, map(list, zip(*rows)) ))
+
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+NAT = np.iinfo(np.int64).min
+
+def to_datetimes(values:list|np.ndarray) -> np.ndarray:
+    '''Converts a list of datetimes (or None) into a datetime64[us] array (None becomes NaT).
+    Goes through Arrow or integer microseconds because np.array is much slower converting datetime objects'''
+    if isinstance(values, np.ndarray): return values.astype('datetime64[us]')
+    if pa is not None:
+        return pa.array(values, pa.timestamp('us')).to_numpy(zero_copy_only=False).astype('datetime64[us]')
+    return np.fromiter( ((v - EPOCH) // MICROSECOND if v is not None else NAT for v in values), dtype=np.int64, count=len(values) ).view('datetime64[us]')
+
+
+def to_booleans(values:list|np.ndarray) -> np.ndarray:
+    '''Converts a list or array of booleans (or None, which counts as False) into a bool array'''
+    return np.array(values, dtype=object).astype(bool) if not isinstance(values, np.ndarray) or values.dtype == object else values.astype(bool)
+
+
+def seconds_between(start:np.ndarray, end:np.ndarray) -> np.ndarray:
+    '''Vectorized equivalent of transform.time_difference'''
+    return (end - start).astype(np.int64) / 1e6
+
+
+def date_parts(dates:np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''Returns the year, month and day of every element of a datetime64 array'''
+    months = dates.astype('datetime64[M]')
+    year = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+    month = months.astype(np.int64) % 12 + 1
+    day = (dates.astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64) + 1
+    return year, month, day
+
+
+def slot_times(dates:np.ndarray) -> np.ndarray:
+    '''Vectorized equivalent of transform.slot_time (time of the day in hours, truncated to transform.BR21_RESOLUTION)'''
+    seconds = (dates - dates.astype('datetime64[D]')).astype('timedelta64[s]').astype(np.int64)
+    resolution = transform.BR21_RESOLUTION
+    if resolution == 3600: return seconds // 3600
+    return seconds // resolution * resolution / 3600
+
+# endregion
+
+
+
+# region KEYS
+
+class KeyEncoder:
+    '''Assigns consecutive integer codes to group keys, keeping the order in which they are first seen (like a dict does)'''
+
+    def __init__(self):
+        self.codes: dict[Any, int] = {}
+
+    def encode(self, keys:np.ndarray) -> np.ndarray:
+        '''Returns the code of every key of an int64 array, registering the unseen ones in order of first appearance'''
+        uniques, first_index, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        codes = np.empty(len(uniques), dtype=np.int64)
+        for u in np.argsort(first_index, kind='stable'):
+            codes[u] = self.codes.setdefault(int(uniques[u]), len(self.codes))
+        return codes[inverse.reshape(-1)]
+
+
+def registration_codes(registrations:list[str], keys:KeyDictionary) -> np.ndarray:
+    '''Dictionary-encodes the registrations with the codes of the row by row engine'''
+    return np.fromiter( (keys.registration(r) for r in registrations), dtype=np.int64, count=len(registrations) )
+
+
+def daily_key(registration:np.ndarray, year:np.ndarray, month:np.ndarray, day:np.ndarray) -> np.ndarray:
+    return registration * DAY_FACTOR + year * 10000 + month * 100 + day
+
+
+def monthly_key(registration:np.ndarray, year:np.ndarray, month:np.ndarray) -> np.ndarray:
+    return registration * MONTH_FACTOR + year * 100 + month
+
+# endregion
+
+
+
+# region BR-21
+
+def br21_accepted(keys:np.ndarray, starts:np.ndarray, ends:np.ndarray) -> np.ndarray:
+    '''Vectorized BR-21. Events are given in processing order, and one is accepted unless it overlaps an event
+    of the same (aircraft, day) that was accepted before it. Returns the boolean mask of accepted events'''
+
+    n = len(keys)
+    accepted = np.ones(n, dtype=bool)
+    if n == 0: return accepted
+
+    # Sort by key (stable, so the processing order is kept inside each group) and build every (earlier, later) pair of each group
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    group_start = np.r_[0, np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1]
+    group_size = np.diff(np.r_[group_start, n])
+    position = np.arange(n) - np.repeat(group_start, group_size)    # Position of each event inside its group
+
+    earlier, later = [], []
+    for offset in range(1, int(group_size.max())):
+        has_pair = position >= offset
+        later.append( np.flatnonzero(has_pair) )
+        earlier.append( later[-1] - offset )
+    if not earlier: return accepted
+    earlier_sorted, later_sorted = np.concatenate(earlier), np.concatenate(later)
+    i, j = order[earlier_sorted], order[later_sorted]
+
+    conflict = (starts[i] < ends[j]) & (starts[j] < ends[i])
+    i, j = i[conflict], j[conflict]
+
+    # Only events that overlap an earlier one need to be resolved one by one, in processing order
+    predecessors: dict[int, list[int]] = {}
+    for a, b in zip(i.tolist(), j.tolist()): predecessors.setdefault(b, []).append(a)
+    for b in sorted(predecessors):
+        accepted[b] = not any( accepted[a] for a in predecessors[b] )
+    return accepted
+
+# endregion
+
+
+
+def record_violations(violation_log:ViolationLog, rule:str, event:str, registrations:list|np.ndarray, dates:np.ndarray, violated:np.ndarray,
+                      starts:np.ndarray|None = None, ends:np.ndarray|None = None):
+    '''Records the events of a boolean mask in violation_log, in source order. Violations are rare, so this loop is short'''
+    for index in np.flatnonzero(violated).tolist():
+        slot = (starts[index].item(), ends[index].item()) if starts is not None else None
+        violation_log.record(rule, event, registrations[index], dates[index].item(), slot)
+
+
+def transform_flights_and_maintenances(     source_flights:SQLSource,
+                                            source_maintenances:SQLSource,
+                                            table_daily_usage:dict[int, DailyUsage],
+                                            table_monthly_usage:dict[int, MonthlyUsage],
+                                            table_days:set[int],
+                                            table_months:set[int],
+                                            keys:KeyDictionary,
+                                            apply_business_rules:bool = True,
+                                            violation_log:ViolationLog|None = None
+                                            ):
+
+    '''Vectorized equivalent of transform.transform_flights followed by transform.transform_maintenances.
+    Loads both sources into column arrays, computes the metrics of every event at once and aggregates them by
+    (aircraft, day) and (aircraft, month). Fills the same tables, with the same rows, as the row by row engine'''
+
+    violation_log = violation_log if violation_log is not None else violations.log
+    flights = to_columns(source_flights, ['aircraftregistration', 'scheduleddeparture', 'scheduledarrival', 'actualdeparture', 'actualarrival', 'cancelled'], "Flights    ")
+    maintenances = to_columns(source_maintenances, ['aircraftregistration', 'scheduleddeparture', 'scheduledarrival', 'programmed'], "Maintenance")
+
+    f_reg = registration_codes(flights['aircraftregistration'], keys)
+    m_reg = registration_codes(maintenances['aircraftregistration'], keys)
+
+    # Flight variables
+    f_sched_dep = to_datetimes(flights['scheduleddeparture'])
+    f_sched_arr = to_datetimes(flights['scheduledarrival'])
+    f_act_dep = to_datetimes(flights['actualdeparture'])
+    f_act_arr = to_datetimes(flights['actualarrival'])
+    f_cancelled = to_booleans(flights['cancelled']) | np.isnat(f_act_dep) | np.isnat(f_act_arr)
+    f_year, f_month, f_day = date_parts(f_sched_dep)
+    f_daily = daily_key(f_reg, f_year, f_month, f_day)
+    f_monthly = monthly_key(f_reg, f_year, f_month)
+
+    # Maintenance variables
+    m_sched_dep = to_datetimes(maintenances['scheduleddeparture'])
+    m_sched_arr = to_datetimes(maintenances['scheduledarrival'])
+    m_programmed = to_booleans(maintenances['programmed'])
+    m_year, m_month, m_day = date_parts(m_sched_dep)
+    m_monthly = monthly_key(m_reg, m_year, m_month)
+
+    # BR-21: flights that were not cancelled come first, then all maintenances, both in source order
+    f_ignored = np.zeros(len(f_reg), dtype=bool)
+    m_ignored = np.zeros(len(m_reg), dtype=bool)
+    if apply_business_rules:
+        flying = np.flatnonzero(~f_cancelled)
+        f_starts, f_ends = slot_times(f_act_dep), slot_times(f_act_arr)
+        m_starts, m_ends = slot_times(m_sched_dep), slot_times(m_sched_arr)
+        accepted = br21_accepted(
+            np.r_[ f_daily[flying], daily_key(m_reg, m_year, m_month, m_day) ],
+            np.r_[ f_starts[flying], m_starts ],
+            np.r_[ f_ends[flying], m_ends ]
+        )
+        f_ignored[flying] = ~accepted[:len(flying)]
+        m_ignored = ~accepted[len(flying):]
+        record_violations(violation_log, 'BR-21', 'flight', flights['aircraftregistration'], f_sched_dep, f_ignored, f_starts, f_ends)
+        record_violations(violation_log, 'BR-21', 'maintenance', maintenances['aircraftregistration'], m_sched_dep, m_ignored, m_starts, m_ends)
+        violation_log.check('BR-21', 'flight', len(flying))
+        violation_log.check('BR-21', 'maintenance', len(m_reg))
+
+    # Flight metrics (BR-23 swaps arrival and departure when the flight hours are negative)
+    counted = ~f_cancelled & ~f_ignored
+    departure = f_act_dep.copy()
+    flight_hours = seconds_between(f_act_dep, f_act_arr) / 3600
+    if apply_business_rules:
+        swapped = counted & (flight_hours < 0)
+        departure[swapped] = f_act_arr[swapped]
+        flight_hours[swapped] = seconds_between(departure[swapped], f_act_dep[swapped]) / 3600
+        record_violations(violation_log, 'BR-23', 'flight', flights['aircraftregistration'], f_sched_dep, swapped)
+        violation_log.check('BR-23', 'flight', len(f_reg))
+    delay_hours = seconds_between(f_sched_dep, departure) / 3600
+    delayed = counted & (delay_hours > 15/60)
+
+    # Maintenance metrics (in days)
+    m_counted = ~m_ignored
+    maintenance_time = seconds_between(m_sched_dep, m_sched_arr) / (3600*24)
+
+    # Aggregation by (aircraft, day)
+    daily_encoder = KeyEncoder()
+    d_code = daily_encoder.encode(f_daily)
+    n_daily = len(daily_encoder.codes)
+    fh = np.bincount(d_code[counted], weights=flight_hours[counted], minlength=n_daily)
+    tos = np.bincount(d_code[counted], minlength=n_daily)
+    sto = np.bincount(d_code[f_cancelled | counted], minlength=n_daily)
+
+    for code, key in enumerate(daily_encoder.codes):
+        table_daily_usage[key] = DailyUsage( float(fh[code]), int(tos[code]), int(sto[code]) )
+        table_days.add( key % DAY_FACTOR )
+
+    # Aggregation by (aircraft, month). Every flight creates its key, but only maintenances that were not ignored do
+    monthly_encoder = KeyEncoder()
+    f_code = monthly_encoder.encode(f_monthly)
+    m_code = monthly_encoder.encode(m_monthly[m_counted])
+    n_monthly = len(monthly_encoder.codes)
+    dy = np.bincount(f_code[delayed], minlength=n_monthly)
+    cn = np.bincount(f_code[f_cancelled], minlength=n_monthly)
+    dh = np.bincount(f_code[delayed], weights=delay_hours[delayed], minlength=n_monthly)
+    ados = np.bincount(m_code, weights=maintenance_time[m_counted], minlength=n_monthly)
+    adoss = np.bincount(m_code, weights=np.where(m_programmed, maintenance_time, 0)[m_counted], minlength=n_monthly)
+    adosu = np.bincount(m_code, weights=np.where(m_programmed, 0, maintenance_time)[m_counted], minlength=n_monthly)
+    # adis starts at its default value and every maintenance is subtracted in order, so the floats match the loop exactly
+    adis = np.bincount( np.r_[np.arange(n_monthly), m_code], weights=np.r_[np.full(n_monthly, void_monthly_metrics().adis), -maintenance_time[m_counted]], minlength=n_monthly )
+
+    for code, key in enumerate(monthly_encoder.codes):
+        metrics = table_monthly_usage[key] = void_monthly_metrics()
+        metrics.dy += int(dy[code])
+        metrics.cn += int(cn[code])
+        metrics.dh += float(dh[code])
+        metrics.ados += float(ados[code])
+        metrics.adoss += float(adoss[code])
+        metrics.adosu += float(adosu[code])
+        metrics.adis = float(adis[code])
+
+    # Every flight and maintenance adds its month, even if it was ignored
+    table_months.update( np.unique(np.r_[f_year, m_year] * 100 + np.r_[f_month, m_month]).tolist() )
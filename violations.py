@@ -0,0 +1,135 @@
+import atexit
+import csv
+import heapq
+import json
+import logging
+import os
+import queue
+import random
+from collections import Counter
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import pyarrow as pa  # Optional: writes the violation file in the Arrow IPC format instead of CSV
+except ImportError:
+    pa = None
+
+
+
+# region LOGGING
+def queue_logging(filename:str, level:int = logging.INFO, format:str = '%(message)s') -> QueueListener|None:
+    '''Like logging.basicConfig(filename=...), but the records are put in a queue and written to the file by a background
+    thread, so logging never waits for the disk. Does nothing if the root logger already has handlers'''
+    root = logging.getLogger()
+    if root.handlers: return None
+    handler = logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter(format))
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)  # Writes what is left in the queue
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+    return listener
+
+# endregion
+
+
+
+# region VIOLATIONS
+# The business rules don't log every event they discard or correct. They count them, per rule and kind of event, and keep a
+# uniform sample of at most sample_size examples of each, which are written to a file at the end of the run (see ViolationLog.write)
+
+RULES = {
+    'BR-21': "overlapped an existing slot and were ignored",
+    'BR-23': "had arrival and departure times swapped",
+    'Reportage BR': "were on aircrafts that are not in our database"
+}
+COLUMNS = ['rule', 'event', 'aircraft', 'date', 'slot_start', 'slot_end']
+FILENAME = 'cleaning_violations.arrow' if pa is not None else 'cleaning_violations.csv'
+sample_size = int(os.environ.get('ETL_VIOLATION_SAMPLES', 1000))
+
+
+class ViolationLog:
+    '''Exact counts of the violations of the business rules, and a sample of them. Each example gets a random priority and
+    only the sample_size lowest ones are kept (in a heap), so the sample is uniform and samples of different logs can be merged'''
+
+    def __init__(self, sample_size:int = sample_size, seed:int = 0):
+        self.sample_size = sample_size
+        self.random = random.Random(seed).random
+        self.counts: Counter[tuple[str, str]] = Counter()    # (rule, event) -> violations
+        self.checked: Counter[tuple[str, str]] = Counter()   # (rule, event) -> events the rule was checked on
+        self.samples: dict[tuple[str, str], list[tuple]] = {}
+
+    def record(self, rule:str, event:str, aircraft:str, date:datetime, slot:tuple[float, float]|None = None):
+        '''Counts a violation and maybe keeps it as an example. Nothing is formatted here, it's called in the inner loops'''
+        key = (rule, event)
+        self.counts[key] += 1
+        if not self.sample_size: return
+        samples = self.samples.get(key)
+        if samples is None: samples = self.samples[key] = []
+        priority = self.random()
+        example = (-priority, self.counts[key], aircraft, date, slot)  # The count breaks the (unlikely) ties
+        if len(samples) < self.sample_size: heapq.heappush(samples, example)
+        elif priority < -samples[0][0]: heapq.heapreplace(samples, example)
+
+    def check(self, rule:str, event:str, events:int):
+        '''Counts the events a rule was checked on, for the summary'''
+        self.checked[(rule, event)] += events
+
+    def merge(self, other:'ViolationLog'):
+        '''Adds the counts and the examples of another log (e.g. of a worker process) to this one'''
+        self.counts.update(other.counts)
+        self.checked.update(other.checked)
+        for key, examples in other.samples.items():
+            self.samples[key] = heapq.nlargest(self.sample_size, self.samples.get(key, []) + examples)
+            heapq.heapify(self.samples[key])
+
+    def examples(self) -> list[tuple]:
+        '''The sampled examples, as rows of COLUMNS'''
+        rows = []
+        for (rule, event), samples in sorted(self.samples.items()):
+            for _, _, aircraft, date, slot in sorted(samples, key=lambda example: example[1]):
+                slot_start, slot_end = slot if slot is not None else (None, None)
+                rows.append( (rule, event, aircraft, date, slot_start, slot_end) )
+        return rows
+
+    def summary(self) -> list[str]:
+        return [ f"{rule}: {self.counts[(rule, event)]}/{events} {event}s {RULES.get(rule, 'violated the rule')}"
+                 for (rule, event), events in sorted(self.checked.items()) ]
+
+    def log_summary(self):
+        for line in self.summary(): logging.info(line)
+
+    def write(self, path:str):
+        '''Writes the examples to path, in the Arrow IPC format (with the exact counts in the schema metadata) or,
+        without pyarrow, as CSV. The file is replaced atomically'''
+        temporary = f"{path}.tmp"
+        rows = self.examples()
+        if pa is not None:
+            counts = { f"{rule}/{event}": {'violations': self.counts[(rule, event)], 'checked': self.checked.get((rule, event))}
+                       for rule, event in self.counts.keys() | self.checked.keys() }
+            schema = pa.schema([('rule', pa.string()), ('event', pa.string()), ('aircraft', pa.string()), ('date', pa.timestamp('us')),
+                                ('slot_start', pa.float64()), ('slot_end', pa.float64())], metadata={'counts': json.dumps(counts)})
+            table = pa.Table.from_pydict({ column: [ row[i] for row in rows ] for i, column in enumerate(COLUMNS) }, schema=schema)
+            with pa.OSFile(temporary, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+                writer.write_table(table)
+        else:
+            with open(temporary, 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(COLUMNS)
+                writer.writerows(rows)
+        os.replace(temporary, path)
+
+
+log = ViolationLog()  # Of the current run
+
+
+def start() -> ViolationLog:
+    '''Starts the log of a new run'''
+    global log
+    log = ViolationLog()
+    return log
+
+# endregion